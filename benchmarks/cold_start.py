@@ -0,0 +1,163 @@
+"""
+Measure ETL cold start: module import time and first invocation latency.
+
+Every run starts a fresh interpreter that imports ``etl/runtime/handler.py``
+and invokes it twice against a local stub serving a synthetic feed and the
+S3 API, so no network access or AWS account is needed. ``--ref`` measures
+the runtime of another git revision for before/after comparisons:
+
+    python benchmarks/cold_start.py --runs 5
+    python benchmarks/cold_start.py --runs 5 --ref HEAD~1
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+RUNTIME_DIR = os.path.join(REPO_DIR, "etl", "runtime")
+
+
+def child(vehicles):
+    """
+    Runs in a fresh interpreter: import the handler and invoke it twice
+    """
+
+    sys.path.insert(0, BENCHMARKS_DIR)
+    from stubs import start_stub_server
+    from synthetic import build_feed
+
+    now = int(time.time())
+    feeds = [build_feed(vehicles, seed=seed, timestamp=now + seed) for seed in range(3)]
+    # removed when the interpreter exits
+    objects = tempfile.TemporaryDirectory(prefix="cold-start-s3-")
+    server = start_stub_server(feeds, objects.name)
+    server.store.create_bucket("bench-bucket")
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}"
+
+    os.environ.update(
+        {
+            "VEH_POSITION_URL": f"{endpoint}/feed",
+            "TIMEZONE": "America/Toronto",
+            "STAGE": "bench",
+            "DESTINATION_BUCKET": "bench-bucket",
+            "AWS_ENDPOINT_URL_S3": endpoint,
+            "AWS_ACCESS_KEY_ID": "bench",
+            "AWS_SECRET_ACCESS_KEY": "bench",
+            "AWS_DEFAULT_REGION": "us-west-2",
+        }
+    )
+    sys.path.insert(0, os.getcwd())
+
+    start = time.perf_counter()
+    import handler
+
+    init_seconds = time.perf_counter() - start
+
+    timings = []
+    for _ in range(2):
+        start = time.perf_counter()
+        handler.handler({}, None)
+        timings.append(time.perf_counter() - start)
+
+    print(
+        json.dumps(
+            {"init": init_seconds, "first_invocation": timings[0], "warm_invocation": timings[1]}
+        )
+    )
+
+
+def import_profile(runtime_dir, top):
+    """
+    Top level imports of the handler sorted by cumulative import time
+    """
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import handler"],
+        cwd=runtime_dir,
+        env={**os.environ, "PRIME_ON_INIT": "false"},
+        capture_output=True,
+        text=True,
+    )
+
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth <= 1:
+            modules.append((int(cumulative) / 1e6, name.strip()))
+
+    return sorted(modules, reverse=True)[:top]
+
+
+def export_runtime(ref, directory):
+    """
+    Extract etl/runtime of a git revision into ``directory``
+    """
+
+    archive = os.path.join(directory, "runtime.tar")
+    subprocess.run(
+        ["git", "archive", "--format=tar", f"--output={archive}", ref, "etl/runtime"],
+        cwd=REPO_DIR,
+        check=True,
+    )
+    with tarfile.open(archive) as tar:
+        tar.extractall(directory)
+    return os.path.join(directory, "etl", "runtime")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--vehicles", type=int, default=2000)
+    parser.add_argument("--ref", help="git revision to measure instead of the working tree")
+    parser.add_argument("--top", type=int, default=10, help="imports to list")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args.vehicles)
+
+    with tempfile.TemporaryDirectory() as directory:
+        runtime_dir = export_runtime(args.ref, directory) if args.ref else RUNTIME_DIR
+
+        runs = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            result = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child", "--vehicles", str(args.vehicles)],
+                cwd=runtime_dir,
+                capture_output=True,
+                text=True,
+            )
+            process_seconds = time.perf_counter() - start
+            if result.returncode:
+                sys.exit(result.stderr)
+            run = json.loads(result.stdout.strip().splitlines()[-1])
+            run["process"] = process_seconds
+            runs.append(run)
+
+        print(f"runtime: {args.ref or 'working tree'}  runs: {args.runs}  vehicles: {args.vehicles}")
+        for metric in ("init", "first_invocation", "warm_invocation", "process"):
+            values = [run[metric] for run in runs]
+            print(
+                f"{metric:>17}: median {statistics.median(values) * 1000:8.1f} ms  "
+                f"min {min(values) * 1000:8.1f} ms"
+            )
+
+        print("import time (cumulative, without priming):")
+        for seconds, name in import_profile(runtime_dir, args.top):
+            print(f"  {seconds * 1000:8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Benchmark the columnar vehicle position decoder against the dict-based path.
+
+Usage:
+
+    python benchmarks/decode.py --vehicles 5000 --repeat 20
+"""
+
+import argparse
+import datetime as dt
+import os
+import sys
+import time
+from zoneinfo import ZoneInfo
+
+import pyarrow as pa
+from google.transit import gtfs_realtime_pb2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "etl", "runtime"))
+
+from decoder import decode_vehicle_positions  # noqa: E402
+from synthetic import build_feed  # noqa: E402
+
+
+def legacy_decode(feed, timezone):
+    """
+    The list-of-dicts decode and per-row timestamp conversion the handler
+    used before the columnar decoder
+    """
+
+    records = []
+    for entity in feed.entity:
+        if entity.HasField("vehicle"):
+            v = entity.vehicle
+            records.append(
+                {
+                    "trip_id": v.trip.trip_id if v.HasField("trip") else None,
+                    "route_id": v.trip.route_id if v.HasField("trip") else None,
+                    "direction_id": v.trip.route_id if v.HasField("trip") else None,
+                    "vehicle_id": v.vehicle.id if v.HasField("vehicle") else None,
+                    "latitude": v.position.latitude if v.HasField("position") else None,
+                    "longitude": v.position.longitude
+                    if v.HasField("position")
+                    else None,
+                    "bearing": v.position.bearing if v.HasField("position") else None,
+                    "speed": v.position.speed if v.HasField("position") else None,
+                    "timestamp": v.timestamp if v.HasField("timestamp") else None,
+                }
+            )
+
+    schema = pa.schema(
+        [
+            pa.field("trip_id", pa.string()),
+            pa.field("route_id", pa.string()),
+            pa.field("direction_id", pa.string()),
+            pa.field("vehicle_id", pa.string()),
+            pa.field("latitude", pa.float64()),
+            pa.field("longitude", pa.float64()),
+            pa.field("bearing", pa.float64()),
+            pa.field("speed", pa.float64()),
+            pa.field("timestamp", pa.int64()),
+        ],
+    )
+
+    pa_table = pa.Table.from_pylist(records, schema=schema)
+
+    parsed_time = pa.array(
+        [
+            dt.datetime.fromtimestamp(t, tz=ZoneInfo(timezone))
+            for t in pa_table["timestamp"].to_pylist()
+        ],
+        type=pa.timestamp("ns", tz=timezone),
+    )
+
+    return pa_table.set_column(
+        pa_table.schema.get_field_index("timestamp"), "timestamp", parsed_time
+    )
+
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--vehicles", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--timezone", default="America/Toronto")
+    args = parser.parse_args()
+
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(build_feed(args.vehicles))
+
+    legacy = legacy_decode(feed, args.timezone)
+    columnar = decode_vehicle_positions(feed, args.timezone)
+    assert legacy.equals(columnar), "columnar decoder output differs from legacy path"
+
+    legacy_seconds = best_of(lambda: legacy_decode(feed, args.timezone), args.repeat)
+    columnar_seconds = best_of(
+        lambda: decode_vehicle_positions(feed, args.timezone), args.repeat
+    )
+
+    print(f"vehicles: {args.vehicles}")
+    for name, seconds in (("legacy", legacy_seconds), ("columnar", columnar_seconds)):
+        print(
+            f"{name:>9}: {seconds * 1000:8.2f} ms  "
+            f"{args.vehicles / seconds:12,.0f} rows/s"
+        )
+    print(f"  speedup: {legacy_seconds / columnar_seconds:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Benchmark the vectorized geohash/WKB enrichment against the per-row path.
+
+Usage:
+
+    python benchmarks/enrich.py --vehicles 5000 --repeat 20
+
+The per-row path needs pygeohash installed (`pip install pygeohash`).
+"""
+
+import argparse
+import array
+import os
+import sys
+
+import geoarrow.pyarrow as ga
+import pyarrow as pa
+import pygeohash as pgh
+from google.transit import gtfs_realtime_pb2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "etl", "runtime"))
+
+from decode import best_of  # noqa: E402
+from decoder import decode_vehicle_positions  # noqa: E402
+from enrich import enrich_positions  # noqa: E402
+from synthetic import build_feed  # noqa: E402
+
+
+def legacy_enrich(pa_table, precision):
+    """
+    The pygeohash loop and array.array point construction the handler used
+    before the vectorized kernel
+    """
+
+    latitudes = pa_table["latitude"].to_pylist()
+    longitudes = pa_table["longitude"].to_pylist()
+
+    geohashes = [
+        pgh.encode(lat, lon, precision=precision)
+        for lat, lon in zip(latitudes, longitudes)
+    ]
+    pa_table = pa_table.append_column(pa.field("geohash", pa.string()), pa.array(geohashes))
+
+    points = ga.point().from_geobuffers(
+        None, array.array("d", longitudes), array.array("d", latitudes)
+    )
+    wkb_array = ga.as_wkb(ga.with_crs(points, ga.OGC_CRS84))
+
+    pa_table = pa_table.append_column(pa.field("geometry", ga.wkb()), wkb_array)
+    return pa_table.drop_columns(["latitude", "longitude"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--vehicles", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--precision", type=int, default=7)
+    args = parser.parse_args()
+
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(build_feed(args.vehicles))
+    decoded = decode_vehicle_positions(feed, "America/Toronto")
+
+    legacy = legacy_enrich(decoded, args.precision)
+    vectorized = enrich_positions(decoded, precision=args.precision)
+    assert legacy["geohash"].equals(vectorized["geohash"]), "geohash mismatch"
+    assert legacy["geometry"].combine_chunks().storage.equals(
+        vectorized["geometry"].combine_chunks().storage
+    ), "geometry mismatch"
+
+    legacy_seconds = best_of(lambda: legacy_enrich(decoded, args.precision), args.repeat)
+    vectorized_seconds = best_of(
+        lambda: enrich_positions(decoded, precision=args.precision), args.repeat
+    )
+
+    print(f"vehicles: {args.vehicles}")
+    for name, seconds in (("legacy", legacy_seconds), ("vectorized", vectorized_seconds)):
+        print(
+            f"{name:>10}: {seconds * 1000:8.2f} ms  "
+            f"{args.vehicles / seconds:12,.0f} rows/s"
+        )
+    print(f"   speedup: {legacy_seconds / vectorized_seconds:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Time the planning of a compaction against an S3 stand-in with latency.
+
+One day of polls of a synthetic fleet is written as raw files to the S3
+stand-in of ``stubs.py``, which answers every request after ``--latency``
+seconds, and the compaction handler compacts the day once with the raw day
+listed as one range and once split by poll hour (``listing_bounds``).
+Reported per run are the listing, footer and read times against the whole
+compaction, the share of the compaction spent before reading (listing and
+footers) and the S3 requests per raw file:
+
+    python benchmarks/planning.py --vehicles 500 --polls 1440 --latency 0.02
+"""
+
+import argparse
+import datetime as dt
+import os
+import shutil
+import sys
+import tempfile
+import time
+from zoneinfo import ZoneInfo
+
+from google.transit import gtfs_realtime_pb2
+from pyarrow import fs
+
+from suite import load_compaction
+from stubs import start_stub_server
+
+import metrics
+from decoder import decode_vehicle_positions
+from enrich import enrich_positions
+from geoparquet import write_geoparquet
+from ingest import positions_object_key
+from synthetic import FleetSimulator
+
+BUCKET = "planning"
+STAGE = "bench"
+DAY = dt.date(2024, 5, 1)
+
+
+def write_day(store, vehicles, polls, timezone, precision):
+    """
+    ``polls`` polls of a synthetic fleet spread over DAY, written straight
+    to the stand-in's store
+    """
+
+    zone = ZoneInfo(timezone)
+    start = dt.datetime.combine(DAY, dt.time(), zone)
+    interval = 86400 / polls
+    simulator = FleetSimulator(vehicles, seed=0, start=start.timestamp())
+    for _ in range(polls):
+        simulator.step(interval)
+        message = gtfs_realtime_pb2.FeedMessage()
+        message.ParseFromString(simulator.feed())
+        pa_table = enrich_positions(
+            decode_vehicle_positions(message, timezone), precision=precision
+        )
+        poll_time = dt.datetime.fromtimestamp(simulator.now, zone)
+        store.put(BUCKET, positions_object_key(STAGE, poll_time), write_geoparquet(pa_table))
+
+
+def compact(compaction, server, timezone, sharded):
+    collector = metrics.MemoryCollector()
+    metrics.set_collector(collector)
+    listing_bounds = compaction.listing_bounds
+    if not sharded:
+        compaction.listing_bounds = lambda period, partitioning: []
+    server.requests.clear()
+    started = time.perf_counter()
+    try:
+        compaction.handler(
+            {
+                "s3_bucket": BUCKET,
+                "timezone": timezone,
+                "stage": STAGE,
+                "previous_days": 1,
+                "dates": [DAY.isoformat()],
+                "datasets": ["positions"],
+                "workers": 1,
+                "incremental": False,
+            },
+            None,
+        )
+    finally:
+        compaction.listing_bounds = listing_bounds
+    seconds = time.perf_counter() - started
+    (record,) = collector.records
+    return record, dict(server.requests), seconds
+
+
+def run(vehicles, polls, latency, timezone, precision):
+    directory = tempfile.mkdtemp(prefix="planning-")
+    server = start_stub_server([b""], directory, latency=latency)
+    try:
+        server.store.create_bucket(BUCKET)
+        started = time.perf_counter()
+        write_day(server.store, vehicles, polls, timezone, precision)
+        print(f"wrote {polls} polls of {vehicles} vehicles in {time.perf_counter() - started:.1f} s")
+
+        # the handler builds its clients at import time
+        endpoint = f"http://127.0.0.1:{server.server_address[1]}"
+        os.environ.update(
+            AWS_ENDPOINT_URL_S3=endpoint,
+            AWS_ACCESS_KEY_ID="planning",
+            AWS_SECRET_ACCESS_KEY="planning",
+            AWS_DEFAULT_REGION="us-west-2",
+        )
+        compaction = load_compaction()
+        compaction.s3fs = fs.S3FileSystem(
+            access_key="planning",
+            secret_key="planning",
+            region="us-west-2",
+            endpoint_override=endpoint,
+            scheme="http",
+        )
+
+        results = []
+        for sharded in (False, True):
+            record, requests, seconds = compact(compaction, server, timezone, sharded)
+            planning_ms = record["list_ms"] + record["footers_ms"]
+            results.append(
+                {
+                    "vehicles": vehicles,
+                    "files": record["objects_read"],
+                    "listing": "by hour" if sharded else "one range",
+                    "list_ms": record["list_ms"],
+                    "footers_ms": record["footers_ms"],
+                    "read_ms": record["read_ms"],
+                    "compact_ms": record["compact_ms"],
+                    "planning_share": planning_ms / (record["list_ms"] + record["compact_ms"]),
+                    "requests_per_file": sum(requests.values()) / record["objects_read"],
+                    "seconds": seconds,
+                }
+            )
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def print_results(results):
+    print(
+        f"{'vehicles':>9} {'files':>6} {'listing':>10} {'list ms':>8} {'footers ms':>11} "
+        f"{'read ms':>8} {'compact ms':>11} {'planning':>9} {'req/file':>9}"
+    )
+    for result in results:
+        print(
+            f"{result['vehicles']:>9} {result['files']:>6} {result['listing']:>10} "
+            f"{result['list_ms']:>8.0f} {result['footers_ms']:>11.0f} {result['read_ms']:>8.0f} "
+            f"{result['compact_ms']:>11.0f} {result['planning_share']:>9.0%} "
+            f"{result['requests_per_file']:>9.2f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--vehicles", type=int, default=500)
+    parser.add_argument("--polls", type=int, default=1440)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per S3 request")
+    parser.add_argument("--timezone", default="America/Toronto")
+    parser.add_argument("--precision", type=int, default=7)
+    args = parser.parse_args()
+
+    print_results(
+        run(args.vehicles, args.polls, args.latency, args.timezone, args.precision)
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,219 @@
+"""
+Compare the version 1 and the compact version 2 raw positions schema.
+
+Each feed is decoded and enriched once, then written both in the version 1
+layout with the previous writer settings (plain strings, float64 bearing and
+speed, snappy) and in the current layout with the current settings. Reported
+per layout are the bytes per row of the raw files, write and read throughput,
+the in-memory Arrow size of a poll and the bytes per row after compacting
+all polls, version 1 with the previous compaction settings and version 2
+with the compaction function:
+
+    python benchmarks/raw_schema.py --vehicles 1000,10000 --polls 20
+    python benchmarks/raw_schema.py --feed captured/*.pb
+
+``--feed`` takes feeds saved from an agency (e.g. with curl) in polling order,
+so the comparison can be run on real data.
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import sys
+import tempfile
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from google.transit import gtfs_realtime_pb2
+from pyarrow import fs
+
+from suite import START, best_of, load_compaction
+
+from decoder import decode_vehicle_positions
+from enrich import enrich_positions
+from geoparquet import write_geoparquet
+from synthetic import FleetSimulator
+
+LAYOUTS = ("v1", "v2")
+
+
+def legacy_positions(pa_table):
+    """
+    The same rows in the version 1 layout: string identifiers, the route id
+    in direction_id, float64 bearing/speed and no status columns
+    """
+
+    route_id = pa_table["route_id"].cast(pa.string())
+    return pa.table(
+        {
+            "trip_id": pa_table["trip_id"].cast(pa.string()),
+            "route_id": route_id,
+            "direction_id": route_id,
+            "vehicle_id": pa_table["vehicle_id"].cast(pa.string()),
+            "bearing": pa_table["bearing"].cast(pa.float64()),
+            "speed": pa_table["speed"].cast(pa.float64()),
+            "timestamp": pa_table["timestamp"],
+            "geohash": pa_table["geohash"].cast(pa.string()),
+            "geometry": pa_table["geometry"],
+        }
+    )
+
+
+def write(layout, pa_table):
+    if layout == "v1":
+        return write_geoparquet(legacy_positions(pa_table), compression="snappy")
+    return write_geoparquet(pa_table)
+
+
+def legacy_compact(uris, output_dir):
+    """
+    Compact version 1 files the way the compaction function did before:
+    zstd 15 with default (all column) dictionary encoding
+    """
+
+    parquet_format = ds.ParquetFileFormat()
+    ds.write_dataset(
+        ds.dataset(uris, format="parquet"),
+        output_dir,
+        format="parquet",
+        file_options=parquet_format.make_write_options(compression="zstd", compression_level=15),
+        basename_template="positions_{i}.parquet",
+        min_rows_per_group=61440,
+        max_rows_per_group=122880,
+        existing_data_behavior="overwrite_or_ignore",
+        preserve_order=True,
+    )
+
+
+def synthetic_feeds(vehicles, polls, seed=0):
+    simulator = FleetSimulator(vehicles, seed=seed, start=START)
+    for _ in range(polls):
+        simulator.step(30)
+        yield simulator.feed()
+
+
+def compare(label, feeds, timezone, precision, repeat, compaction):
+    """
+    Measure both layouts over a sequence of serialized feeds
+    """
+
+    tables = []
+    for content in feeds:
+        message = gtfs_realtime_pb2.FeedMessage()
+        message.ParseFromString(content)
+        tables.append(
+            enrich_positions(decode_vehicle_positions(message, timezone), precision=precision)
+        )
+    rows = sum(table.num_rows for table in tables)
+    sample = max(tables, key=lambda table: table.num_rows)
+
+    results = []
+    for layout in LAYOUTS:
+        directory = tempfile.mkdtemp(prefix=f"raw-schema-{layout}-")
+        try:
+            uris = []
+            raw_bytes = 0
+            for i, table in enumerate(tables):
+                data = write(layout, table)
+                raw_bytes += len(data)
+                uris.append(os.path.join(directory, f"{i:05d}.parquet"))
+                with open(uris[-1], "wb") as f:
+                    f.write(data)
+
+            write_seconds, data = best_of(lambda: write(layout, sample), repeat)
+            read_seconds, decoded = best_of(lambda: pq.read_table(pa.BufferReader(data)), repeat)
+
+            output_dir = os.path.join(directory, "compacted")
+            os.makedirs(output_dir)
+            if layout == "v1":
+                legacy_compact(uris, output_dir)
+            else:
+                compaction.compact_dataset(uris, fs.LocalFileSystem(), output_dir)
+            compacted_bytes = sum(
+                os.path.getsize(path) for path in glob.glob(os.path.join(output_dir, "*.parquet"))
+            )
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        results.append(
+            {
+                "feed": label,
+                "layout": layout,
+                "rows": rows,
+                "raw_bytes_per_row": raw_bytes / max(rows, 1),
+                "write_rows_per_second": sample.num_rows / write_seconds,
+                "read_rows_per_second": sample.num_rows / read_seconds,
+                "arrow_bytes": decoded.nbytes,
+                "compacted_bytes_per_row": compacted_bytes / max(rows, 1),
+            }
+        )
+    return results
+
+
+def print_results(results):
+    print(
+        f"{'feed':>12} {'layout':>6} {'rows':>9} {'raw B/row':>10} {'write rows/s':>13} "
+        f"{'read rows/s':>12} {'arrow MB':>9} {'compact B/row':>14}"
+    )
+    baseline = {}
+    for result in results:
+        if result["layout"] == "v1":
+            baseline[result["feed"]] = result
+        print(
+            f"{result['feed']:>12} {result['layout']:>6} {result['rows']:>9} "
+            f"{result['raw_bytes_per_row']:>10.1f} {result['write_rows_per_second']:>13,.0f} "
+            f"{result['read_rows_per_second']:>12,.0f} {result['arrow_bytes'] / 1e6:>9.2f} "
+            f"{result['compacted_bytes_per_row']:>14.1f}"
+        )
+        if result["layout"] != "v1" and result["feed"] in baseline:
+            before = baseline[result["feed"]]
+            print(
+                f"{'':>12} {'change':>6} {'':>9} "
+                f"{result['raw_bytes_per_row'] / before['raw_bytes_per_row'] - 1:>+10.0%} "
+                f"{result['write_rows_per_second'] / before['write_rows_per_second'] - 1:>+13.0%} "
+                f"{result['read_rows_per_second'] / before['read_rows_per_second'] - 1:>+12.0%} "
+                f"{result['arrow_bytes'] / before['arrow_bytes'] - 1:>+9.0%} "
+                f"{result['compacted_bytes_per_row'] / before['compacted_bytes_per_row'] - 1:>+14.0%}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--vehicles", default="1000,10000")
+    parser.add_argument("--polls", type=int, default=20)
+    parser.add_argument(
+        "--feed", nargs="*", default=[], help="serialized FeedMessage files, in polling order"
+    )
+    parser.add_argument("--timezone", default="America/Toronto")
+    parser.add_argument("--precision", type=int, default=7)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    compaction = load_compaction()
+
+    results = []
+    if args.feed:
+        feeds = []
+        for path in args.feed:
+            with open(path, "rb") as f:
+                feeds.append(f.read())
+        results += compare(
+            "captured", feeds, args.timezone, args.precision, args.repeat, compaction
+        )
+    else:
+        for vehicles in (int(value) for value in args.vehicles.split(",")):
+            results += compare(
+                str(vehicles),
+                synthetic_feeds(vehicles, args.polls),
+                args.timezone,
+                args.precision,
+                args.repeat,
+                compaction,
+            )
+    print_results(results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+"""
+Time replaying a raw feed archive into compacted daily files.
+
+A synthetic fleet is polled every ``--interval`` seconds for ``--days`` days
+and its feed bodies archived as the handler archives them with ARCHIVE_RAW
+(``etl/runtime/archive.py``), to a local directory. ``replay.py`` then
+reprocesses the whole range with ``--workers`` processes. Reported are the
+archive size, the replay time and throughput in bodies and rows per second,
+and the compacted output:
+
+    python benchmarks/replay.py --vehicles 1000 --days 2 --interval 60 --workers 1,4
+"""
+
+import argparse
+import datetime as dt
+import os
+import shutil
+import sys
+import tempfile
+import time
+from zoneinfo import ZoneInfo
+
+from suite import START
+
+from archive import RawArchive
+from feeds import Feed
+from replay import ReplayOptions, replay
+from sinks import LocalSink
+from synthetic import FleetSimulator
+
+STAGE = "bench"
+
+
+def archive_fleet(root, vehicles, days, interval, timezone):
+    """
+    Archive ``days`` days of polls of a synthetic fleet below ``root``,
+    returning (first day, last day, bodies, archive bytes)
+    """
+
+    zone = ZoneInfo(timezone)
+    # start at the first midnight after START so every day is complete
+    start = dt.datetime.fromtimestamp(START, zone).date() + dt.timedelta(days=1)
+    first = dt.datetime.combine(start, dt.time(), zone)
+    simulator = FleetSimulator(vehicles, seed=0, start=first.timestamp())
+    archive = RawArchive(LocalSink(root))
+
+    bodies = 0
+    polls = int(days * 86400 / interval)
+    for _ in range(polls):
+        simulator.step(interval)
+        poll_time = dt.datetime.fromtimestamp(simulator.now, zone)
+        archive.append(STAGE, "positions", poll_time, simulator.feed())
+        bodies += 1
+    archive.flush(force=True)
+
+    size = sum(
+        os.path.getsize(os.path.join(directory, file))
+        for directory, _, files in os.walk(root)
+        for file in files
+    )
+    return start, start + dt.timedelta(days=days - 1), bodies, size
+
+
+def run(vehicles, days, interval, workers, timezone, precision, spatial_sort):
+    directory = tempfile.mkdtemp(prefix="replay-bench-")
+    results = []
+    try:
+        archive_dir = os.path.join(directory, "archive")
+        started = time.perf_counter()
+        first, last, bodies, archive_bytes = archive_fleet(
+            archive_dir, vehicles, days, interval, timezone
+        )
+        print(
+            f"archived {bodies} polls of {vehicles} vehicles ({archive_bytes / 1e6:.1f} MB) "
+            f"in {time.perf_counter() - started:.1f} s"
+        )
+
+        feed = Feed(stage=STAGE, url="", timezone=timezone)
+        options = ReplayOptions(geohash_precision=precision, spatial_sort=spatial_sort)
+        for count in workers:
+            output_dir = os.path.join(directory, f"out-{count}")
+            staging = os.path.join(directory, f"staging-{count}")
+            os.makedirs(staging)
+            started = time.perf_counter()
+            totals = replay(
+                feed,
+                first,
+                last,
+                f"file://{archive_dir}",
+                f"file://{output_dir}",
+                staging,
+                ("positions",),
+                options,
+                count,
+            )
+            seconds = time.perf_counter() - started
+            results.append(
+                {
+                    "vehicles": vehicles,
+                    "workers": count,
+                    "bodies": totals["bodies"],
+                    "rows": totals["rows"],
+                    "days": totals["days"],
+                    "seconds": seconds,
+                    "bodies_per_second": totals["bodies"] / seconds,
+                    "rows_per_second": totals["rows"] / seconds,
+                    "archive_bytes": archive_bytes,
+                    "output_bytes": totals["bytes"],
+                }
+            )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def print_results(results):
+    print(
+        f"{'vehicles':>9} {'workers':>8} {'bodies':>8} {'rows':>11} {'days':>5} "
+        f"{'seconds':>8} {'bodies/s':>9} {'rows/s':>10} {'archive MB':>11} {'output MB':>10}"
+    )
+    for result in results:
+        print(
+            f"{result['vehicles']:>9} {result['workers']:>8} {result['bodies']:>8} "
+            f"{result['rows']:>11} {result['days']:>5} {result['seconds']:>8.1f} "
+            f"{result['bodies_per_second']:>9.0f} {result['rows_per_second']:>10.0f} "
+            f"{result['archive_bytes'] / 1e6:>11.1f} {result['output_bytes'] / 1e6:>10.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--vehicles", default="1000")
+    parser.add_argument("--days", type=int, default=2)
+    parser.add_argument("--interval", type=int, default=60, help="seconds between polls")
+    parser.add_argument("--workers", default=str(os.cpu_count()))
+    parser.add_argument("--timezone", default="America/Toronto")
+    parser.add_argument("--precision", type=int, default=7)
+    parser.add_argument("--spatial-sort", choices=("hilbert", "geohash"))
+    args = parser.parse_args()
+
+    workers = [int(value) for value in args.workers.split(",")]
+    results = []
+    for vehicles in (int(value) for value in args.vehicles.split(",")):
+        results += run(
+            vehicles,
+            args.days,
+            args.interval,
+            workers,
+            args.timezone,
+            args.precision,
+            args.spatial_sort,
+        )
+    print_results(results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
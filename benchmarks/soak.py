@@ -0,0 +1,610 @@
+"""
+Soak the ETL and compaction handlers under the deployed Lambda limits.
+
+For every fleet size and backlog (hours of raw files) the harness serves a
+synthetic feed and a filesystem backed S3 stand-in (``stubs.py``), invokes
+the ETL handler once per ``--cadence`` seconds of simulated time in one
+long lived process, like a warm Lambda container, and then runs the
+compaction handler over the day partitions that were written. Simulated
+time only moves the feed header, the vehicle timestamps and the object keys
+forward, so an hour of polls runs as fast as the handler does. Raw
+positions are partitioned on the vehicle timestamps, as deployed by
+default, or on the poll time with ``--partition-time poll``.
+
+Each process is killed once it goes over its limit, as Lambda would:
+
+    ETL         512 MB memory, 10 s per invocation
+    compaction  2048 MB memory, 2048 MB ephemeral storage in /tmp, 15 min
+
+and the report names the first fleet size or backlog that broke each
+limit. Memory is the resident set size read from /proc, so the harness
+needs Linux (like Lambda):
+
+    python benchmarks/soak.py --vehicles 1000,10000,50000 --hours 1,6
+"""
+
+import argparse
+import datetime as dt
+import json
+import math
+import os
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from zoneinfo import ZoneInfo
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+RUNTIME_DIR = os.path.join(REPO_DIR, "etl", "runtime")
+
+# as deployed by etl/infrastructure/construct.py and compaction/infrastructure
+ETL_MEMORY_MB = 512
+ETL_TIMEOUT_SECONDS = 10
+COMPACTION_MEMORY_MB = 2048
+COMPACTION_STORAGE_MB = 2048
+COMPACTION_TIMEOUT_SECONDS = 15 * 60
+
+BUCKET = "soak"
+DATASETS = ("positions", "trip_updates")
+# prefix of the lines children report on, everything else is handler output
+MARKER = "SOAK "
+# compaction streams its output to S3; any disk it uses here counts against the limit
+COMPACTION_TMP = "/tmp"
+POLL_SECONDS = 0.05
+# the children enforce their own timeouts; the parent only steps in this much later
+WATCHDOG_GRACE_SECONDS = 10
+
+MB = 1024 * 1024
+
+
+class InvocationTimeout(BaseException):
+    """Like a Lambda timeout, not caught by the handler's error handling."""
+
+
+def emit(record):
+    print(MARKER + json.dumps(record), flush=True)
+
+
+def process_memory(pid="self"):
+    """
+    Current and peak resident set size of a process, in bytes
+    """
+
+    values = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name in ("VmRSS", "VmHWM"):
+                values[name] = int(value.split()[0]) * 1024
+    return values.get("VmRSS", 0), values.get("VmHWM", 0)
+
+
+def directory_size(path, exclude=()):
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.path in exclude:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                total += directory_size(entry.path, exclude)
+            elif entry.is_file(follow_symlinks=False):
+                total += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            # files come and go while the child runs
+            continue
+    return total
+
+
+def arm_timeout(seconds):
+    def expire(signum, frame):
+        raise InvocationTimeout()
+
+    signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+
+
+def disarm_timeout():
+    signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+class SimulatedClock:
+    """Stands in for ``datetime.datetime`` so object keys follow simulated time."""
+
+    def __init__(self, start):
+        self.now = start
+
+    def datetime_module(self):
+        clock = self
+
+        class SimulatedDatetime(dt.datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return dt.datetime.fromtimestamp(clock.now, tz)
+
+        module = type(sys)("simulated_datetime")
+        module.datetime = SimulatedDatetime
+        return module
+
+
+class FeedRing:
+    """
+    Polls of a synthetic fleet, ``cadence`` seconds apart
+
+    ``distinct`` snapshots are generated up front and served in turn with a
+    fresh header and vehicle timestamps moved forward by the rounds served
+    before, so a large fleet doesn't have to be simulated for every poll of
+    a long soak. With ``stops`` the fleet's trip updates, predicting that
+    many stops per trip, are served as well.
+    """
+
+    def __init__(self, vehicles, start, cadence, distinct, stops=0, seed=0):
+        from synthetic import FleetSimulator
+
+        simulator = FleetSimulator(vehicles, seed=seed, start=start)
+        self.entities = {"positions": [], "trip_updates": []}
+        for snapshot in range(distinct):
+            if snapshot:
+                simulator.step(cadence)
+            messages = {"positions": simulator.message()}
+            if stops:
+                messages["trip_updates"] = simulator.trip_updates(stops)
+            for kind, message in messages.items():
+                message.ClearField("header")
+                self.entities[kind].append(message.SerializePartialToString())
+
+        self.start = start
+        self.cadence = cadence
+        self.polls = {kind: 0 for kind in self.entities}
+        self.lock = threading.Lock()
+        # the next poll of each kind, rendered while the handler works on this one
+        self.renderer = ThreadPoolExecutor(max_workers=1)
+        self.rendered = {}
+
+    def render(self, kind, poll):
+        from google.transit import gtfs_realtime_pb2
+
+        header = gtfs_realtime_pb2.FeedMessage()
+        header.header.gtfs_realtime_version = "2.0"
+        header.header.timestamp = self.start + poll * self.cadence
+        entities = self.entities[kind]
+        body = entities[poll % len(entities)]
+        offset = (poll - poll % len(entities)) * self.cadence
+        if kind == "positions" and offset:
+            # vehicle timestamps follow the simulated clock through every
+            # round of the snapshots, for event time partitioning
+            message = gtfs_realtime_pb2.FeedMessage()
+            message.ParseFromString(body)
+            for entity in message.entity:
+                if entity.HasField("vehicle") and entity.vehicle.HasField("timestamp"):
+                    entity.vehicle.timestamp += offset
+            body = message.SerializePartialToString()
+        # concatenated messages parse as one, so only the header is serialized per poll
+        return header.SerializeToString() + body
+
+    def serve(self, kind):
+        with self.lock:
+            poll = self.polls[kind]
+            self.polls[kind] += 1
+            rendered = self.rendered.pop(kind, None)
+            self.rendered[kind] = self.renderer.submit(self.render, kind, poll + 1)
+        return rendered.result() if rendered is not None else self.render(kind, poll)
+
+
+def etl_child(args):
+    """
+    Runs in its own process: invoke the ETL handler at every simulated poll
+    """
+
+    sys.path.insert(0, RUNTIME_DIR)
+    clock = SimulatedClock(args.start)
+
+    import handler
+
+    handler.dt = clock.datetime_module()
+    emit({"event": "init", "rss": process_memory()[0]})
+
+    for invocation in range(args.invocations):
+        clock.now = args.start + invocation * args.cadence
+        start = time.perf_counter()
+        arm_timeout(args.timeout)
+        try:
+            result = handler.handler({}, None)
+        except InvocationTimeout:
+            emit({"event": "timeout", "invocation": invocation, "seconds": time.perf_counter() - start})
+            return
+        finally:
+            disarm_timeout()
+
+        emit(
+            {
+                "event": "invocation",
+                "invocation": invocation,
+                "seconds": time.perf_counter() - start,
+                "records": result["records"],
+                "skipped": result["skipped"],
+                "rss": process_memory()[0],
+            }
+        )
+
+
+def compaction_child(args):
+    """
+    Runs in its own process: invoke the compaction handler once
+    """
+
+    sys.path.insert(0, BENCHMARKS_DIR)
+    from pyarrow import fs
+
+    from suite import load_compaction
+
+    compaction = load_compaction()
+    # boto3 follows AWS_ENDPOINT_URL_S3, pyarrow needs the stand-in spelled out
+    compaction.s3fs = fs.S3FileSystem(
+        access_key=os.environ["AWS_ACCESS_KEY_ID"],
+        secret_key=os.environ["AWS_SECRET_ACCESS_KEY"],
+        region=os.environ["AWS_DEFAULT_REGION"],
+        endpoint_override=os.environ["AWS_ENDPOINT_URL_S3"],
+        scheme="http",
+    )
+
+    start = time.perf_counter()
+    arm_timeout(args.timeout)
+    try:
+        compaction.handler(
+            {
+                "s3_bucket": BUCKET,
+                "previous_days": args.days,
+                "timezone": args.timezone,
+                "compact_to_now": False,
+                "stage": args.stage,
+            },
+            None,
+        )
+    except InvocationTimeout:
+        emit({"event": "timeout", "seconds": time.perf_counter() - start})
+        return
+    finally:
+        disarm_timeout()
+    emit({"event": "done", "seconds": time.perf_counter() - start})
+
+
+def supervise(command, env, memory_limit, timeout, storage_limit=None, storage_exclude=()):
+    """
+    Run a child, killing it when it goes over a limit
+
+    The child enforces ``timeout`` itself per invocation; the parent kills it
+    when it hasn't reported for ``WATCHDOG_GRACE_SECONDS`` longer than that,
+    which catches a child stuck in native code. Returns (reports, breach or None, peak rss, peak storage).
+    """
+
+    storage_baseline = directory_size(COMPACTION_TMP, storage_exclude) if storage_limit else 0
+    process = subprocess.Popen(
+        command,
+        cwd=RUNTIME_DIR,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+
+    state = {"breach": None, "peak_rss": 0, "peak_storage": 0, "last_report": time.monotonic()}
+    finished = threading.Event()
+
+    def kill(breach):
+        if state["breach"] is None:
+            state["breach"] = breach
+        process.kill()
+
+    def monitor():
+        polls = 0
+        while not finished.wait(POLL_SECONDS):
+            try:
+                rss, peak = process_memory(process.pid)
+            except (FileNotFoundError, ProcessLookupError):
+                return
+            state["peak_rss"] = max(state["peak_rss"], rss, peak)
+            if rss > memory_limit:
+                return kill("memory")
+
+            polls += 1
+            # walking /tmp is slower than reading /proc, do it less often
+            if storage_limit and polls % 10 == 0:
+                used = directory_size(COMPACTION_TMP, storage_exclude) - storage_baseline
+                state["peak_storage"] = max(state["peak_storage"], used)
+                if used > storage_limit:
+                    return kill("storage")
+
+            if time.monotonic() - state["last_report"] > timeout + WATCHDOG_GRACE_SECONDS:
+                return kill("timeout")
+
+    # stderr is drained in the background so a chatty child never blocks
+    stderr = []
+    threading.Thread(target=lambda: stderr.extend(process.stderr), daemon=True).start()
+    watcher = threading.Thread(target=monitor, daemon=True)
+    watcher.start()
+
+    reports = []
+    for line in process.stdout:
+        if line.startswith(MARKER):
+            report = json.loads(line[len(MARKER) :])
+            state["last_report"] = time.monotonic()
+            reports.append(report)
+            if report["event"] == "timeout":
+                kill("timeout")
+    process.wait()
+    finished.set()
+    watcher.join()
+
+    if storage_limit:
+        used = directory_size(COMPACTION_TMP, storage_exclude) - storage_baseline
+        state["peak_storage"] = max(state["peak_storage"], used)
+        if used > storage_limit and state["breach"] is None:
+            state["breach"] = "storage"
+
+    if process.returncode and state["breach"] is None:
+        state["breach"] = "crash"
+        reports.append({"event": "crash", "stderr": "".join(stderr[-20:])})
+
+    return reports, state["breach"], state["peak_rss"], state["peak_storage"]
+
+
+def prefix_size(root, prefix):
+    path = os.path.join(root, BUCKET, *prefix.split("/"))
+    files = 0
+    for _, _, filenames in os.walk(path):
+        files += len(filenames)
+    return files, directory_size(path)
+
+
+def dataset_size(root, stage, suffix=""):
+    """
+    Files and bytes of every dataset of ``stage``, raw with ``suffix="_raw"``
+    """
+
+    sizes = [prefix_size(root, f"{stage}/{dataset}{suffix}") for dataset in DATASETS]
+    return sum(files for files, _ in sizes), sum(size for _, size in sizes)
+
+
+def run_scenario(args, server, endpoint, vehicles, hours):
+    timezone = ZoneInfo(args.timezone)
+    days = math.ceil(hours / 24)
+    # start at midnight so the backlog fills whole days the compaction picks up
+    midnight = dt.datetime.combine(
+        dt.datetime.now(timezone).date() - dt.timedelta(days=days), dt.time(), timezone
+    )
+    start = int(midnight.timestamp())
+    invocations = int(hours * 3600 / args.cadence)
+    stage = f"soak-{vehicles}v-{hours:g}h"
+
+    server.feeds["current"] = FeedRing(
+        vehicles, start, args.cadence, args.distinct_feeds, stops=args.stops
+    )
+
+    env = {
+        **os.environ,
+        "VEH_POSITION_URL": f"{endpoint}/feed",
+        "TRIP_UPDATE_URL": f"{endpoint}/trip_updates" if args.stops else "",
+        "TIMEZONE": args.timezone,
+        "STAGE": stage,
+        "DESTINATION_BUCKET": BUCKET,
+        "AWS_ENDPOINT_URL_S3": endpoint,
+        "AWS_ACCESS_KEY_ID": "soak",
+        "AWS_SECRET_ACCESS_KEY": "soak",
+        "AWS_DEFAULT_REGION": "us-west-2",
+        "PARTITION_TIME": args.partition_time,
+    }
+    env.pop("DESTINATION_URI", None)
+    env.pop("FEEDS", None)
+
+    reports, etl_breach, etl_rss, _ = supervise(
+        [
+            sys.executable, os.path.abspath(__file__), "--child", "etl",
+            "--start", str(start), "--invocations", str(invocations),
+            "--cadence", str(args.cadence), "--timeout", str(args.etl_timeout),
+        ],
+        env,
+        args.etl_memory * MB,
+        args.etl_timeout,
+    )
+
+    invoked = [report for report in reports if report["event"] == "invocation"]
+    seconds = sorted(report["seconds"] for report in invoked)
+    init_rss = next((report["rss"] for report in reports if report["event"] == "init"), 0)
+    result = {
+        "vehicles": vehicles,
+        "hours": hours,
+        "invocations": len(invoked),
+        "etl_p50": statistics.median(seconds) if seconds else None,
+        "etl_p95": seconds[int(len(seconds) * 0.95)] if seconds else None,
+        "etl_max": max(seconds) if seconds else None,
+        "etl_peak_rss": etl_rss,
+        "etl_growth": invoked[-1]["rss"] - invoked[0]["rss"] if invoked else 0,
+        "etl_init_rss": init_rss,
+        "etl_breach": etl_breach,
+    }
+    result["raw_files"], result["raw_bytes"] = dataset_size(server.store.root, stage, "_raw")
+    if etl_breach:
+        result["error"] = reports[-1].get("stderr") if reports else None
+        return result
+
+    reports, compaction_breach, compaction_rss, storage = supervise(
+        [
+            sys.executable, os.path.abspath(__file__), "--child", "compaction",
+            "--stage", stage, "--days", str(days), "--timezone", args.timezone,
+            "--timeout", str(args.compaction_timeout),
+        ],
+        env,
+        args.compaction_memory * MB,
+        args.compaction_timeout,
+        storage_limit=args.compaction_storage * MB,
+        storage_exclude=(server.store.root,),
+    )
+
+    done = next((report for report in reports if report["event"] == "done"), None)
+    result.update(
+        {
+            "compaction_seconds": done["seconds"] if done else None,
+            "compaction_peak_rss": compaction_rss,
+            "compaction_storage": storage,
+            "compaction_breach": compaction_breach,
+        }
+    )
+    result["compacted_files"], result["compacted_bytes"] = dataset_size(server.store.root, stage)
+    if compaction_breach:
+        result["error"] = reports[-1].get("stderr") if reports else None
+    return result
+
+
+def _seconds(value):
+    return f"{value:7.2f}" if value is not None else f"{'-':>7}"
+
+
+def _mb(value):
+    return f"{value / MB:8.1f}" if value is not None else f"{'-':>8}"
+
+
+def header():
+    print(
+        f"{'vehicles':>8} {'hours':>5} {'polls':>5} {'raw':>5} {'raw MB':>8} "
+        f"{'etl p95':>7} {'etl max':>7} {'etl MB':>8} {'growth':>8} "
+        f"{'compact':>7} {'cmp MB':>8} {'tmp MB':>8}  status"
+    )
+
+
+def print_result(result):
+    breaches = [
+        f"{process} {result[f'{process}_breach']}"
+        for process in ("etl", "compaction")
+        if result.get(f"{process}_breach")
+    ]
+    print(
+        f"{result['vehicles']:>8} {result['hours']:>5g} {result['invocations']:>5} "
+        f"{result['raw_files']:>5} {_mb(result['raw_bytes'])} "
+        f"{_seconds(result['etl_p95'])} {_seconds(result['etl_max'])} "
+        f"{_mb(result['etl_peak_rss'])} {_mb(result['etl_growth'])} "
+        f"{_seconds(result.get('compaction_seconds'))} "
+        f"{_mb(result.get('compaction_peak_rss'))} {_mb(result.get('compaction_storage'))}  "
+        + (", ".join(breaches) or "ok"),
+        flush=True,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--vehicles", default="1000,10000,50000", help="comma separated fleet sizes")
+    parser.add_argument("--hours", default="1", help="comma separated backlogs in simulated hours")
+    parser.add_argument(
+        "--cadence",
+        type=int,
+        default=int(os.environ.get("GTFS_RT_EVENT_SCHEDULE_SECONDS") or 60),
+        help="simulated seconds between ETL invocations (GTFS_RT_EVENT_SCHEDULE_SECONDS)",
+    )
+    parser.add_argument("--distinct-feeds", type=int, default=8, help="snapshots generated per fleet")
+    parser.add_argument(
+        "--stops", type=int, default=0, help="also serve trip updates with this many stops per trip"
+    )
+    parser.add_argument("--timezone", default="America/Toronto")
+    parser.add_argument(
+        "--partition-time",
+        choices=("event", "poll"),
+        default="event",
+        help="partition raw positions on the vehicle timestamps or the poll time",
+    )
+    parser.add_argument("--etl-memory", type=int, default=ETL_MEMORY_MB, help="MB")
+    parser.add_argument("--etl-timeout", type=float, default=ETL_TIMEOUT_SECONDS, help="seconds")
+    parser.add_argument(
+        "--compaction-memory",
+        type=int,
+        default=int(os.environ.get("GTFS_RT_EVENT_MEMORY_SIZE") or COMPACTION_MEMORY_MB),
+        help="MB (GTFS_RT_EVENT_MEMORY_SIZE)",
+    )
+    parser.add_argument("--compaction-storage", type=int, default=COMPACTION_STORAGE_MB, help="MB")
+    parser.add_argument(
+        "--compaction-timeout", type=float, default=COMPACTION_TIMEOUT_SECONDS, help="seconds"
+    )
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--child", choices=("etl", "compaction"), help=argparse.SUPPRESS)
+    parser.add_argument("--start", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--invocations", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--timeout", type=float, help=argparse.SUPPRESS)
+    parser.add_argument("--stage", help=argparse.SUPPRESS)
+    parser.add_argument("--days", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child == "etl":
+        return etl_child(args)
+    if args.child == "compaction":
+        return compaction_child(args)
+
+    if not os.path.isdir("/proc/self"):
+        sys.exit("The soak harness reads memory use from /proc and needs Linux")
+
+    sys.path.insert(0, BENCHMARKS_DIR)
+    from stubs import start_stub_server
+
+    sizes = sorted(int(size) for size in args.vehicles.split(","))
+    backlogs = sorted(float(hours) for hours in args.hours.split(","))
+
+    objects = tempfile.mkdtemp(prefix="soak-s3-")
+    feeds = {}
+    server = start_stub_server(
+        lambda number: feeds["current"].serve("positions"),
+        objects,
+        trip_updates=lambda number: feeds["current"].serve("trip_updates"),
+    )
+    server.feeds = feeds
+    server.store.create_bucket(BUCKET)
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}"
+
+    print(
+        f"cadence {args.cadence}s  limits: ETL {args.etl_memory} MB / {args.etl_timeout:g} s, "
+        f"compaction {args.compaction_memory} MB / {args.compaction_storage} MB /tmp / "
+        f"{args.compaction_timeout:g} s, partition time {args.partition_time}"
+    )
+    header()
+
+    results = []
+    try:
+        for vehicles in sizes:
+            for hours in backlogs:
+                result = run_scenario(args, server, endpoint, vehicles, hours)
+                results.append(result)
+                print_result(result)
+                if result.get("error"):
+                    print(result["error"], file=sys.stderr)
+                if result["etl_breach"] or result.get("compaction_breach"):
+                    # a longer backlog of the same fleet only breaks harder
+                    break
+    finally:
+        server.shutdown()
+        shutil.rmtree(objects, ignore_errors=True)
+
+    print()
+    for process in ("etl", "compaction"):
+        first = next((result for result in results if result.get(f"{process}_breach")), None)
+        if first is None:
+            print(f"{process}: within limits for every fleet size and backlog")
+        else:
+            print(
+                f"{process}: {first[f'{process}_breach']} limit first broken by "
+                f"{first['vehicles']} vehicles with {first['hours']:g} h of raw files"
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Compare compacted file size and trajectory queries per compaction sort key.
+
+Synthetic polls are written as raw files and compacted once per sort key:
+in the order they were polled, by vehicle (``vehicle_id, timestamp``, the
+default) and by trip (``route_id, trip_id, timestamp``). One vehicle's and
+one trip's rows are then counted with DuckDB on each output. Reported per
+sort key are the compaction time, the size of the output, how many row
+groups each query can't skip according to their min/max statistics, and the
+best query times:
+
+    python benchmarks/sort_keys.py --vehicles 5000 --polls 240
+
+``--run-rows`` lowers the rows the compaction sorts in memory, so the sort
+spills runs to disk and merges them as it does for a large day. Needs
+``pip install duckdb``.
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import duckdb
+import pyarrow.parquet as pq
+from google.transit import gtfs_realtime_pb2
+from pyarrow import fs
+
+from suite import START, best_of, load_compaction
+
+from decoder import decode_vehicle_positions
+from enrich import enrich_positions
+from geoparquet import write_geoparquet
+from synthetic import FleetSimulator
+
+SORT_KEYS = (
+    ("polled", ()),
+    ("vehicle", ("vehicle_id", "timestamp")),
+    ("trip", ("route_id", "trip_id", "timestamp")),
+)
+
+QUERY = "SELECT count(*), avg(speed) FROM read_parquet(?) WHERE {column} = ?"
+
+
+def write_raw(directory, vehicles, polls, timezone, precision):
+    simulator = FleetSimulator(vehicles, seed=0, start=START)
+    uris = []
+    for i in range(polls):
+        simulator.step(30)
+        message = gtfs_realtime_pb2.FeedMessage()
+        message.ParseFromString(simulator.feed())
+        pa_table = enrich_positions(
+            decode_vehicle_positions(message, timezone), precision=precision
+        )
+        uris.append(os.path.join(directory, f"{i:05d}.parquet"))
+        with open(uris[-1], "wb") as f:
+            f.write(write_geoparquet(pa_table))
+    return uris
+
+
+def matching_row_groups(paths, column, value):
+    """
+    (row groups whose ``column`` statistics may hold ``value``, all row
+    groups)
+    """
+
+    matching = 0
+    total = 0
+    for path in paths:
+        metadata = pq.ParquetFile(path).metadata
+        index = metadata.schema.names.index(column)
+        for r in range(metadata.num_row_groups):
+            statistics = metadata.row_group(r).column(index).statistics
+            total += 1
+            matching += statistics is None or statistics.min <= value <= statistics.max
+    return matching, total
+
+
+def compare(vehicles, polls, timezone, precision, repeat, run_rows, compaction):
+    directory = tempfile.mkdtemp(prefix="sort-keys-")
+    results = []
+    try:
+        uris = write_raw(directory, vehicles, polls, timezone, precision)
+        # a vehicle and a trip from the middle of the fleet
+        first = pq.read_table(uris[0], columns=["vehicle_id", "trip_id"])
+        middle = first.num_rows // 2
+        lookups = {
+            "vehicle_id": first["vehicle_id"][middle].as_py(),
+            "trip_id": first["trip_id"][middle].as_py(),
+        }
+
+        if run_rows:
+            compaction.SORT_RUN_ROWS = run_rows
+        for name, sort_keys in SORT_KEYS:
+            output_dir = os.path.join(directory, f"compacted-{name}")
+            os.makedirs(output_dir)
+
+            start = time.perf_counter()
+            compaction.compact_dataset(
+                uris, fs.LocalFileSystem(), output_dir, sort_keys=sort_keys
+            )
+            compact_seconds = time.perf_counter() - start
+
+            paths = sorted(glob.glob(os.path.join(output_dir, "*.parquet")))
+            rows = sum(pq.ParquetFile(path).metadata.num_rows for path in paths)
+            size = sum(os.path.getsize(path) for path in paths)
+            result = {
+                "vehicles": vehicles,
+                "sort_key": name,
+                "rows": rows,
+                "compact_seconds": compact_seconds,
+                "bytes": size,
+                "bytes_per_row": size / rows,
+            }
+
+            connection = duckdb.connect()
+            for column, value in lookups.items():
+                matching, total = matching_row_groups(paths, column, value)
+                query = QUERY.format(column=column)
+                query_seconds, _ = best_of(
+                    lambda: connection.execute(query, [paths, value]).fetchone(), repeat
+                )
+                result[f"{column}_row_groups"] = f"{matching}/{total}"
+                result[f"{column}_ms"] = query_seconds * 1e3
+            connection.close()
+            results.append(result)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def print_results(results):
+    print(
+        f"{'vehicles':>9} {'sort key':>8} {'rows':>9} {'compact s':>10} {'MB':>7} "
+        f"{'B/row':>6} {'vehicle rgs':>12} {'vehicle ms':>11} {'trip rgs':>9} {'trip ms':>8}"
+    )
+    for result in results:
+        print(
+            f"{result['vehicles']:>9} {result['sort_key']:>8} {result['rows']:>9} "
+            f"{result['compact_seconds']:>10.2f} {result['bytes'] / 1e6:>7.2f} "
+            f"{result['bytes_per_row']:>6.1f} {result['vehicle_id_row_groups']:>12} "
+            f"{result['vehicle_id_ms']:>11.1f} {result['trip_id_row_groups']:>9} "
+            f"{result['trip_id_ms']:>8.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--vehicles", default="5000")
+    parser.add_argument("--polls", type=int, default=240)
+    parser.add_argument("--timezone", default="America/Toronto")
+    parser.add_argument("--precision", type=int, default=7)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--run-rows", type=int, help="rows sorted in memory at once")
+    args = parser.parse_args()
+
+    compaction = load_compaction()
+
+    results = []
+    for vehicles in (int(value) for value in args.vehicles.split(",")):
+        results += compare(
+            vehicles,
+            args.polls,
+            args.timezone,
+            args.precision,
+            args.repeat,
+            args.run_rows,
+            compaction,
+        )
+    print_results(results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
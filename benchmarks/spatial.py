@@ -0,0 +1,184 @@
+"""
+Compare DuckDB bounding box queries on clustered and unclustered output.
+
+Synthetic polls are written as raw files and compacted once per ordering:
+as polled, and clustered along a Hilbert curve and in geohash order. A
+bounding box filter on the ``bbox`` covering columns is then run with DuckDB
+against each compacted output. Reported per ordering are the compaction
+time, the bytes per row, how many row groups the box overlaps according to
+their bbox statistics (the rest can be skipped) and the best query time:
+
+    python benchmarks/spatial.py --vehicles 10000 --polls 60 --box 0.02
+
+``--box`` is the side of the square query box in degrees, centred on the
+fleet; the synthetic fleet spans 0.3 degrees. Needs ``pip install duckdb``.
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import duckdb
+import pyarrow.parquet as pq
+from google.transit import gtfs_realtime_pb2
+from pyarrow import fs
+
+from suite import START, best_of, load_compaction
+
+from decoder import decode_vehicle_positions
+from enrich import enrich_positions
+from geoparquet import write_geoparquet
+from synthetic import FleetSimulator
+
+ORDERINGS = (None, "hilbert", "geohash")
+
+CENTER = (43.70, -79.40)
+
+QUERY = """
+    SELECT count(*)
+    FROM read_parquet(?)
+    WHERE bbox.xmax >= ? AND bbox.xmin <= ? AND bbox.ymax >= ? AND bbox.ymin <= ?
+"""
+
+
+def write_raw(directory, vehicles, polls, timezone, precision):
+    simulator = FleetSimulator(vehicles, seed=0, start=START)
+    uris = []
+    for i in range(polls):
+        simulator.step(30)
+        message = gtfs_realtime_pb2.FeedMessage()
+        message.ParseFromString(simulator.feed())
+        pa_table = enrich_positions(
+            decode_vehicle_positions(message, timezone), precision=precision
+        )
+        uris.append(os.path.join(directory, f"{i:05d}.parquet"))
+        with open(uris[-1], "wb") as f:
+            f.write(write_geoparquet(pa_table))
+    return uris
+
+
+def overlapping_row_groups(paths, box):
+    """
+    (row groups whose bbox statistics overlap ``box``, all row groups)
+    """
+
+    xmin, xmax, ymin, ymax = box
+    overlapping = 0
+    total = 0
+    for path in paths:
+        metadata = pq.ParquetFile(path).metadata
+        columns = {
+            metadata.schema.column(i).path: i for i in range(metadata.num_columns)
+        }
+        for r in range(metadata.num_row_groups):
+            row_group = metadata.row_group(r)
+
+            def stat(name, attribute):
+                return getattr(row_group.column(columns[name]).statistics, attribute)
+
+            total += 1
+            overlapping += (
+                stat("bbox.xmax", "max") >= xmin
+                and stat("bbox.xmin", "min") <= xmax
+                and stat("bbox.ymax", "max") >= ymin
+                and stat("bbox.ymin", "min") <= ymax
+            )
+    return overlapping, total
+
+
+def compare(vehicles, polls, box_size, timezone, precision, repeat, compaction):
+    box = (
+        CENTER[1] - box_size / 2,
+        CENTER[1] + box_size / 2,
+        CENTER[0] - box_size / 2,
+        CENTER[0] + box_size / 2,
+    )
+
+    directory = tempfile.mkdtemp(prefix="spatial-")
+    results = []
+    try:
+        uris = write_raw(directory, vehicles, polls, timezone, precision)
+        for ordering in ORDERINGS:
+            output_dir = os.path.join(directory, f"compacted-{ordering}")
+            os.makedirs(output_dir)
+
+            start = time.perf_counter()
+            # unclustered output as polled, not sorted by vehicle
+            compaction.compact_dataset(
+                uris, fs.LocalFileSystem(), output_dir, spatial_sort=ordering, sort_keys=()
+            )
+            compact_seconds = time.perf_counter() - start
+
+            paths = sorted(glob.glob(os.path.join(output_dir, "*.parquet")))
+            rows = sum(pq.ParquetFile(path).metadata.num_rows for path in paths)
+            overlapping, total = overlapping_row_groups(paths, box)
+
+            connection = duckdb.connect()
+            query_seconds, (matched,) = best_of(
+                lambda: connection.execute(QUERY, [paths, *box]).fetchone(), repeat
+            )
+            connection.close()
+
+            results.append(
+                {
+                    "vehicles": vehicles,
+                    "ordering": ordering or "none",
+                    "rows": rows,
+                    "matched": matched,
+                    "compact_seconds": compact_seconds,
+                    "bytes_per_row": sum(os.path.getsize(path) for path in paths) / rows,
+                    "row_groups": f"{overlapping}/{total}",
+                    "query_ms": query_seconds * 1e3,
+                }
+            )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def print_results(results):
+    print(
+        f"{'vehicles':>9} {'ordering':>8} {'rows':>9} {'matched':>8} {'compact s':>10} "
+        f"{'B/row':>6} {'row groups':>11} {'query ms':>9}"
+    )
+    for result in results:
+        print(
+            f"{result['vehicles']:>9} {result['ordering']:>8} {result['rows']:>9} "
+            f"{result['matched']:>8} {result['compact_seconds']:>10.2f} "
+            f"{result['bytes_per_row']:>6.1f} {result['row_groups']:>11} "
+            f"{result['query_ms']:>9.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--vehicles", default="10000")
+    parser.add_argument("--polls", type=int, default=60)
+    parser.add_argument("--box", type=float, default=0.02, help="query box side in degrees")
+    parser.add_argument("--timezone", default="America/Toronto")
+    parser.add_argument("--precision", type=int, default=7)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    compaction = load_compaction()
+
+    results = []
+    for vehicles in (int(value) for value in args.vehicles.split(",")):
+        results += compare(
+            vehicles,
+            args.polls,
+            args.box,
+            args.timezone,
+            args.precision,
+            args.repeat,
+            compaction,
+        )
+    print_results(results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
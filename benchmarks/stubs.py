@@ -0,0 +1,428 @@
+"""
+Local stand-ins for a GTFS realtime feed and the S3 API.
+
+``start_stub_server`` serves feed bodies at ``/feed`` and ``/trip_updates``
+and a filesystem backed subset of the S3 REST API (path style addressing)
+at every other path: bucket creation, PutObject, GetObject with ranges,
+HeadObject, DeleteObject, ListObjectsV2 and multipart uploads. That covers
+what boto3 and pyarrow's ``S3FileSystem`` do in the ETL and compaction
+handlers, so both run unchanged with ``AWS_ENDPOINT_URL_S3`` pointing at
+the stub. S3 requests are counted per operation in ``server.requests`` and
+can be delayed by a fixed latency, as a stand-in for the round trips to S3.
+"""
+
+import datetime as dt
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+S3_NAMESPACE = "http://s3.amazonaws.com/doc/2006-03-01/"
+LIST_MAX_KEYS = 1000
+
+# bookkeeping directories next to the buckets
+TMP_DIR = ".tmp"
+UPLOADS_DIR = ".uploads"
+
+
+class ObjectStore:
+    """Buckets and objects as directories and files below ``root``."""
+
+    def __init__(self, root):
+        self.root = root
+        self.etags = {}
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(root, TMP_DIR), exist_ok=True)
+        os.makedirs(os.path.join(root, UPLOADS_DIR), exist_ok=True)
+
+    def bucket_path(self, bucket):
+        return os.path.join(self.root, bucket)
+
+    def path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split("/"))
+
+    def create_bucket(self, bucket):
+        os.makedirs(self.bucket_path(bucket), exist_ok=True)
+
+    def has_bucket(self, bucket):
+        return not bucket.startswith(".") and os.path.isdir(self.bucket_path(bucket))
+
+    def _commit(self, bucket, key, tmp_path, etag):
+        path = self.path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.etags[path] = etag
+        return etag
+
+    def put(self, bucket, key, data):
+        tmp_path = os.path.join(self.root, TMP_DIR, uuid.uuid4().hex)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        return self._commit(bucket, key, tmp_path, hashlib.md5(data).hexdigest())
+
+    def etag(self, bucket, key):
+        path = self.path(bucket, key)
+        with self.lock:
+            etag = self.etags.get(path)
+        if etag is None:
+            with open(path, "rb") as f:
+                etag = hashlib.md5(f.read()).hexdigest()
+        return etag
+
+    def stat(self, bucket, key):
+        path = self.path(bucket, key)
+        if not os.path.isfile(path):
+            return None
+        return os.stat(path)
+
+    def read(self, bucket, key, start=0, end=None):
+        with open(self.path(bucket, key), "rb") as f:
+            f.seek(start)
+            return f.read() if end is None else f.read(end - start + 1)
+
+    def delete(self, bucket, key):
+        try:
+            os.remove(self.path(bucket, key))
+        except FileNotFoundError:
+            pass
+
+    def keys(self, bucket, prefix=""):
+        """
+        Sorted keys of ``bucket`` starting with ``prefix``
+        """
+
+        root = self.bucket_path(bucket)
+        # only walk the directory the prefix points into
+        directory = os.path.join(root, *prefix.split("/")[:-1])
+        keys = []
+        for dirpath, _, filenames in os.walk(directory):
+            relative = os.path.relpath(dirpath, root).replace(os.sep, "/")
+            for filename in filenames:
+                key = filename if relative == "." else f"{relative}/{filename}"
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+    def create_upload(self):
+        upload_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.root, UPLOADS_DIR, upload_id))
+        return upload_id
+
+    def put_part(self, upload_id, part_number, data):
+        path = os.path.join(self.root, UPLOADS_DIR, upload_id, f"{int(part_number):05d}")
+        with open(path, "wb") as f:
+            f.write(data)
+        return hashlib.md5(data).hexdigest()
+
+    def complete_upload(self, bucket, key, upload_id, part_numbers):
+        directory = os.path.join(self.root, UPLOADS_DIR, upload_id)
+        tmp_path = os.path.join(self.root, TMP_DIR, upload_id)
+        digests = b""
+        with open(tmp_path, "wb") as out:
+            for part_number in part_numbers:
+                with open(os.path.join(directory, f"{int(part_number):05d}"), "rb") as f:
+                    data = f.read()
+                digests += hashlib.md5(data).digest()
+                out.write(data)
+        shutil.rmtree(directory)
+        etag = f"{hashlib.md5(digests).hexdigest()}-{len(part_numbers)}"
+        return self._commit(bucket, key, tmp_path, etag)
+
+    def abort_upload(self, upload_id):
+        shutil.rmtree(os.path.join(self.root, UPLOADS_DIR, upload_id), ignore_errors=True)
+
+
+def _http_date(timestamp):
+    return dt.datetime.fromtimestamp(timestamp, dt.timezone.utc).strftime(
+        "%a, %d %b %Y %H:%M:%S GMT"
+    )
+
+
+def _iso_date(timestamp):
+    return dt.datetime.fromtimestamp(timestamp, dt.timezone.utc).strftime(
+        "%Y-%m-%dT%H:%M:%S.000Z"
+    )
+
+
+def _xml(root, body):
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?>'
+        f'<{root} xmlns="{S3_NAMESPACE}">{body}</{root}>'
+    ).encode()
+
+
+def _read_chunked(rfile):
+    """
+    Body of a request sent with ``Transfer-Encoding: chunked``
+    """
+
+    data = bytearray()
+    while True:
+        size = int(rfile.readline().split(b";")[0].strip(), 16)
+        if not size:
+            # trailers end with an empty line
+            while rfile.readline().strip():
+                pass
+            return bytes(data)
+        data += rfile.read(size)
+        rfile.readline()
+
+
+def _decode_aws_chunked(body):
+    """
+    Payload of an ``aws-chunked`` body: hex size lines, each followed by that
+    many bytes, then optional checksum trailers
+    """
+
+    data = bytearray()
+    position = 0
+    while True:
+        line_end = body.index(b"\r\n", position)
+        size = int(body[position:line_end].split(b";")[0], 16)
+        position = line_end + 2
+        if not size:
+            return bytes(data)
+        data += body[position : position + size]
+        position += size + 2
+
+
+def start_stub_server(feeds, root, trip_updates=None, latency=0.0):
+    """
+    Serve ``feeds`` at /feed, ``trip_updates`` at /trip_updates and an S3
+    stand-in storing objects below ``root``
+
+    Bodies are a list returned in turn, or a callable taking the zero based
+    request number and returning the body. Every S3 request waits
+    ``latency`` seconds before it is answered.
+    """
+
+    store = ObjectStore(root)
+    bodies = {"/feed": feeds, "/trip_updates": trip_updates}
+    requests_served = {"/feed": 0, "/trip_updates": 0}
+    feed_lock = threading.Lock()
+    # S3 requests by operation, e.g. "LIST" or "GET range"
+    s3_requests = Counter()
+
+    class Handler(BaseHTTPRequestHandler):
+        # HTTP/1.1 answers botocore's "Expect: 100-continue" instead of stalling
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, status, body=b"", content_type="application/octet-stream", headers=None):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(body)
+
+        def _error(self, status, code, message=""):
+            self._reply(
+                status,
+                f"<Error><Code>{code}</Code><Message>{escape(message)}</Message></Error>".encode(),
+                "application/xml",
+            )
+
+        def _parse(self):
+            url = urlsplit(self.path)
+            bucket, _, key = url.path.lstrip("/").partition("/")
+            query = {name: values[0] for name, values in parse_qs(url.query, keep_blank_values=True).items()}
+            operation = self.command if key else "LIST" if self.command == "GET" else self.command
+            if "Range" in self.headers:
+                operation += " range"
+            with feed_lock:
+                s3_requests[operation] += 1
+            if latency:
+                time.sleep(latency)
+            return unquote(bucket), unquote(key), query
+
+        def _body(self):
+            if "chunked" in self.headers.get("Transfer-Encoding", ""):
+                body = _read_chunked(self.rfile)
+            else:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if "aws-chunked" in self.headers.get("Content-Encoding", "") or (
+                self.headers.get("x-amz-decoded-content-length") is not None
+            ):
+                body = _decode_aws_chunked(body)
+            return body
+
+        def _feed(self, path):
+            with feed_lock:
+                number = requests_served[path]
+                requests_served[path] += 1
+            served = bodies[path]
+            body = served(number) if callable(served) else served[number % len(served)]
+            self._reply(200, body)
+
+        def _list(self, bucket, query):
+            prefix = query.get("prefix", "")
+            delimiter = query.get("delimiter", "")
+            max_keys = min(int(query.get("max-keys", LIST_MAX_KEYS)), LIST_MAX_KEYS)
+            after = query.get("continuation-token") or query.get("start-after") or ""
+
+            contents, prefixes = [], []
+            truncated = False
+            for key in store.keys(bucket, prefix):
+                if key <= after:
+                    continue
+                if delimiter and delimiter in key[len(prefix) :]:
+                    common = key[: key.index(delimiter, len(prefix)) + len(delimiter)]
+                    if common in prefixes or common <= after:
+                        continue
+                    entry = common
+                    prefixes.append(common)
+                else:
+                    entry = key
+                    contents.append(key)
+                if len(contents) + len(prefixes) >= max_keys:
+                    truncated = True
+                    last = entry
+                    break
+
+            body = f"<Name>{escape(bucket)}</Name><Prefix>{escape(prefix)}</Prefix>"
+            body += f"<KeyCount>{len(contents) + len(prefixes)}</KeyCount><MaxKeys>{max_keys}</MaxKeys>"
+            body += f"<IsTruncated>{'true' if truncated else 'false'}</IsTruncated>"
+            if truncated:
+                body += f"<NextContinuationToken>{escape(last)}</NextContinuationToken>"
+            for key in contents:
+                stat = store.stat(bucket, key)
+                if stat is None:
+                    continue
+                body += (
+                    f"<Contents><Key>{escape(key)}</Key>"
+                    f"<LastModified>{_iso_date(stat.st_mtime)}</LastModified>"
+                    f'<ETag>"{store.etag(bucket, key)}"</ETag><Size>{stat.st_size}</Size>'
+                    f"<StorageClass>STANDARD</StorageClass></Contents>"
+                )
+            for common in prefixes:
+                body += f"<CommonPrefixes><Prefix>{escape(common)}</Prefix></CommonPrefixes>"
+            self._reply(200, _xml("ListBucketResult", body), "application/xml")
+
+        def _object(self, bucket, key):
+            stat = store.stat(bucket, key)
+            if stat is None:
+                if self.command == "HEAD":
+                    return self._reply(404)
+                return self._error(404, "NoSuchKey", key)
+
+            headers = {
+                "ETag": f'"{store.etag(bucket, key)}"',
+                "Last-Modified": _http_date(stat.st_mtime),
+                "Accept-Ranges": "bytes",
+            }
+            size = stat.st_size
+            ranged = self.headers.get("Range", "")
+            if self.command == "HEAD":
+                # the object size without sending the object
+                self.send_response(200)
+                self.send_header("Content-Length", str(size))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                return
+            if not ranged.startswith("bytes="):
+                return self._reply(200, store.read(bucket, key), headers=headers)
+
+            first, _, last = ranged[len("bytes=") :].partition("-")
+            if not first:
+                start, end = max(size - int(last), 0), size - 1
+            else:
+                start, end = int(first), min(int(last) if last else size - 1, size - 1)
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            self._reply(206, store.read(bucket, key, start, end), headers=headers)
+
+        def do_GET(self):
+            path = urlsplit(self.path).path
+            if bodies.get(path) is not None:
+                return self._feed(path)
+            bucket, key, query = self._parse()
+            if not store.has_bucket(bucket):
+                return self._error(404, "NoSuchBucket", bucket)
+            if not key:
+                return self._list(bucket, query)
+            self._object(bucket, key)
+
+        def do_HEAD(self):
+            bucket, key, _ = self._parse()
+            if not store.has_bucket(bucket):
+                return self._reply(404)
+            if not key:
+                return self._reply(200)
+            self._object(bucket, key)
+
+        def do_PUT(self):
+            bucket, key, query = self._parse()
+            body = self._body()
+            if not key:
+                store.create_bucket(bucket)
+                return self._reply(200)
+            if not store.has_bucket(bucket):
+                return self._error(404, "NoSuchBucket", bucket)
+            if "uploadId" in query:
+                etag = store.put_part(query["uploadId"], query["partNumber"], body)
+            else:
+                etag = store.put(bucket, key, body)
+            self._reply(200, headers={"ETag": f'"{etag}"'})
+
+        def do_POST(self):
+            bucket, key, query = self._parse()
+            body = self._body()
+            if not store.has_bucket(bucket):
+                return self._error(404, "NoSuchBucket", bucket)
+            if "uploads" in query:
+                upload_id = store.create_upload()
+                return self._reply(
+                    200,
+                    _xml(
+                        "InitiateMultipartUploadResult",
+                        f"<Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key>"
+                        f"<UploadId>{upload_id}</UploadId>",
+                    ),
+                    "application/xml",
+                )
+            if "uploadId" in query:
+                parts = ElementTree.fromstring(body)
+                part_numbers = sorted(
+                    int(element.text)
+                    for element in parts.iter()
+                    if element.tag.rsplit("}", 1)[-1] == "PartNumber"
+                )
+                etag = store.complete_upload(bucket, key, query["uploadId"], part_numbers)
+                return self._reply(
+                    200,
+                    _xml(
+                        "CompleteMultipartUploadResult",
+                        f"<Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key>"
+                        f'<ETag>"{etag}"</ETag>',
+                    ),
+                    "application/xml",
+                )
+            self._error(400, "NotImplemented", self.path)
+
+        def do_DELETE(self):
+            bucket, key, query = self._parse()
+            if "uploadId" in query:
+                store.abort_upload(query["uploadId"])
+            elif key:
+                store.delete(bucket, key)
+            self._reply(204)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    server.store = store
+    server.requests = s3_requests
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
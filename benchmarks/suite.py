@@ -0,0 +1,281 @@
+"""
+Benchmark every pipeline stage on synthetic feeds of several fleet sizes.
+
+Stages are decode (protobuf parse and columnar decode), enrich (geohash and
+WKB geometry), write (GeoParquet serialization) and compact (merging
+``--raw-files`` raw GeoParquet files with the compaction function's
+``compact_dataset``). Each stage runs in a fresh process so its peak RSS is
+its own. Results can be stored as a named baseline and later runs compared
+against it:
+
+    python benchmarks/suite.py --vehicles 100,1000,10000 --save-baseline local
+    python benchmarks/suite.py --vehicles 100,1000,10000 --compare local
+"""
+
+import argparse
+import glob
+import importlib.util
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+RUNTIME_DIR = os.path.join(REPO_DIR, "etl", "runtime")
+COMPACTION_HANDLER = os.path.join(REPO_DIR, "compaction", "runtime", "handler.py")
+BASELINES_DIR = os.path.join(BENCHMARKS_DIR, "baselines")
+
+sys.path.insert(0, RUNTIME_DIR)
+
+STAGES = ("decode", "enrich", "write", "compact")
+
+# fixed so raw files land in the same partition on every run
+START = 1_700_000_000
+
+
+def peak_rss_bytes():
+    """
+    High-water mark of this process' resident set size
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def load_compaction():
+    """
+    Import the compaction handler without clashing with the ETL ``handler``
+    """
+
+    # the handler builds its S3 clients at import time
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+    spec = importlib.util.spec_from_file_location("compaction_handler", COMPACTION_HANDLER)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def prepare(directory, vehicles, raw_files, timezone, precision, seed=0):
+    """
+    Write ``raw_files`` successive polls of a synthetic fleet as feeds
+    (``feeds/*.pb``) and as raw GeoParquet (``raw/*.parquet``)
+    """
+
+    from google.transit import gtfs_realtime_pb2
+
+    from decoder import decode_vehicle_positions
+    from enrich import enrich_positions
+    from geoparquet import write_geoparquet
+    from synthetic import FleetSimulator
+
+    os.makedirs(os.path.join(directory, "feeds"))
+    os.makedirs(os.path.join(directory, "raw"))
+
+    simulator = FleetSimulator(vehicles, seed=seed, start=START)
+    for poll in range(raw_files):
+        if poll:
+            simulator.step(15)
+        content = simulator.feed()
+        with open(os.path.join(directory, "feeds", f"{poll:05d}.pb"), "wb") as f:
+            f.write(content)
+
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(content)
+        table = enrich_positions(decode_vehicle_positions(feed, timezone), precision)
+        with open(os.path.join(directory, "raw", f"{poll:05d}.parquet"), "wb") as f:
+            f.write(write_geoparquet(table))
+
+
+def run_stage(stage, directory, repeat, timezone, precision):
+    """
+    Time one stage on the prepared ``directory``. Runs in a fresh process.
+    """
+
+    from google.transit import gtfs_realtime_pb2
+
+    from decoder import decode_vehicle_positions
+    from enrich import enrich_positions
+    from geoparquet import write_geoparquet
+
+    import_rss = peak_rss_bytes()
+
+    with open(sorted(glob.glob(os.path.join(directory, "feeds", "*.pb")))[0], "rb") as f:
+        content = f.read()
+
+    def decode():
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(content)
+        return decode_vehicle_positions(feed, timezone)
+
+    bytes_written = 0
+    if stage == "decode":
+        seconds, table = best_of(decode, repeat)
+        rows = table.num_rows
+    elif stage == "enrich":
+        decoded = decode()
+        seconds, table = best_of(lambda: enrich_positions(decoded, precision), repeat)
+        rows = table.num_rows
+    elif stage == "write":
+        enriched = enrich_positions(decode(), precision)
+        seconds, data = best_of(lambda: write_geoparquet(enriched), repeat)
+        rows = enriched.num_rows
+        bytes_written = len(data)
+    elif stage == "compact":
+        import pyarrow.parquet as pq
+        from pyarrow import fs
+
+        compaction = load_compaction()
+        uris = sorted(glob.glob(os.path.join(directory, "raw", "*.parquet")))
+        output_dir = os.path.join(directory, "compacted")
+
+        def compact():
+            shutil.rmtree(output_dir, ignore_errors=True)
+            os.makedirs(output_dir)
+            compaction.compact_dataset(uris, fs.LocalFileSystem(), output_dir)
+
+        seconds, _ = best_of(compact, repeat)
+        outputs = glob.glob(os.path.join(output_dir, "*.parquet"))
+        rows = sum(pq.read_metadata(path).num_rows for path in outputs)
+        bytes_written = sum(os.path.getsize(path) for path in outputs)
+    else:
+        raise ValueError(f"Unknown stage: {stage}")
+
+    return {
+        "seconds": seconds,
+        "rows": rows,
+        "rows_per_second": rows / seconds if seconds else None,
+        "bytes_written": bytes_written,
+        "import_rss": import_rss,
+        "peak_rss": peak_rss_bytes(),
+    }
+
+
+def run_suite(sizes, stages, raw_files, repeat, timezone, precision):
+    results = []
+    spawn = get_context("spawn")
+    for vehicles in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            prepare(directory, vehicles, raw_files, timezone, precision)
+            for stage in stages:
+                # a fresh interpreter per stage keeps peak RSS per stage
+                with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+                    result = pool.submit(
+                        run_stage, stage, directory, repeat, timezone, precision
+                    ).result()
+                result.update({"stage": stage, "vehicles": vehicles})
+                if stage == "compact":
+                    result["raw_files"] = raw_files
+                results.append(result)
+                print_result(result)
+    return results
+
+
+def _mb(value):
+    return f"{value / 1024 / 1024:9.1f}"
+
+
+def print_result(result, baseline=None):
+    line = (
+        f"{result['stage']:>8} {result['vehicles']:>8} "
+        f"{result['rows']:>10} {result['seconds'] * 1000:10.2f} "
+        f"{result['rows_per_second']:14,.0f} {_mb(result['peak_rss'])} "
+        + (_mb(result["bytes_written"]) if result["bytes_written"] else f"{'-':>9}")
+    )
+    if baseline is not None:
+        line += (
+            f" {result['rows_per_second'] / baseline['rows_per_second']:8.2f}x"
+            f" {result['peak_rss'] / baseline['peak_rss']:8.2f}x"
+        )
+    print(line)
+
+
+def header(compare=False):
+    line = (
+        f"{'stage':>8} {'vehicles':>8} {'rows':>10} {'ms':>10} "
+        f"{'rows/s':>14} {'rss MB':>9} {'out MB':>9}"
+    )
+    if compare:
+        line += f" {'rows/s':>9} {'rss':>9}"
+    print(line)
+
+
+def baseline_path(name):
+    return os.path.join(BASELINES_DIR, f"{name}.json")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--vehicles",
+        default="100,1000,10000,50000",
+        help="comma separated fleet sizes, up to 200000",
+    )
+    parser.add_argument("--stages", default=",".join(STAGES))
+    parser.add_argument("--raw-files", type=int, default=20, help="raw files to compact")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--timezone", default="America/Toronto")
+    parser.add_argument("--precision", type=int, default=7, help="geohash precision")
+    parser.add_argument("--save-baseline", metavar="NAME")
+    parser.add_argument("--compare", metavar="NAME", help="baseline to compare against")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.vehicles.split(",")]
+    stages = args.stages.split(",")
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error(f"unknown stage {stage}, expected one of {', '.join(STAGES)}")
+
+    header()
+    results = run_suite(
+        sizes, stages, args.raw_files, args.repeat, args.timezone, args.precision
+    )
+
+    if args.compare:
+        with open(baseline_path(args.compare)) as f:
+            baseline = {
+                (result["stage"], result["vehicles"]): result
+                for result in json.load(f)["results"]
+            }
+        print(f"\ncompared to baseline {args.compare}:")
+        header(compare=True)
+        for result in results:
+            print_result(result, baseline.get((result["stage"], result["vehicles"])))
+
+    if args.save_baseline:
+        os.makedirs(BASELINES_DIR, exist_ok=True)
+        with open(baseline_path(args.save_baseline), "w") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "processor_count": os.cpu_count(),
+                    "raw_files": args.raw_files,
+                    "repeat": args.repeat,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+            f.write("\n")
+        print(f"\nsaved baseline {baseline_path(args.save_baseline)}")
+
+
+if __name__ == "__main__":
+    main()
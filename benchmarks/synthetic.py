@@ -0,0 +1,258 @@
+"""
+Synthetic GTFS realtime vehicle position feeds.
+
+``FleetSimulator`` moves a fleet of vehicles around a city centre and
+serializes each poll as a ``gtfs_realtime_pb2.FeedMessage``. Positions drift
+between polls, some vehicles don't report every poll, and optional fields
+and sub-messages can be left out at configurable rates, like real agency
+feeds do.
+
+    python benchmarks/synthetic.py --vehicles 5000 --polls 3 --output /tmp/feeds
+"""
+
+import argparse
+import math
+import os
+import time
+
+import numpy as np
+from google.transit import gtfs_realtime_pb2
+
+METERS_PER_DEGREE = 111_320
+
+# share of vehicles that leave each field or sub-message out of a report
+DEFAULT_MISSING = {
+    "trip": 0.02,
+    "vehicle": 0.01,
+    "position": 0.005,
+    "bearing": 0.1,
+    "speed": 0.1,
+    "timestamp": 0.01,
+    "direction": 0.05,
+    "current_status": 0.05,
+    "stop": 0.05,
+    "occupancy": 0.5,
+}
+
+# share of entities that carry something other than a vehicle position
+DEFAULT_NON_VEHICLE = 0.01
+
+# share of vehicles that don't send a new report in a poll
+DEFAULT_STALE = 0.3
+
+NO_MISSING = {name: 0.0 for name in DEFAULT_MISSING}
+
+
+class FleetSimulator:
+    """A fleet of vehicles whose reports drift from poll to poll."""
+
+    def __init__(
+        self,
+        vehicles,
+        seed=0,
+        start=None,
+        center=(43.70, -79.40),
+        radius=0.15,
+        routes=200,
+        missing=None,
+        non_vehicle=DEFAULT_NON_VEHICLE,
+        stale=DEFAULT_STALE,
+    ):
+        self.rng = np.random.default_rng(seed)
+        self.vehicles = vehicles
+        self.missing = DEFAULT_MISSING if missing is None else missing
+        self.non_vehicle = non_vehicle
+        self.stale = stale
+
+        self.now = int(time.time()) if start is None else int(start)
+
+        rng = self.rng
+        self.latitude = center[0] + rng.uniform(-radius, radius, vehicles)
+        self.longitude = center[1] + rng.uniform(-radius, radius, vehicles)
+        self.bearing = rng.uniform(0, 360, vehicles)
+        self.speed = rng.uniform(0, 20, vehicles)
+        self.reported = self.now - rng.integers(0, 30, vehicles)
+
+        self.route = rng.integers(0, routes, vehicles)
+        self.vehicle_ids = [f"vehicle-{i}" for i in range(vehicles)]
+        self.trip_ids = [f"trip-{route}-{i}" for i, route in enumerate(self.route)]
+        self.route_ids = [f"route-{route}" for route in self.route]
+        self.stop = rng.integers(0, 5000, vehicles)
+
+    def step(self, seconds):
+        """
+        Advance the fleet by ``seconds``
+        """
+
+        rng = self.rng
+        self.now += int(seconds)
+
+        moving = rng.random(self.vehicles) >= self.stale
+        heading = np.radians(self.bearing)
+        distance = self.speed * seconds * moving
+
+        self.latitude += distance * np.cos(heading) / METERS_PER_DEGREE
+        self.longitude += (
+            distance
+            * np.sin(heading)
+            / (METERS_PER_DEGREE * np.cos(np.radians(self.latitude)))
+        )
+        self.bearing = (self.bearing + rng.normal(0, 15, self.vehicles) * moving) % 360
+        self.speed = np.clip(self.speed + rng.normal(0, 1, self.vehicles) * moving, 0, 25)
+        self.reported = np.where(moving, self.now - rng.integers(0, 5, self.vehicles), self.reported)
+        self.stop = (self.stop + (rng.random(self.vehicles) < 0.2) * moving) % 5000
+
+    def message(self):
+        """
+        The current fleet state as a FeedMessage
+        """
+
+        rng = self.rng
+        count = self.vehicles
+        draws = {name: rng.random(count) < rate for name, rate in self.missing.items()}
+        other = rng.random(count) < self.non_vehicle
+
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.header.gtfs_realtime_version = "2.0"
+        feed.header.incrementality = gtfs_realtime_pb2.FeedHeader.FULL_DATASET
+        feed.header.timestamp = self.now
+
+        latitude = self.latitude.tolist()
+        longitude = self.longitude.tolist()
+        bearing = self.bearing.tolist()
+        speed = self.speed.tolist()
+        reported = self.reported.tolist()
+        stop = self.stop.tolist()
+        status = rng.integers(0, 3, count).tolist()
+        occupancy = rng.integers(0, 5, count).tolist()
+
+        for i in range(count):
+            entity = feed.entity.add()
+            entity.id = str(i)
+
+            if other[i]:
+                entity.alert.header_text.translation.add(text="Detour")
+                continue
+
+            v = entity.vehicle
+            if not draws["trip"][i]:
+                v.trip.trip_id = self.trip_ids[i]
+                v.trip.route_id = self.route_ids[i]
+                if not draws["direction"][i]:
+                    v.trip.direction_id = i % 2
+            if not draws["vehicle"][i]:
+                v.vehicle.id = self.vehicle_ids[i]
+            if not draws["position"][i]:
+                v.position.latitude = latitude[i]
+                v.position.longitude = longitude[i]
+                if not draws["bearing"][i]:
+                    v.position.bearing = bearing[i]
+                if not draws["speed"][i]:
+                    v.position.speed = speed[i]
+            if not draws["timestamp"][i]:
+                v.timestamp = reported[i]
+            if not draws["current_status"][i]:
+                v.current_status = status[i]
+            if not draws["stop"][i]:
+                v.stop_id = f"stop-{stop[i]}"
+            if not draws["occupancy"][i]:
+                v.occupancy_status = occupancy[i]
+
+        return feed
+
+    def feed(self):
+        """
+        The current fleet state as serialized FeedMessage bytes
+        """
+
+        return self.message().SerializeToString()
+
+    def trip_updates(self, stops=20):
+        """
+        Predictions for the next ``stops`` stops of every trip as a FeedMessage
+
+        Delays drift with the fleet's speed; a few trips are cancelled and
+        carry no stop time updates.
+        """
+
+        rng = self.rng
+        count = self.vehicles
+        delays = (rng.normal(60, 120, count) - (self.speed - 10) * 10).astype(int).tolist()
+        cancelled = (rng.random(count) < self.missing.get("trip", 0.0)).tolist()
+        skipped = rng.random((count, stops)) < 0.01
+
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.header.gtfs_realtime_version = "2.0"
+        feed.header.incrementality = gtfs_realtime_pb2.FeedHeader.FULL_DATASET
+        feed.header.timestamp = self.now
+
+        for i in range(count):
+            entity = feed.entity.add()
+            entity.id = str(i)
+            update = entity.trip_update
+            update.trip.trip_id = self.trip_ids[i]
+            update.trip.route_id = self.route_ids[i]
+            update.trip.direction_id = i % 2
+            update.vehicle.id = self.vehicle_ids[i]
+            update.timestamp = self.now
+
+            if cancelled[i]:
+                update.trip.schedule_relationship = (
+                    gtfs_realtime_pb2.TripDescriptor.CANCELED
+                )
+                continue
+
+            delay = delays[i]
+            first_stop = i % 40
+            for stop in range(stops):
+                stop_time = update.stop_time_update.add()
+                stop_time.stop_sequence = first_stop + stop
+                stop_time.stop_id = f"stop-{(i * 7 + stop) % 5000}"
+                if skipped[i, stop]:
+                    stop_time.schedule_relationship = (
+                        gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.SKIPPED
+                    )
+                    continue
+                arrival = self.now + 90 * (stop + 1) + delay
+                stop_time.arrival.time = arrival
+                stop_time.arrival.delay = delay
+                stop_time.departure.time = arrival + 20
+                stop_time.departure.delay = delay
+
+        return feed
+
+
+def build_feed(vehicles, seed=0, timestamp=None):
+    """
+    One serialized feed where every vehicle reports every field
+    """
+
+    simulator = FleetSimulator(
+        vehicles, seed=seed, start=timestamp, missing=NO_MISSING, non_vehicle=0.0
+    )
+    return simulator.feed()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--vehicles", type=int, default=1000)
+    parser.add_argument("--polls", type=int, default=1)
+    parser.add_argument("--interval", type=float, default=15, help="seconds between polls")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", required=True, help="directory for the .pb files")
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    simulator = FleetSimulator(args.vehicles, seed=args.seed)
+    width = max(1, int(math.log10(max(args.polls, 1))) + 1)
+    for poll in range(args.polls):
+        if poll:
+            simulator.step(args.interval)
+        path = os.path.join(args.output, f"feed_{poll:0{width}d}.pb")
+        with open(path, "wb") as f:
+            f.write(simulator.feed())
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
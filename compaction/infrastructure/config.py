@@ -1,5 +1,7 @@
 """gtfs-realtime-etl compaction construct configuration."""
 
+from typing import Optional
+
 from pydantic import Field
 from pydantic_settings import BaseSettings
 
@@ -32,6 +34,108 @@ class CompactionSettings(BaseSettings):
         description="IANA time zone name. https://data.iana.org/time-zones/tzdb-2021a/zone1970.tab",
     )
 
+    spatial_sort: Optional[str] = Field(
+        None,
+        description=(
+            "Cluster compacted positions along a space filling curve, 'hilbert' or "
+            "'geohash', so the bbox statistics of each row group cover a small area"
+        ),
+    )
+
+    sort_keys: str = Field(
+        "vehicle_id,timestamp",
+        description=(
+            "Columns the rows of compacted files are sorted by, e.g. "
+            "'route_id,trip_id,timestamp', or 'none' to keep the order they "
+            "arrived in; positions clustered by spatial_sort aren't sorted"
+        ),
+    )
+
+    partition_keys: Optional[str] = Field(
+        None,
+        description=(
+            "Extra hive partition levels of positions below day=, in order, e.g. "
+            "'hour,route_bucket:16,geohash4'"
+        ),
+    )
+
+    partition_time: str = Field(
+        "event",
+        description=(
+            "Partition positions on the vehicle timestamps ('event') or on the "
+            "time of the poll ('poll')"
+        ),
+    )
+
+    max_lateness_seconds: int = Field(
+        24 * 60 * 60,
+        description=(
+            "The ETL's max_lateness_seconds, so compacted positions keep the "
+            "hour the ETL partitioned them at"
+        ),
+    )
+
+    max_future_seconds: int = Field(
+        15 * 60,
+        description=(
+            "The ETL's max_future_seconds, so compacted positions keep the "
+            "hour the ETL partitioned them at"
+        ),
+    )
+
+    metrics_namespace: str = Field(
+        "GtfsRealtimeEtl",
+        description=(
+            "CloudWatch namespace of the stage timings and counters emitted as "
+            "Embedded Metric Format; empty to emit none"
+        ),
+    )
+
+    profile_sample_rate: float = Field(
+        0.0,
+        description=(
+            "Fraction of invocations profiled with cProfile and tracemalloc, "
+            "dumps written below {stage}/_profiles/"
+        ),
+    )
+
+    profile_modes: str = Field(
+        "cpu,memory",
+        description="Profilers of a sampled invocation, 'cpu' and/or 'memory'",
+    )
+
+    workers: Optional[int] = Field(
+        None,
+        description=(
+            "Dates and datasets compacted concurrently by one invocation; by "
+            "default as many as the memory (1 GB each) and cores allow"
+        ),
+    )
+
+    fan_out: bool = Field(
+        False,
+        description=(
+            "Compact every date of a run in an invocation of its own, invoked "
+            "by the scheduled one, which gathers their results"
+        ),
+    )
+
+    incremental_compaction: bool = Field(
+        True,
+        description=(
+            "Merge only the raw objects added since the last compaction of a "
+            "day or month, tracked in a manifest below {stage}/_manifests/"
+        ),
+    )
+
+    intraday_hours: Optional[int] = Field(
+        None,
+        description=(
+            "Also compact the current day every this many hours; with "
+            "incremental compaction each run merges only the new objects"
+        ),
+    )
+
     class Config:
         """model config."""
 
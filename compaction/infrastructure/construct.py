@@ -7,8 +7,10 @@ https://github.com/aws-samples/s3-small-object-compaction
 import os
 
 from aws_cdk import (
+    ArnFormat,
     Duration,
     Size,
+    Stack,
     TimeZone,
     aws_lambda,
     aws_s3 as s3,
@@ -82,6 +84,24 @@ class CompactionConstruct(Construct):
                 ],
             )
         )
+        if compaction_settings.fan_out:
+            # the function invokes itself once per date; named by pattern, as
+            # its own ARN in its role's policy would be a circular dependency
+            compactionFunction.add_to_role_policy(
+                iam.PolicyStatement(
+                    effect=iam.Effect.ALLOW,
+                    actions=["lambda:InvokeFunction"],
+                    resources=[
+                        Stack.of(self).format_arn(
+                            service="lambda",
+                            resource="function",
+                            resource_name=f"{Stack.of(self).stack_name}-*",
+                            arn_format=ArnFormat.COLON_RESOURCE_NAME,
+                        )
+                    ],
+                )
+            )
+
         destination_s3_bucket.grant_read(compactionFunction)
         destination_s3_bucket.grant_write(compactionFunction)
 
@@ -93,6 +113,18 @@ class CompactionConstruct(Construct):
                     "previous_days": int(compaction_settings.previous_days),
                     "timezone": compaction_settings.timezone,
                     "stage": stage,
+                    "spatial_sort": compaction_settings.spatial_sort or "",
+                    "sort_keys": compaction_settings.sort_keys,
+                    "partition_keys": compaction_settings.partition_keys or "",
+                    "partition_time": compaction_settings.partition_time,
+                    "max_lateness_seconds": compaction_settings.max_lateness_seconds,
+                    "max_future_seconds": compaction_settings.max_future_seconds,
+                    "metrics_namespace": compaction_settings.metrics_namespace,
+                    "profile_sample_rate": compaction_settings.profile_sample_rate,
+                    "profile_modes": compaction_settings.profile_modes,
+                    "workers": compaction_settings.workers or 0,
+                    "fan_out": compaction_settings.fan_out,
+                    "incremental": compaction_settings.incremental_compaction,
                 }
             ),
             max_event_age=Duration.minutes(15),
@@ -111,6 +143,44 @@ class CompactionConstruct(Construct):
             target=target_daily,
         )
 
+        if compaction_settings.intraday_hours:
+            # the current day so far, merged into its compacted files
+            target_intraday = aws_scheduler_targets.LambdaInvoke(
+                compactionFunction,
+                input=aws_scheduler.ScheduleTargetInput.from_object(
+                    {
+                        "s3_bucket": compaction_settings.destination_bucket,
+                        "previous_days": 0,
+                        "compact_to_now": True,
+                        "timezone": compaction_settings.timezone,
+                        "stage": stage,
+                        "spatial_sort": compaction_settings.spatial_sort or "",
+                        "sort_keys": compaction_settings.sort_keys,
+                        "partition_keys": compaction_settings.partition_keys or "",
+                        "partition_time": compaction_settings.partition_time,
+                        "max_lateness_seconds": compaction_settings.max_lateness_seconds,
+                        "max_future_seconds": compaction_settings.max_future_seconds,
+                        "metrics_namespace": compaction_settings.metrics_namespace,
+                        "profile_sample_rate": compaction_settings.profile_sample_rate,
+                        "profile_modes": compaction_settings.profile_modes,
+                        "workers": compaction_settings.workers or 0,
+                        "fan_out": compaction_settings.fan_out,
+                        "incremental": compaction_settings.incremental_compaction,
+                    }
+                ),
+                max_event_age=Duration.minutes(15),
+                retry_attempts=0,
+            )
+
+            aws_scheduler.Schedule(
+                self,
+                "IntradaySchedule",
+                schedule=aws_scheduler.ScheduleExpression.rate(
+                    Duration.hours(compaction_settings.intraday_hours)
+                ),
+                target=target_intraday,
+            )
+
         target_monthly = aws_scheduler_targets.LambdaInvoke(
             compactionFunction,
             input=aws_scheduler.ScheduleTargetInput.from_object(
@@ -120,6 +190,18 @@ class CompactionConstruct(Construct):
                     "timezone": compaction_settings.timezone,
                     "compact_to_now": False,
                     "stage": stage,
+                    "spatial_sort": compaction_settings.spatial_sort or "",
+                    "sort_keys": compaction_settings.sort_keys,
+                    "partition_keys": compaction_settings.partition_keys or "",
+                    "partition_time": compaction_settings.partition_time,
+                    "max_lateness_seconds": compaction_settings.max_lateness_seconds,
+                    "max_future_seconds": compaction_settings.max_future_seconds,
+                    "metrics_namespace": compaction_settings.metrics_namespace,
+                    "profile_sample_rate": compaction_settings.profile_sample_rate,
+                    "profile_modes": compaction_settings.profile_modes,
+                    "workers": compaction_settings.workers or 0,
+                    "fan_out": compaction_settings.fan_out,
+                    "incremental": compaction_settings.incremental_compaction,
                 }
             ),
             max_event_age=Duration.minutes(15),
@@ -5,19 +5,56 @@ https://github.com/aws-samples/s3-small-object-compaction
 """
 
 import os
+import json
 import logging
+import tempfile
+import time
+import uuid
 import boto3
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from contextlib import nullcontext
 from datetime import timedelta, datetime
 from dateutil.relativedelta import relativedelta
 from zoneinfo import ZoneInfo
 
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
 
 from pyarrow import fs
 import pyarrow.dataset as ds
 
+from metrics import DEFAULT_NAMESPACE, Metrics, count, span, timed
+from partitioning import (
+    DEFAULT_EVENT_TIME_WINDOW,
+    event_time_partitioning,
+    event_time_window,
+    hour_groups,
+    late_marker_prefix,
+    object_event_hours,
+    parse_partitioning,
+    partition_arrays,
+    partition_path,
+)
+from profiling import parse_modes, profiled, sampled
+from schemas import (
+    positions_schema_version,
+    schema_metadata,
+    upgrade_positions,
+    upgraded_schema,
+)
+from spatial import SPATIAL_SORTS, cluster_positions
+
 
-s3 = boto3.client("s3", region_name=os.environ.get("AWS_DEFAULT_REGION"))
+# listings and part uploads of the concurrent compactions share the client,
+# which would otherwise keep only 10 connections
+s3 = boto3.client(
+    "s3",
+    region_name=os.environ.get("AWS_DEFAULT_REGION"),
+    config=Config(max_pool_connections=64),
+)
 s3fs = fs.S3FileSystem(
     access_key=os.environ.get("AWS_ACCESS_KEY_ID"),
     secret_key=os.environ.get("AWS_SECRET_ACCESS_KEY"),
@@ -28,123 +65,1342 @@ s3fs = fs.S3FileSystem(
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# raw partition trees written by the ETL, compacted from {name}_raw into {name}
+DATASETS = ("positions", "trip_updates")
+
+# footers of the raw files are fetched concurrently
+FOOTER_READ_THREADS = 32
+
+# uncompressed bytes of the files a scan reads ahead, in at least 4 (Arrow's
+# default) and at most FOOTER_READ_THREADS files
+READAHEAD_BYTES = 64 * 1024 * 1024
+
+# key ranges of a listing (the hours of a raw day, the days of a month)
+# listed at once
+LIST_THREADS = 24
+
+# https://duckdb.org/docs/stable/guides/performance/file_formats.html
+MAX_ROWS_PER_GROUP = 122880
+
+# rows buffered over all partitions of a compaction before the largest one
+# is written as a smaller row group
+BUFFERED_ROWS = 8 * MAX_ROWS_PER_GROUP
+
+# spatial clustering sorts this many row groups at a time, so memory stays
+# bounded while each row group still covers a fraction of the area
+CLUSTER_WINDOW_ROWS = 8 * MAX_ROWS_PER_GROUP
+
+# compacted rows are ordered by these columns unless positions are clustered
+# spatially, so the rows of a vehicle are contiguous and its trajectory is in
+# a few row groups
+DEFAULT_SORT_KEYS = ("vehicle_id", "timestamp")
+
+# rows sorted in memory at once; larger compactions spill sorted runs of
+# this many rows to /tmp and merge them
+SORT_RUN_ROWS = 8 * MAX_ROWS_PER_GROUP
+
+# rows of each spilled run read at a time while merging, and of the sorted
+# batches, each dictionary encoded afresh
+SORT_MERGE_ROWS = 16384
+
+# compacted files are uploaded in parts of this size while the next ones are
+# written; S3 takes 5 MiB or more for every part but the last
+PART_BYTES = 8 * 1024 * 1024
+
+# parts of one file uploading at once, which bounds the memory they hold
+PARTS_IN_FLIGHT = 4
+
+# threads uploading parts, shared by the concurrent compactions
+UPLOAD_THREADS = 16
+
+# memory budgeted per concurrent compaction when sizing the worker pool
+WORKER_MEMORY_MB = 1024
+
+# a fanned out invocation waits for its children up to the Lambda timeout
+FAN_OUT_READ_TIMEOUT_SECONDS = 15 * 60
+
+# layout of the manifests of what every compaction merged
+MANIFEST_VERSION = 1
+
+_lambda_client = None
+_upload_executor = None
+
+
+def list_key_range(bucket, prefix, start=None, stop=None, page_keys=None):
+    """
+    Objects below ``prefix`` after ``prefix + start`` up to and including
+    ``prefix + stop``, in pages of up to ``page_keys`` keys
+    """
 
-def list_objects_in_s3(bucket, prefix):
     contents = []
-    continuation_token = None
+    request = {"Bucket": bucket, "Prefix": prefix}
+    if start is not None:
+        request["StartAfter"] = prefix + start
+    if page_keys:
+        request["MaxKeys"] = page_keys
 
     while True:
-        if continuation_token:
-            response = s3.list_objects_v2(
-                Bucket=bucket, Prefix=prefix, ContinuationToken=continuation_token
-            )
-        else:
-            response = s3.list_objects_v2(Bucket=bucket, Prefix=prefix)
+        response = s3.list_objects_v2(**request)
 
-        contents.extend(response.get("Contents", []))
+        for object in response.get("Contents", []):
+            # pages are in key order, the rest belongs to the next range
+            if stop is not None and object["Key"] > prefix + stop:
+                return contents
+            contents.append(object)
 
         if "NextContinuationToken" not in response:
-            break
+            return contents
+
+        request["ContinuationToken"] = response["NextContinuationToken"]
+
+
+def list_objects_in_s3(bucket, prefix, bounds=()):
+    """
+    Objects below ``prefix`` in key order, or "None" when there are none
+
+    When the first page doesn't hold them all, the rest of the keys are
+    split at ``prefix + bound`` for each of the sorted ``bounds`` and the
+    ranges listed concurrently, so a day of several thousand polls takes
+    about two round trips. Parsing a page costs about as much as fetching
+    it, so the ranges ask for pages sized to the keys per range the first
+    page saw, to read few keys past their ends. Whatever the keys look
+    like, every one falls in exactly one range.
+    """
+
+    response = s3.list_objects_v2(Bucket=bucket, Prefix=prefix)
+    contents = response.get("Contents", [])
 
-        continuation_token = response["NextContinuationToken"]
+    if "NextContinuationToken" in response:
+        last = contents[-1]["Key"][len(prefix) :]
+        crossed = [bound for bound in bounds if bound <= last]
+        rest = bounds[len(crossed) :]
+        if rest:
+            page_keys = len(contents)
+            if crossed:
+                whole = sum(object["Key"] <= prefix + crossed[-1] for object in contents)
+                page_keys = min(page_keys, max(1, whole * 5 // (4 * len(crossed))))
+            ranges = list(zip([last, *rest], [*rest, None]))
+            with ThreadPoolExecutor(max_workers=min(LIST_THREADS, len(ranges))) as executor:
+                for objects in executor.map(
+                    lambda key_range: list_key_range(bucket, prefix, *key_range, page_keys),
+                    ranges,
+                ):
+                    contents.extend(objects)
+        else:
+            contents.extend(list_key_range(bucket, prefix, last))
 
     return contents if contents else "None"
 
 
-def upload_object_to_s3(bucket, key, file_path):
-    s3.upload_file(file_path, bucket, key)
+def listing_bounds(period, partitioning):
+    """
+    Bounds splitting the listing of a raw day by poll hour, of its
+    ``HHMMSS`` file names or of its leading ``hour=`` partition, or of a
+    month by day
+    """
+
+    if period == "months":
+        return [f"day={day:02d}" for day in range(2, 32)]
+    if not partitioning:
+        return [f"{hour:02d}" for hour in range(1, 24)]
+    if partitioning[0].kind == "hour":
+        return [f"hour={hour:02d}" for hour in range(1, 24)]
+    return []
+
 
+def upload_executor():
+    global _upload_executor
+    if _upload_executor is None:
+        _upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_THREADS)
+    return _upload_executor
 
-def merge_objects_from_s3(s3_bucket, date, period, city_name):
-    if period == "days":
-        objects = list_objects_in_s3(
-            s3_bucket,
-            f"{city_name}/positions_raw/year={date.strftime('%Y')}/month={date.strftime('%m')}/day={date.strftime('%d')}/",
+
+class MultipartUpload:
+    """
+    Binary file object writing one S3 object, uploaded part by part as it's
+    written
+
+    Nothing is visible at ``key`` until ``close`` completes the upload (or
+    puts an object smaller than a part whole), so readers never see a
+    partial file and a retried compaction replaces it in one step; ``abort``
+    discards the parts.
+    """
+
+    def __init__(self, client, bucket, key, part_bytes=PART_BYTES, executor=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_bytes = part_bytes
+        self.executor = executor or upload_executor()
+        self.buffer = bytearray()
+        self.position = 0
+        self.upload_id = None
+        self.parts = []
+        self.closed = False
+        # of the committed object
+        self.etag = None
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.part_bytes:
+            self._send(bytes(self.buffer[: self.part_bytes]))
+            del self.buffer[: self.part_bytes]
+        return len(data)
+
+    def _send(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key
+            )["UploadId"]
+        in_flight = [part for part in self.parts if not part.done()]
+        if len(in_flight) >= PARTS_IN_FLIGHT:
+            # the writer is ahead of the uploads, wait for the oldest part
+            with span("upload"):
+                in_flight[0].result()
+        self.parts.append(self.executor.submit(self._upload_part, len(self.parts) + 1, data))
+
+    def _upload_part(self, number, data):
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=data
         )
+        return {"PartNumber": number, "ETag": response["ETag"]}
 
-        if objects == "None":
-            print(
-                f"No objects found for {date.strftime('%Y')}/{date.strftime('%m')}/{date.strftime('%d')}"
-            )
+    def close(self):
+        """
+        Commit the object
+        """
+
+        if self.closed:
             return
-    elif period == "months":
-        objects = list_objects_in_s3(
-            s3_bucket,
-            f"{city_name}/positions/year={date.strftime('%Y')}/month={date.strftime('%m')}/",
-        )
+        try:
+            with span("upload"):
+                if self.upload_id is None:
+                    response = self.client.put_object(
+                        Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer)
+                    )
+                else:
+                    if self.buffer:
+                        self._send(bytes(self.buffer))
+                    response = self.client.complete_multipart_upload(
+                        Bucket=self.bucket,
+                        Key=self.key,
+                        UploadId=self.upload_id,
+                        MultipartUpload={"Parts": [part.result() for part in self.parts]},
+                    )
+        except BaseException:
+            self.abort()
+            raise
+        self.buffer = bytearray()
+        self.closed = True
+        self.etag = response.get("ETag")
 
-        if objects == "None":
-            print(f"No objects found for {date.strftime('%Y')}/{date.strftime('%m')}")
+    def abort(self):
+        if self.closed:
             return
+        self.closed = True
+        self.buffer = bytearray()
+        for part in self.parts:
+            part.cancel()
+        wait(self.parts)
+        if self.upload_id is not None:
+            try:
+                self.client.abort_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+                )
+            except Exception:
+                logger.exception("Failed to abort the upload of %s", self.key)
 
-    s3_uris = []
-    for object in objects:
-        s3_uris.append(f"{s3_bucket}/{object['Key']}")
 
-    print(f"Found {len(s3_uris)} objects")
+def parquet_fragments(uris, filesystem, sizes=None):
+    """
+    Dataset fragments of the parquet files at ``uris``, their footers
+    prefetched in parallel
+
+    Given the ``sizes`` of the files (e.g. from the listing, else they are
+    looked up) every footer takes a single ranged GET, and scanning the
+    fragments reuses it, so reading a file later only fetches its column
+    chunks.
+    """
 
-    metadata = pq.read_metadata(
-        s3_uris[0], filesystem=s3fs
-    ).metadata  # get the file level metadata since GeoParquetWriter doesn't write table level metadata
-    
-    schema =  pq.read_schema(
-    s3_uris[0],
-    filesystem=s3fs,
+    if sizes is None:
+        sizes = [info.size for info in filesystem.get_file_info(uris)]
+    parquet_format = ds.ParquetFileFormat()
+    fragments = [
+        parquet_format.make_fragment(uri, filesystem, file_size=size)
+        for uri, size in zip(uris, sizes)
+    ]
+    with ThreadPoolExecutor(max_workers=FOOTER_READ_THREADS) as executor:
+        list(executor.map(lambda fragment: fragment.ensure_complete_metadata(), fragments))
+    return fragments
+
+
+def fragment_readahead(fragments):
+    """
+    Files to scan at once: many small raw files, so their latencies overlap,
+    but few large compacted ones
+    """
+
+    footers = [fragment.metadata for fragment in fragments]
+    size = sum(
+        footer.row_group(index).total_byte_size
+        for footer in footers
+        for index in range(footer.num_row_groups)
+    ) // max(len(footers), 1)
+    return max(4, min(FOOTER_READ_THREADS, READAHEAD_BYTES // max(size, 1)))
+
+
+def file_schemas(footers):
+    """
+    Arrow schemas of the files of parquet ``footers``, each distinct one
+    decoded once; decoding one takes longer than fetching a small footer
+    """
+
+    decoded = {}
+    schemas = []
+    for footer in footers:
+        # the arrow schema the file was written with, when it was
+        serialized = (footer.metadata or {}).get(b"ARROW:schema")
+        key = (serialized, footer.num_columns) if serialized else id(footer)
+        if key not in decoded:
+            decoded[key] = footer.schema.to_arrow_schema()
+        schemas.append(decoded[key])
+    return schemas
+
+
+def unified_schema(schemas, paths):
+    """
+    Schema all files of ``schemas`` can be read as, checked against every
+    one of them rather than a sample
+
+    Fields some files lack are added, read as nulls from those; a field
+    whose type differs between files raises a ValueError naming them. The
+    last (newest) file's field order comes first.
+    """
+
+    unified = schemas[-1]
+    seen = {id(unified)}
+    for schema, path in zip(schemas, paths):
+        if id(schema) in seen or schema.equals(unified):
+            continue
+        seen.add(id(schema))
+        try:
+            unified = pa.unify_schemas([unified, schema])
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as exc:
+            raise ValueError(
+                f"Schema of {path} conflicts with that of {paths[-1]} or the files before it: {exc}"
+            ) from exc
+    return unified
+
+
+def unified_geo_metadata(metadata):
+    """
+    GeoParquet ``geo`` metadata covering all files of the file ``metadata``
+    dicts: the bbox of every geometry column grown to that of each file and
+    the geometry types of all of them
+
+    A column bbox some file doesn't have is dropped, and so are the types
+    when a file allows any. None when no file is GeoParquet.
+    """
+
+    geo = None
+    for file_metadata in metadata:
+        if not file_metadata or b"geo" not in file_metadata:
+            continue
+        file_geo = json.loads(file_metadata[b"geo"])
+        if geo is None:
+            geo = file_geo
+            continue
+        for name, column in file_geo.get("columns", {}).items():
+            merged = geo["columns"].setdefault(name, column)
+            if merged is column:
+                continue
+            if "bbox" in merged and "bbox" in column:
+                half = len(merged["bbox"]) // 2
+                merged["bbox"] = [
+                    min(a, b) for a, b in zip(merged["bbox"][:half], column["bbox"][:half])
+                ] + [max(a, b) for a, b in zip(merged["bbox"][half:], column["bbox"][half:])]
+            else:
+                merged.pop("bbox", None)
+            if merged.get("geometry_types") and column.get("geometry_types"):
+                merged["geometry_types"] = sorted(
+                    set(merged["geometry_types"]) | set(column["geometry_types"])
+                )
+            else:
+                merged["geometry_types"] = []
+    return geo
+
+
+def conform(batch, schema):
+    """
+    ``batch`` with the fields of ``schema``, nulls for those it lacks
+    """
+
+    if batch.schema.equals(schema):
+        return batch
+    columns = []
+    for field in schema:
+        index = batch.schema.get_field_index(field.name)
+        if index < 0:
+            columns.append(pa.nulls(batch.num_rows, type=field.type))
+        else:
+            column = batch.column(index)
+            columns.append(column if column.type == field.type else column.cast(field.type))
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def upgraded_batches(fragments, schemas, filesystem, schema, tagged=False):
+    """
+    Scan positions files written with any schema version as record batches of
+    ``schema``, the current version, in file order; (path, batch) pairs with
+    ``tagged``
+    """
+
+    parquet_format = ds.ParquetFileFormat()
+    start = 0
+    while start < len(fragments):
+        version = positions_schema_version(schemas[start])
+        end = start + 1
+        while end < len(fragments) and positions_schema_version(schemas[end]) == version:
+            end += 1
+
+        dataset = ds.FileSystemDataset(
+            fragments[start:end],
+            unified_schema(schemas[start:end], [fragment.path for fragment in fragments[start:end]]),
+            parquet_format,
+            filesystem,
+        )
+        scanner = dataset.scanner(
+            use_threads=True, fragment_readahead=fragment_readahead(fragments[start:end])
+        )
+        for batch in scanner.scan_batches():
+            upgraded = conform(upgrade_positions(batch.record_batch, version), schema)
+            yield (batch.fragment.path, upgraded) if tagged else upgraded
+        start = end
+
+
+def partitioned_schema(schema, keys):
+    """
+    ``schema`` with a field per partition key appended
+    """
+
+    fields = [pa.field(key.name, key.type) for key in keys]
+    return pa.schema(list(schema) + fields, metadata=schema.metadata)
+
+
+def partitioned_batches(
+    fragments,
+    schemas,
+    filesystem,
+    keys,
+    schema,
+    event_time=False,
+    window=DEFAULT_EVENT_TIME_WINDOW,
+):
+    """
+    Upgraded position batches with a column per partition key appended
+
+    The hour is the event hour the ETL placed each row at with
+    ``event_time``, see ``partitioning.object_event_hours`` (``window`` is
+    the ETL's), else the poll hour taken from the key of each object.
+    """
+
+    data_schema = partitioned_schema(schema, keys)
+    event_hourly = event_time and any(key.kind == "hour" for key in keys)
+    start = 0
+    for hour, group in hour_groups([fragment.path for fragment in fragments]):
+        end = start + len(group)
+        for path, batch in upgraded_batches(
+            fragments[start:end], schemas[start:end], filesystem, schema, tagged=True
+        ):
+            if event_hourly:
+                hour = object_event_hours(path, batch.column("timestamp"), window)
+            yield pa.RecordBatch.from_arrays(
+                batch.columns + partition_arrays(batch, keys, hour), schema=data_schema
+            )
+        start = end
+
+
+def clustered_batches(batches, schema, method, window_rows=CLUSTER_WINDOW_ROWS):
+    """
+    Re-emit position ``batches`` sorted along the ``method`` curve within
+    consecutive windows of about ``window_rows`` rows
+    """
+
+    def cluster(window):
+        with span("cluster"):
+            table = pa.Table.from_batches(window, schema=schema)
+            table = cluster_positions(table.unify_dictionaries().combine_chunks(), method)
+            return table.to_batches(max_chunksize=MAX_ROWS_PER_GROUP)
+
+    window = []
+    rows = 0
+    for batch in batches:
+        window.append(batch)
+        rows += batch.num_rows
+        if rows >= window_rows:
+            yield from cluster(window)
+            window = []
+            rows = 0
+    if window:
+        yield from cluster(window)
+
+
+def parse_sort_keys(value):
+    """
+    Columns compacted rows are sorted by, from a comma separated list such
+    as "route_id,trip_id,timestamp": DEFAULT_SORT_KEYS when empty and none
+    for "none", which keeps the rows in the order they are read
+    """
+
+    if not value:
+        return DEFAULT_SORT_KEYS
+    if isinstance(value, str):
+        if value.strip().lower() == "none":
+            return ()
+        value = value.split(",")
+    return tuple(name.strip() for name in value if name.strip())
+
+
+def sort_key_table(table, columns):
+    """
+    The ``columns`` of ``table`` as a table Arrow can sort, dictionary
+    columns decoded so they order by their values
+    """
+
+    return pa.table(
+        [
+            column.cast(column.type.value_type) if pa.types.is_dictionary(column.type) else column
+            for column in (table.column(name) for name in columns)
+        ],
+        names=list(columns),
     )
-    
-    schema = schema.with_metadata(metadata)
-
-    dataset = ds.dataset(
-        s3_uris,
-        filesystem=s3fs,
-        format="parquet",
-        schema=schema,
+
+
+def sort_table(table, columns):
+    """
+    ``table`` ordered by ``columns``, ascending with nulls last
+    """
+
+    indices = pc.sort_indices(
+        sort_key_table(table, columns), sort_keys=[(name, "ascending") for name in columns]
     )
+    return table.take(indices)
 
-    # https://duckdb.org/docs/stable/guides/performance/file_formats.html
-    min_rows_per_group = 61440
-    max_rows_per_group = 122880
-    
-    parquet_format = ds.ParquetFileFormat()
-    parquet_write_options = parquet_format.make_write_options(
-        compression="zstd",
-        compression_level=15,
+
+def at_most(keys, frontier):
+    """
+    Mask of the rows of the key table ``keys`` that sort no later than the
+    single row of ``frontier``, nulls sorting last
+    """
+
+    mask = None
+    for name in reversed(keys.column_names):
+        column = keys.column(name)
+        value = frontier.column(name)[0]
+        if value.is_valid:
+            less = pc.fill_null(pc.less(column, value), False)
+            equal = pc.fill_null(pc.equal(column, value), False)
+        else:
+            less = pc.is_valid(column)
+            equal = pc.is_null(column)
+        mask = pc.or_(less, equal) if mask is None else pc.or_(less, pc.and_(equal, mask))
+    return mask
+
+
+def sorted_output(table):
+    """
+    Batches of SORT_MERGE_ROWS rows of the sorted ``table``, each with
+    dictionaries of its own in the order their values appear
+
+    Sorting scatters the indices of the dictionaries unified over all rows;
+    encoded again per batch, as the raw files are, near unique columns such
+    as geohash and stop ids take half the space.
+    """
+
+    for batch in table.to_batches(max_chunksize=SORT_MERGE_ROWS):
+        yield pa.RecordBatch.from_arrays(
+            [
+                column.cast(field.type.value_type).dictionary_encode().cast(field.type)
+                if pa.types.is_dictionary(field.type)
+                else column
+                for field, column in zip(batch.schema, batch.columns)
+            ],
+            schema=batch.schema,
+        )
+
+
+def spill_run(table, path):
+    """
+    Write the sorted run ``table`` to a zstd compressed Arrow file at
+    ``path``, in batches of SORT_MERGE_ROWS rows
+    """
+
+    # one dictionary per column, which the IPC file format requires
+    table = table.unify_dictionaries().combine_chunks()
+    options = pa.ipc.IpcWriteOptions(compression="zstd")
+    with pa.ipc.new_file(path, table.schema, options=options) as writer:
+        writer.write_table(table, max_chunksize=SORT_MERGE_ROWS)
+
+
+def merged_runs(paths, columns):
+    """
+    Batches of the sorted runs spilled to ``paths`` merged into one order
+
+    Every round emits the rows of all runs that sort no later than the last
+    row of the run batch ending first, which no row still unread can
+    precede, and reads the next batch of the runs it used up. So every row
+    is sorted once more and only one batch of each run is held.
+    """
+
+    readers = [pa.ipc.open_file(pa.memory_map(path)) for path in paths]
+    batches_read = [0] * len(readers)
+    # (rows not emitted yet, their sort key table) of the current batch of each run
+    heads = [None] * len(readers)
+
+    def advance(run):
+        heads[run] = None
+        reader = readers[run]
+        while heads[run] is None and batches_read[run] < reader.num_record_batches:
+            table = pa.Table.from_batches([reader.get_batch(batches_read[run])])
+            batches_read[run] += 1
+            if table.num_rows:
+                heads[run] = (table, sort_key_table(table, columns))
+
+    for run in range(len(readers)):
+        advance(run)
+
+    sort_keys = [(name, "ascending") for name in columns]
+    while True:
+        active = [run for run, head in enumerate(heads) if head is not None]
+        if not active:
+            return
+        with span("merge"):
+            ends = pa.concat_tables(
+                [heads[run][1].slice(heads[run][1].num_rows - 1) for run in active]
+            )
+            first = pc.sort_indices(ends, sort_keys=sort_keys)[0].as_py()
+            frontier = ends.slice(first, 1)
+            parts = []
+            for run in active:
+                table, keys = heads[run]
+                if run == active[first]:
+                    rows = table.num_rows
+                else:
+                    rows = pc.sum(at_most(keys, frontier)).as_py() or 0
+                parts.append(table.slice(0, rows))
+                if rows == table.num_rows:
+                    advance(run)
+                else:
+                    heads[run] = (table.slice(rows), keys.slice(rows))
+            merged = sort_table(
+                pa.concat_tables(parts).unify_dictionaries().combine_chunks(), columns
+            )
+        yield from sorted_output(merged)
+
+
+def sorted_batches(batches, schema, columns):
+    """
+    Re-emit ``batches`` ordered by ``columns``, out of core
+
+    Up to SORT_RUN_ROWS rows are sorted in memory. Beyond that every run of
+    SORT_RUN_ROWS rows is sorted and spilled to a temporary file, and the
+    runs are merged once all batches are read (see ``merged_runs``), so
+    memory stays bounded however many rows are sorted.
+    """
+
+    def sort(window):
+        with span("sort"):
+            table = pa.Table.from_batches(window, schema=schema)
+            return sort_table(table.unify_dictionaries().combine_chunks(), columns)
+
+    with tempfile.TemporaryDirectory(prefix="sort-") as directory:
+        runs = []
+
+        def spill(window):
+            runs.append(os.path.join(directory, f"run-{len(runs)}.arrow"))
+            sorted_run = sort(window)
+            with span("sort"):
+                spill_run(sorted_run, runs[-1])
+
+        window = []
+        rows = 0
+        for batch in batches:
+            window.append(batch)
+            rows += batch.num_rows
+            if rows >= SORT_RUN_ROWS:
+                spill(window)
+                window = []
+                rows = 0
+
+        if not runs:
+            if rows:
+                yield from sorted_output(sort(window))
+            return
+        if rows:
+            spill(window)
+        count("sort_runs", len(runs))
+        yield from merged_runs(runs, columns)
+
+
+def write_options(schema):
+    """
+    ``pq.ParquetWriter`` options: zstd with dictionary pages only for
+    identifier, enum, integer and timestamp columns and byte stream split
+    for floats
+
+    Float columns left out of dictionary encoding get byte stream split,
+    which zstd compresses far better than plain or dictionary pages.
+    """
+
+    dictionary = []
+    byte_stream_split = []
+
+    def visit(path, type):
+        if pa.types.is_struct(type):
+            for child in type:
+                visit(f"{path}.{child.name}", child.type)
+        elif pa.types.is_floating(type):
+            byte_stream_split.append(path)
+        elif (
+            pa.types.is_dictionary(type)
+            or pa.types.is_string(type)
+            or pa.types.is_integer(type)
+            or pa.types.is_timestamp(type)
+        ):
+            dictionary.append(path)
+
+    for field in schema:
+        visit(field.name, field.type)
+
+    return {
+        "compression": "zstd",
+        "compression_level": 15,
+        "use_dictionary": dictionary,
+        "use_byte_stream_split": byte_stream_split,
+    }
+
+
+def partition_batches(batches, keys, schema):
+    """
+    (hive partition path, batch) pairs of ``batches`` split on the columns
+    of the partition ``keys`` appended to them, which are dropped; rows keep
+    their order inside each partition
+    """
+
+    names = [key.name for key in keys]
+    for batch in batches:
+        data = batch.select(schema.names)
+        if not keys:
+            yield "", data
+            continue
+        grouped = (
+            pa.table(
+                [batch.column(name) for name in names] + [pa.array(np.arange(batch.num_rows))],
+                names=names + ["row"],
+            )
+            .group_by(names, use_threads=False)
+            .aggregate([("row", "list")])
+        )
+        values = [grouped[name].to_pylist() for name in names]
+        for i, rows in enumerate(grouped["row_list"].to_pylist()):
+            yield partition_path(keys, [column[i] for column in values]), data.take(rows)
+
+
+def local_output(directory):
+    """
+    ``compact_dataset`` output writing files below a local ``directory``
+    """
+
+    def output(path):
+        file_path = os.path.join(directory, *path.split("/"))
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        return open(file_path, "wb")
+
+    return output
+
+
+def write_partitions(parts, schema, output, basename):
+    """
+    Write (partition path, batch) ``parts`` as one ``{basename}_0.parquet``
+    file per partition, in row groups of MAX_ROWS_PER_GROUP rows, returning
+    (path, rows, bytes) per file
+
+    Rows are buffered per partition until a row group is full; once more
+    than BUFFERED_ROWS are buffered over all partitions the largest one is
+    written early, so memory stays bounded however many partitions there
+    are. The files are only closed, which commits them, once every one of
+    them is complete; on failure they are aborted when they can be.
+    """
+
+    options = write_options(schema)
+    files = {}
+    writers = {}
+    pending = {}
+    rows = {}
+    buffered = 0
+
+    def write(path, final=False):
+        nonlocal buffered
+        table = pa.Table.from_batches(pending[path], schema=schema)
+        size = table.num_rows if final else table.num_rows - table.num_rows % MAX_ROWS_PER_GROUP
+        if not size:
+            return
+        if path not in writers:
+            files[path] = output(f"{path}{basename}_0.parquet")
+            writers[path] = pq.ParquetWriter(files[path], schema, **options)
+        writers[path].write_table(table.slice(0, size), row_group_size=MAX_ROWS_PER_GROUP)
+        rest = table.slice(size)
+        pending[path] = rest.to_batches() if rest.num_rows else []
+        rows[path] = rows.get(path, 0) + size
+        buffered -= size
+
+    try:
+        for path, batch in parts:
+            if not batch.num_rows:
+                continue
+            pending.setdefault(path, []).append(batch)
+            buffered += batch.num_rows
+            if sum(part.num_rows for part in pending[path]) >= MAX_ROWS_PER_GROUP:
+                write(path)
+            if buffered > BUFFERED_ROWS:
+                largest = max(pending, key=lambda key: sum(b.num_rows for b in pending[key]))
+                write(largest, final=True)
+        for path in sorted(pending):
+            if pending[path]:
+                write(path, final=True)
+        outputs = []
+        for path in sorted(writers):
+            writers[path].close()
+            outputs.append((f"{path}{basename}_0.parquet", rows[path], files[path].tell()))
+    except BaseException:
+        for file in files.values():
+            getattr(file, "abort", file.close)()
+        raise
+    for file in files.values():
+        file.close()
+    return outputs
+
+
+def compact_dataset(
+    uris,
+    filesystem,
+    output,
+    basename="positions",
+    spatial_sort=None,
+    partitioning=(),
+    event_time=True,
+    fragments=None,
+    sort_keys=DEFAULT_SORT_KEYS,
+    window=DEFAULT_EVENT_TIME_WINDOW,
+):
+    """
+    Merge the parquet files at ``uris`` into zstd compressed files with
+    DuckDB friendly row groups named ``{basename}_0.parquet``, returning
+    (path, rows, bytes) per file
+
+    ``output`` is a local directory or a callable returning a binary file
+    object to write the file at a relative path to, e.g. a
+    ``MultipartUpload``. Batches are streamed from the inputs to the output,
+    so memory and disk use don't grow with the size of the dataset.
+
+    Positions files of older schema versions are upgraded to the current one
+    on the way through. With ``spatial_sort`` ("hilbert" or "geohash") their
+    rows are clustered along that curve in windows of CLUSTER_WINDOW_ROWS, so
+    the bbox statistics of each row group cover a small area. With
+    ``partitioning`` keys they are written to hive partition directories,
+    ``hour=`` following the row timestamps with ``event_time``, as the ETL
+    writes them with its event time ``window``, else the poll times.
+
+    Unless positions are clustered spatially, the rows of every file are
+    ordered by the ``sort_keys`` columns, e.g. ("vehicle_id", "timestamp"),
+    with a sort that spills to /tmp when they don't fit in memory (see
+    ``sorted_batches``); no ``sort_keys`` keeps the order they are read in.
+
+    The schema and the GeoParquet metadata of the output are worked out once
+    from the footers of all files: ``fragments`` of ``uris`` whose footers
+    the caller already fetched (see ``parquet_fragments``), else they are
+    fetched here.
+    """
+
+    if isinstance(output, str):
+        output = local_output(output)
+
+    if fragments is None:
+        with span("footers"):
+            fragments = parquet_fragments(uris, filesystem)
+
+    footers = [fragment.metadata for fragment in fragments]
+    paths = [fragment.path for fragment in fragments]
+    metadata = dict(
+        footers[-1].metadata or {}
+    )  # get the file level metadata since GeoParquetWriter doesn't write table level metadata
+    # the writer stores the output's own arrow schema, a copy of the input's would shadow it
+    metadata.pop(b"ARROW:schema", None)
+    # the bbox of the first file alone wouldn't cover the others
+    geo = unified_geo_metadata(footer.metadata for footer in footers)
+    if geo is not None:
+        metadata[b"geo"] = json.dumps(geo).encode()
+
+    schemas = file_schemas(footers)
+
+    # only positions are partitioned below the day
+    keys = ()
+
+    if basename == "positions":
+        keys = partitioning
+        upgraded = {id(schema): upgraded_schema(schema) for schema in schemas}
+        schema = unified_schema([upgraded[id(schema)] for schema in schemas], paths)
+        schema = schema.with_metadata(schema_metadata(metadata))
+        data_schema = partitioned_schema(schema, partitioning)
+        if partitioning:
+            batches = partitioned_batches(
+                fragments, schemas, filesystem, partitioning, schema, event_time, window
+            )
+        else:
+            batches = upgraded_batches(fragments, schemas, filesystem, schema)
+        # reading and upgrading, apart from sorting and writing
+        batches = timed("read", batches)
+        if spatial_sort:
+            batches = clustered_batches(batches, data_schema, spatial_sort)
+            sort_keys = ()
+    else:
+        schema = unified_schema(schemas, paths)
+
+        schema = schema.with_metadata(metadata)
+        data_schema = schema
+
+        batches = timed(
+            "read",
+            ds.FileSystemDataset(
+                fragments,
+                schema,
+                ds.ParquetFileFormat(),
+                filesystem,
+            ).to_batches(use_threads=True, fragment_readahead=fragment_readahead(fragments)),
+        )
+
+    if sort_keys:
+        missing = [name for name in sort_keys if name not in schema.names]
+        if missing:
+            raise ValueError(f"Can't sort {basename} by {', '.join(missing)}, not one of its columns")
+        # partitions first, so they are written one after another
+        columns = list(dict.fromkeys([key.name for key in keys] + list(sort_keys)))
+        batches = sorted_batches(batches, data_schema, columns)
+
+    return write_partitions(partition_batches(batches, keys, schema), schema, output, basename)
+
+
+def manifest_key(city_name, dataset, label):
+    """
+    Key of the manifest of the compaction of ``dataset`` for ``label``, a
+    ``YYYY-MM-DD`` day or ``YYYY-MM`` month
+    """
+
+    return f"{city_name}/_manifests/{dataset}/{label}.json"
+
+
+def load_manifest(s3_bucket, key):
+    """
+    The manifest stored at ``key``, or None when there is none (or it was
+    written in another layout)
+    """
+
+    try:
+        response = s3.get_object(Bucket=s3_bucket, Key=key)
+    except s3.exceptions.NoSuchKey:
+        return None
+    manifest = json.loads(response["Body"].read())
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def save_manifest(s3_bucket, key, manifest):
+    s3.put_object(
+        Bucket=s3_bucket,
+        Key=key,
+        Body=json.dumps(manifest, indent=1, sort_keys=True).encode(),
+        ContentType="application/json",
     )
 
-    ds.write_dataset(
-        dataset,
-        "/tmp",
-        format="parquet",
-        file_options=parquet_write_options,
-        basename_template=f"positions_{{i}}.parquet",
-        min_rows_per_group=min_rows_per_group,
-        max_rows_per_group=max_rows_per_group,
-        existing_data_behavior="overwrite_or_ignore",
-        use_threads=True,
-        preserve_order=True,
-        filesystem=fs.LocalFileSystem(),
-        create_dir=False,
+
+def compaction_settings(spatial_sort, partitioning, event_time, sort_keys):
+    """
+    Settings that shape the compacted files; the output of a manifest
+    written with other settings is compacted again from scratch
+    """
+
+    return {
+        "spatial_sort": spatial_sort,
+        "partitioning": [f"{key.name}:{key.size}" for key in partitioning],
+        "event_time": event_time,
+        "sort_keys": list(sort_keys),
+    }
+
+
+def record_compaction(s3_bucket, city_name, dataset, date, settings, rows):
+    """
+    Write the manifest of a day whose compacted files were written outside
+    ``compact_objects``, e.g. by a replay of the raw archive, so the next
+    compaction merges new raw objects into them rather than compacting the
+    day again from its raw objects
+
+    ``rows`` holds the rows of every compacted file of the day by key. All
+    raw objects of the day listed now count as merged into them.
+    """
+
+    label = date.strftime("%Y-%m-%d")
+    day = f"year={date.strftime('%Y')}/month={date.strftime('%m')}/day={date.strftime('%d')}/"
+
+    def parquet(prefix):
+        objects = list_objects_in_s3(s3_bucket, prefix)
+        if objects == "None":
+            return {}
+        return {object["Key"]: object for object in objects if object["Key"].endswith(".parquet")}
+
+    inputs = parquet(f"{city_name}/{dataset}_raw/{day}")
+    outputs = parquet(f"{city_name}/{dataset}/{day}")
+    save_manifest(
+        s3_bucket,
+        manifest_key(city_name, dataset, label),
+        {
+            "version": MANIFEST_VERSION,
+            "dataset": dataset,
+            "date": label,
+            "settings": settings,
+            "inputs": {
+                key: {"etag": object.get("ETag"), "size": object.get("Size"), "rows": None}
+                for key, object in inputs.items()
+            },
+            "outputs": {
+                key: {"etag": object.get("ETag"), "rows": rows.get(key), "bytes": object.get("Size")}
+                for key, object in outputs.items()
+            },
+            "compacted_at": datetime.now(date.tzinfo).isoformat(),
+        },
     )
 
-    # loop through tmp and upload to s3
-    for file in os.listdir("/tmp"):
-        if file.endswith(".parquet"):
-            if period == "days":
-                s3_key = (
-                    f"{city_name}/positions/year={date.strftime('%Y')}/"
-                    f"month={date.strftime('%m')}/day={date.strftime('%d')}/{file}"
-                )
-            elif period == "months":
-                s3_key = (
-                    f"{city_name}/positions/year={date.strftime('%Y')}/"
-                    f"month={date.strftime('%m')}/{file}"
+
+def plan_compaction(manifest, inputs, outputs, settings):
+    """
+    How to bring the compacted files of a partition up to date: ("merge",
+    keys) to merge the raw objects ``keys`` into the existing output,
+    ("unchanged", []) when it already holds every input, or ("full", reason)
+    to compact every input again
+
+    ``inputs`` are the listed objects to compact by key and ``outputs`` the
+    ETags of the compacted files there are now by key. Objects can only be
+    merged in when the output is exactly what the manifest recorded, and no
+    input it recorded changed or disappeared since; anything else, such as
+    files a failed run committed without its manifest, is rebuilt.
+    """
+
+    if manifest is None:
+        return "full", "no manifest"
+    if manifest["settings"] != settings:
+        return "full", "settings changed"
+    if {key: output["etag"] for key, output in manifest["outputs"].items()} != outputs:
+        return "full", "compacted files changed"
+    for key, merged in manifest["inputs"].items():
+        if key not in inputs or inputs[key].get("ETag") != merged["etag"]:
+            return "full", f"{key} changed"
+    added = [key for key in inputs if key not in manifest["inputs"]]
+    if not added:
+        return "unchanged", []
+    return "merge", added
+
+
+def merge_objects_from_s3(
+    s3_bucket,
+    date,
+    period,
+    city_name,
+    dataset="positions",
+    spatial_sort=None,
+    partitioning=(),
+    event_time=True,
+    metrics_namespace=DEFAULT_NAMESPACE,
+    profile=None,
+    incremental=True,
+    sort_keys=DEFAULT_SORT_KEYS,
+    window=DEFAULT_EVENT_TIME_WINDOW,
+):
+    """
+    Compact the raw objects of ``dataset`` for the day (or the compacted
+    days of the month) of ``date`` and upload the result
+
+    Listing, footer reads, reading, clustering, the whole compaction and the
+    uploads are timed, with object, row and byte counts, and emitted as one
+    EMF record per dataset, see ``metrics``. ``profile``, (invocation id,
+    profile modes), profiles the compaction and writes the dumps to the
+    bucket, see ``profiling``. With ``incremental`` only the objects added
+    since the last compaction are merged, see ``compact_objects``.
+
+    Returns the result of the partition: its date, dataset, status ("ok",
+    "unchanged", "empty" or "failed"), mode ("full" or "merge"), object and
+    row counts, seconds and error, if any.
+    Failures are logged and reported rather than raised, so the other
+    partitions of the invocation still complete.
+    """
+
+    label = date.strftime("%Y-%m-%d") if period == "days" else date.strftime("%Y-%m")
+    result = {
+        "date": label,
+        "dataset": dataset,
+        "status": "ok",
+        "mode": None,
+        "objects_read": 0,
+        "objects_written": 0,
+        "rows": 0,
+        "error": None,
+    }
+    metrics = Metrics(metrics_namespace, "compaction", Stage=city_name, Dataset=dataset)
+    metrics.set_property("period", period)
+    metrics.set_property("date", date.strftime("%Y-%m-%d"))
+    profile_dataset = nullcontext()
+    if profile is not None:
+        invocation, modes = profile
+        profile_dataset = profiled(
+            lambda key, data: s3.put_object(Bucket=s3_bucket, Key=key, Body=data),
+            city_name,
+            "compaction",
+            f"{dataset}-{date.strftime('%Y%m%d')}-{invocation}",
+            datetime.now(date.tzinfo),
+            modes,
+        )
+    start = time.perf_counter()
+    try:
+        with metrics.activate(), profile_dataset:
+            result.update(
+                compact_objects(
+                    s3_bucket,
+                    date,
+                    period,
+                    city_name,
+                    dataset,
+                    spatial_sort,
+                    partitioning,
+                    event_time,
+                    metrics,
+                    incremental,
+                    sort_keys,
+                    window,
                 )
-            upload_object_to_s3(
+            )
+    except Exception as exc:
+        logger.exception("Failed to compact %s %s for %s", dataset, label, city_name)
+        metrics.count("errors")
+        result.update(status="failed", error=f"{type(exc).__name__}: {exc}")
+    finally:
+        metrics.flush()
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def compact_objects(
+    s3_bucket,
+    date,
+    period,
+    city_name,
+    dataset,
+    spatial_sort,
+    partitioning,
+    event_time,
+    metrics,
+    incremental=True,
+    sort_keys=DEFAULT_SORT_KEYS,
+    window=DEFAULT_EVENT_TIME_WINDOW,
+):
+    """
+    Compact one partition, returning its status, mode and object and row
+    counts
+
+    The manifest of the partition records the raw objects (key, ETag, rows)
+    merged into its compacted files and those files (key, ETag, rows,
+    bytes). With ``incremental`` only the objects added since are read,
+    together with the compacted files they are merged into, and nothing is
+    read when there are none, so a retried or repeated compaction is a no-op.
+    The compacted files are committed before the manifest, and compacted
+    files it doesn't name are removed.
+    """
+
+    label = date.strftime("%Y-%m-%d") if period == "days" else date.strftime("%Y-%m")
+    if period == "days":
+        prefix = (
+            f"{city_name}/{dataset}/year={date.strftime('%Y')}/"
+            f"month={date.strftime('%m')}/day={date.strftime('%d')}/"
+        )
+    elif period == "months":
+        prefix = f"{city_name}/{dataset}/year={date.strftime('%Y')}/month={date.strftime('%m')}/"
+
+    # only positions are partitioned below the day
+    bounds = listing_bounds(period, partitioning if dataset == "positions" else ())
+    with span("list"):
+        if period == "days":
+            objects = list_objects_in_s3(
                 s3_bucket,
-                s3_key,
-                f"/tmp/{file}",
+                f"{city_name}/{dataset}_raw/year={date.strftime('%Y')}/month={date.strftime('%m')}/day={date.strftime('%d')}/",
+                bounds,
             )
-            print(f"Uploaded {file} to {s3_bucket}")
+            compacted = list_objects_in_s3(s3_bucket, prefix)
+        elif period == "months":
+            # the days of the month and the month's own compacted files
+            # share its prefix
+            objects = compacted = list_objects_in_s3(s3_bucket, prefix, bounds)
+
+    def parquet(objects, days):
+        if objects == "None":
+            return {}
+        return {
+            object["Key"]: object
+            for object in objects
+            if object["Key"].endswith(".parquet")
+            and (days is None or object["Key"][len(prefix) :].startswith("day=") == days)
+        }
+
+    inputs = parquet(objects, True if period == "months" else None)
+    compacted = parquet(compacted, False if period == "months" else None)
+    outputs = {key: object.get("ETag") for key, object in compacted.items()}
+
+    if not inputs:
+        metrics.count("objects_listed", 0)
+        if period == "days":
+            print(
+                f"No {dataset} objects found for {date.strftime('%Y')}/{date.strftime('%m')}/{date.strftime('%d')}"
+            )
+        else:
+            print(f"No {dataset} objects found for {date.strftime('%Y')}/{date.strftime('%m')}")
+        return {"status": "empty", "objects_read": 0, "objects_written": 0, "rows": 0}
+
+    print(f"Found {len(inputs)} {dataset} objects")
+    metrics.count("objects_listed", len(inputs))
+
+    settings = compaction_settings(spatial_sort, partitioning, event_time, sort_keys)
+    key = manifest_key(city_name, dataset, label)
+    if incremental:
+        manifest = load_manifest(s3_bucket, key)
+        mode, plan = plan_compaction(manifest, inputs, outputs, settings)
+    else:
+        mode, plan = "full", "incremental compaction is off"
+    metrics.set_property("mode", mode)
+    if mode == "unchanged":
+        print(f"{dataset} {label} already holds its {len(inputs)} objects")
+        return {"status": "unchanged", "objects_read": 0, "objects_written": 0, "rows": 0}
+    if mode == "merge":
+        print(f"Merging {len(plan)} new {dataset} objects into {len(outputs)} compacted files")
+        merged = dict(manifest["inputs"])
+        read_keys = sorted(outputs) + plan
+    else:
+        print(f"Compacting all {dataset} objects ({plan})")
+        merged = {}
+        read_keys = sorted(inputs)
+
+    s3_uris = [f"{s3_bucket}/{key}" for key in read_keys]
+    sizes = [(inputs.get(key) or compacted[key]).get("Size") for key in read_keys]
+    metrics.count("objects_read", len(s3_uris))
+    bytes_in = sum(size or 0 for size in sizes)
+    metrics.count("bytes_in", bytes_in, "Bytes")
+
+    with span("compact"):
+        with span("footers"):
+            fragments = parquet_fragments(s3_uris, s3fs, sizes)
+
+        # every file streams straight into a multipart upload of its final
+        # key, so nothing is staged in /tmp and uploads overlap the reads
+        uploads = {}
+
+        def output(path):
+            uploads[path] = MultipartUpload(s3, s3_bucket, f"{prefix}{path}")
+            return uploads[path]
+
+        written = compact_dataset(
+            s3_uris,
+            s3fs,
+            output,
+            basename=dataset,
+            spatial_sort=spatial_sort,
+            partitioning=partitioning,
+            event_time=event_time,
+            fragments=fragments,
+            sort_keys=sort_keys,
+            window=window,
+        )
+
+    for read_key, fragment in zip(read_keys, fragments):
+        if read_key in inputs:
+            merged[read_key] = {
+                "etag": inputs[read_key].get("ETag"),
+                "size": inputs[read_key].get("Size"),
+                "rows": fragment.metadata.num_rows,
+            }
+
+    rows = bytes_out = 0
+    files = {}
+    for path, file_rows, size in written:
+        metrics.count("rows", file_rows)
+        metrics.count("objects_written")
+        rows += file_rows
+        bytes_out += size
+        files[f"{prefix}{path}"] = {"etag": uploads[path].etag, "rows": file_rows, "bytes": size}
+        print(f"Uploaded {path} to {s3_bucket}")
+
+    # compacted files of earlier runs the new ones don't replace, e.g. of
+    # partitions that are gone or of another layout
+    for stale in sorted(set(outputs) - set(files)):
+        s3.delete_object(Bucket=s3_bucket, Key=stale)
+        print(f"Removed {stale} from {s3_bucket}")
+
+    save_manifest(
+        s3_bucket,
+        key,
+        {
+            "version": MANIFEST_VERSION,
+            "dataset": dataset,
+            "date": label,
+            "settings": settings,
+            "inputs": merged,
+            "outputs": files,
+            "compacted_at": datetime.now(date.tzinfo).isoformat(),
+        },
+    )
+
+    metrics.count("bytes_out", bytes_out, "Bytes")
+    if bytes_out:
+        metrics.put("compression_ratio", bytes_in / bytes_out)
+    return {
+        "mode": mode,
+        "objects_read": len(s3_uris),
+        "objects_written": len(written),
+        "rows": rows,
+    }
+
+
+def late_markers(s3_bucket, city_name, datasets):
+    """
+    Markers the ETL left for days it wrote raw objects to after they were
+    over, as {(dataset, YYYY-MM-DD): [marker keys]}
+    """
+
+    prefix = late_marker_prefix(city_name)
+    objects = list_objects_in_s3(s3_bucket, prefix)
+    markers = {}
+    if objects == "None":
+        return markers
+    for object in objects:
+        dataset, label, _ = object["Key"][len(prefix) :].split("/", 2)
+        if dataset in datasets:
+            markers.setdefault((dataset, label), []).append(object["Key"])
+    return markers
 
 
 def get_dates_in_range(duration, timezone, period, compact_to_now):
@@ -167,9 +1423,149 @@ def get_dates_in_range(duration, timezone, period, compact_to_now):
     return dates
 
 
+def dates_period(values):
+    """
+    "days" or "months", whichever all the ISO ``values`` are
+    """
+
+    periods = set()
+    for value in values:
+        for period, format in (("days", "%Y-%m-%d"), ("months", "%Y-%m")):
+            try:
+                datetime.strptime(value, format)
+            except (TypeError, ValueError):
+                continue
+            periods.add(period)
+            break
+        else:
+            raise ValueError(f"Invalid date {value!r}, expected YYYY-MM-DD or YYYY-MM")
+    if len(periods) != 1:
+        raise ValueError(f"dates must be all days or all months, got {values}")
+    return periods.pop()
+
+
+def parse_dates(values, timezone):
+    """
+    Aware datetimes of the ISO ``values`` (``YYYY-MM-DD`` or ``YYYY-MM``)
+    """
+
+    dates = []
+    for value in values:
+        if len(value) == len("YYYY-MM"):
+            value = f"{value}-01"
+        dates.append(datetime.fromisoformat(value).replace(hour=12, tzinfo=ZoneInfo(timezone)))
+    return dates
+
+
+def default_workers():
+    """
+    Concurrent compactions the function's memory and cores allow
+    """
+
+    cores = os.cpu_count() or 1
+    memory = int(os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE") or 0)
+    if not memory:
+        return cores
+    return max(1, min(cores, memory // WORKER_MEMORY_MB))
+
+
+def compact_partitions(tasks, workers, **options):
+    """
+    Run ``merge_objects_from_s3`` for every (date, dataset) of ``tasks`` on
+    up to ``workers`` threads, returning their results in task order
+
+    Arrow releases the GIL while it reads, sorts, compresses and writes, so
+    threads overlap the work of several dates; each one streams its output
+    to uploads of its own.
+    """
+
+    if workers <= 1 or len(tasks) <= 1:
+        return [
+            merge_objects_from_s3(date=date, dataset=dataset, **options)
+            for date, dataset in tasks
+        ]
+
+    results = [None] * len(tasks)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(merge_objects_from_s3, date=date, dataset=dataset, **options): i
+            for i, (date, dataset) in enumerate(tasks)
+        }
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return results
+
+
+def get_lambda_client():
+    global _lambda_client
+    if _lambda_client is None:
+        _lambda_client = boto3.client(
+            "lambda",
+            region_name=os.environ.get("AWS_DEFAULT_REGION"),
+            config=Config(
+                read_timeout=FAN_OUT_READ_TIMEOUT_SECONDS, retries={"max_attempts": 0}
+            ),
+        )
+    return _lambda_client
+
+
+def invoke_for_date(context, event, label):
+    """
+    Compact one date in an invocation of its own, returning its results
+    """
+
+    # a child reports its failures to its parent rather than raising them
+    child_event = {**event, "dates": [label], "fan_out": False, "parent": context.aws_request_id}
+    response = get_lambda_client().invoke(
+        FunctionName=context.function_name,
+        InvocationType="RequestResponse",
+        Payload=json.dumps(child_event).encode(),
+    )
+    payload = json.loads(response["Payload"].read() or b"{}")
+    if response.get("FunctionError"):
+        return [
+            {
+                "date": label,
+                "dataset": dataset,
+                "status": "failed",
+                "error": payload.get("errorMessage") or response["FunctionError"],
+            }
+            for dataset in event.get("datasets") or DATASETS
+        ]
+    return payload.get("results", [])
+
+
+def fan_out(event, context, labels):
+    """
+    Invoke the function once per date, concurrently, and gather the results
+    """
+
+    results = []
+    with ThreadPoolExecutor(max_workers=len(labels)) as executor:
+        futures = [
+            executor.submit(invoke_for_date, context, event, label)
+            for label in labels
+        ]
+        for future in futures:
+            results.extend(future.result())
+    return results
+
+
 def handler(event, context):
     """
     This compresses the GTFS vehicle position data in S3 bucket
+
+    The dates (or months) and datasets are compacted concurrently by
+    ``workers`` threads, by default as many as the function's memory and
+    cores allow, or with ``fan_out`` in one invocation per date. ``dates``
+    (ISO days or months, not both) compacts those instead of the previous
+    days or months. Every partition is reported with its own status, and the
+    invocation fails once the others are done if any of them failed.
+    Partitions are compacted incrementally unless ``incremental`` is false.
+    ``sort_keys`` ("vehicle_id,timestamp" by default, "none" for the order
+    rows are read in) orders the rows of the compacted files. Scheduled
+    daily runs also compact the earlier days the ETL left late markers for,
+    and remove the markers of the days they compacted.
     """
 
     s3_bucket = event.get("s3_bucket")
@@ -178,21 +1574,109 @@ def handler(event, context):
     timezone = event.get("timezone")
     compact_to_now = event.get("compact_to_now")
     city_name = event.get("stage")
+    datasets = event.get("datasets") or DATASETS
+    spatial_sort = event.get("spatial_sort") or os.environ.get("SPATIAL_SORT") or None
+    if spatial_sort not in (None, *SPATIAL_SORTS):
+        raise ValueError(f"spatial_sort must be one of {SPATIAL_SORTS}, got {spatial_sort!r}")
+    partitioning = parse_partitioning(
+        event.get("partition_keys") or os.environ.get("PARTITION_KEYS")
+    )
+    event_time = event_time_partitioning(
+        event.get("partition_time") or os.environ.get("PARTITION_TIME")
+    )
+    sort_keys = parse_sort_keys(event.get("sort_keys") or os.environ.get("SORT_KEYS"))
+    # the ETL's bounds of the event times, to place rows at the same hours
+    window = event_time_window(
+        event.get("max_lateness_seconds") or os.environ.get("MAX_LATENESS_SECONDS"),
+        event.get("max_future_seconds") or os.environ.get("MAX_FUTURE_SECONDS"),
+    )
+    # empty to emit no metrics
+    metrics_namespace = event.get(
+        "metrics_namespace", os.environ.get("METRICS_NAMESPACE", DEFAULT_NAMESPACE)
+    )
+    # merge only the objects added since the last compaction
+    incremental = event.get("incremental")
+    if incremental is None:
+        incremental = os.environ.get("INCREMENTAL_COMPACTION", "true").lower() in ("1", "true", "yes")
+    # cProfile/tracemalloc dumps of a sample of the invocations
+    profile = None
+    if sampled(event.get("profile_sample_rate") or os.environ.get("PROFILE_SAMPLE_RATE")):
+        profile = (
+            getattr(context, "aws_request_id", None) or uuid.uuid4().hex,
+            parse_modes(event.get("profile_modes") or os.environ.get("PROFILE_MODES")),
+        )
+        print(f"Profiling invocation {profile[0]} ({','.join(profile[1])})")
 
-    if previous_days:
-        duration = previous_days
+    # 0 previous days with compact_to_now compacts the current day
+    if event.get("dates"):
+        period = dates_period(event["dates"])
+        dates = parse_dates(event["dates"], timezone)
+    elif previous_days is not None:
         period = "days"
-    elif previous_months:
-        duration = previous_months
+        dates = get_dates_in_range(int(previous_days), timezone, period, compact_to_now)
+    elif previous_months is not None:
         period = "months"
+        dates = get_dates_in_range(int(previous_months), timezone, period, compact_to_now)
+    else:
+        raise ValueError("One of dates, previous_days or previous_months is required")
+
+    late = {}
+    if period == "days" and not event.get("dates"):
+        # listed before the raw objects, so markers of objects written
+        # during the run are kept for the next one
+        late = late_markers(s3_bucket, city_name, datasets)
+        labels = {date.strftime("%Y-%m-%d") for date in dates}
+        revisit = sorted({label for _, label in late} - labels)
+        if revisit:
+            print(f"Revisiting {len(revisit)} days with late objects: {', '.join(revisit)}")
+            dates += parse_dates(revisit, timezone)
 
-    dates = get_dates_in_range(int(duration), timezone, period, compact_to_now)
+    # concurrent dates and datasets, sized to the function by default
+    workers = int(
+        event.get("workers") or os.environ.get("COMPACTION_WORKERS") or default_workers()
+    )
+    if event.get("fan_out") and len(dates) > 1 and context is not None:
+        labels = [
+            date.strftime("%Y-%m-%d") if period == "days" else date.strftime("%Y-%m")
+            for date in dates
+        ]
+        print(f"Fanning out {len(labels)} {period} to one invocation each")
+        results = fan_out(event, context, labels)
+    else:
+        print(f"Compacting {len(dates)} {period} of {len(datasets)} datasets on {workers} workers")
+        results = compact_partitions(
+            [(date, dataset) for date in dates for dataset in datasets],
+            workers,
+            s3_bucket=s3_bucket,
+            period=period,
+            city_name=city_name,
+            spatial_sort=spatial_sort,
+            partitioning=partitioning,
+            event_time=event_time,
+            metrics_namespace=metrics_namespace,
+            profile=profile,
+            incremental=incremental,
+            sort_keys=sort_keys,
+            window=window,
+        )
 
-    for date in dates:
-        merge_objects_from_s3(s3_bucket, date, period, city_name)
-        print(
-            f"Compacted {date.strftime('%Y')}/{date.strftime('%m')}/{date.strftime('%d')} of {len(dates)}"
+    for result in results:
+        print(json.dumps(result))
+    compacted = {
+        (result["dataset"], result["date"]) for result in results if result["status"] != "failed"
+    }
+    for marker, keys in sorted(late.items()):
+        if marker in compacted:
+            for key in keys:
+                s3.delete_object(Bucket=s3_bucket, Key=key)
+    failed = [result for result in results if result["status"] == "failed"]
+    if failed:
+        message = f"Compaction failed for {len(failed)} of {len(results)} partitions: " + ", ".join(
+            f"{result['dataset']} {result['date']}" for result in failed
         )
+        if event.get("parent"):
+            return {"statusCode": 500, "body": message, "results": results}
+        raise RuntimeError(message)
 
     print("Compaction complete!")
-    return {"statusCode": 200, "body": "Compaction complete!"}
+    return {"statusCode": 200, "body": "Compaction complete!", "results": results}
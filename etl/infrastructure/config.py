@@ -2,7 +2,7 @@
 
 from pydantic import Field
 from pydantic_settings import BaseSettings
-from typing import Optional
+from typing import List, Optional
 
 
 class ETLSettings(BaseSettings):
@@ -13,6 +13,14 @@ class ETLSettings(BaseSettings):
         description="GTFS realtime vehicle position feed url",
     )
 
+    trip_update_url: Optional[str] = Field(
+        None,
+        description=(
+            "GTFS realtime trip updates feed url, written one row per stop time "
+            "update to trip_updates_raw"
+        ),
+    )
+
     schedule_seconds: int = Field(
         60,
         description="How often the event is scheduled",
@@ -38,6 +46,141 @@ class ETLSettings(BaseSettings):
         description="Header name to access the realtime data",
     )
 
+    feeds: Optional[List[dict]] = Field(
+        None,
+        description=(
+            "Feeds ingested together by one function, as a JSON list of "
+            '{"stage", "url", "timezone", "headers", "api_key", "api_key_header", '
+            '"trip_updates_url"} '
+            "objects. When unset the single veh_position_url feed is used."
+        ),
+    )
+
+    geohash_precision: int = Field(
+        7,
+        description="Number of characters in the geohash written with each position (1-12)",
+    )
+
+    delta_mode: bool = Field(
+        False,
+        description=(
+            "Only write vehicle reports that changed since the previous poll, "
+            "with a full keyframe snapshot every delta_keyframe_seconds"
+        ),
+    )
+
+    delta_keyframe_seconds: int = Field(
+        600,
+        description="Seconds between full keyframe snapshots in delta mode",
+    )
+
+    stream_decode: bool = Field(
+        False,
+        description=(
+            "Decode vehicle positions while the feed downloads, in batches of "
+            "stream_batch_rows entities, so memory stays bounded for very large "
+            "feeds. Ignored in delta mode"
+        ),
+    )
+
+    stream_batch_rows: int = Field(
+        65536,
+        description="Entities decoded and written per record batch in stream_decode mode",
+    )
+
+    spatial_sort: Optional[str] = Field(
+        None,
+        description=(
+            "Sort the rows of each raw positions file along a space filling curve "
+            "before writing, 'hilbert' or 'geohash', so row groups cover a small area"
+        ),
+    )
+
+    partition_keys: Optional[str] = Field(
+        None,
+        description=(
+            "Extra hive partition levels of positions below day=, in order, e.g. "
+            "'hour,route_bucket:16,geohash4'"
+        ),
+    )
+
+    partition_time: str = Field(
+        "event",
+        description=(
+            "Partition positions on the vehicle timestamps ('event') or on the "
+            "time of the poll ('poll')"
+        ),
+    )
+
+    max_lateness_seconds: int = Field(
+        24 * 60 * 60,
+        description=(
+            "Vehicle timestamps further than this before the poll are partitioned "
+            "at the time of the poll"
+        ),
+    )
+
+    max_future_seconds: int = Field(
+        15 * 60,
+        description=(
+            "Vehicle timestamps further than this after the poll are partitioned "
+            "at the time of the poll"
+        ),
+    )
+
+    fetch_hedge: bool = Field(
+        True,
+        description=(
+            "Send a second request for a feed whose download runs past the 95th "
+            "percentile of its recent download times"
+        ),
+    )
+
+    fetch_reserve_seconds: float = Field(
+        3.0,
+        description=(
+            "Seconds of the invocation kept for decoding and writing after the "
+            "download deadline"
+        ),
+    )
+
+    metrics_namespace: str = Field(
+        "GtfsRealtimeEtl",
+        description=(
+            "CloudWatch namespace of the stage timings and counters emitted as "
+            "Embedded Metric Format; empty to emit none"
+        ),
+    )
+
+    profile_sample_rate: float = Field(
+        0.0,
+        description=(
+            "Fraction of invocations profiled with cProfile and tracemalloc, "
+            "dumps written below {stage}/_profiles/"
+        ),
+    )
+
+    profile_modes: str = Field(
+        "cpu,memory",
+        description="Profilers of a sampled invocation, 'cpu' and/or 'memory'",
+    )
+
+    archive_raw: bool = Field(
+        False,
+        description=(
+            "Also keep the raw protobuf feed bodies, zstd compressed below "
+            "{stage}/{dataset}_archive/ in one object per invocation, for replays"
+        ),
+    )
+
+    snap_start: bool = Field(
+        False,
+        description=(
+            "Enable Lambda SnapStart so invocations restore a primed snapshot "
+            "instead of running the init phase"
+        ),
+    )
+
     class Config:
         """model config."""
 
@@ -2,6 +2,7 @@
 CDK construct for gtfs-realtime-etl Eventbridge scheduler.
 """
 
+import json
 import os
 
 from aws_cdk import (
@@ -37,9 +38,13 @@ class SubMinuteStepFunctionConstruct(Construct):
         construct_id: str,
         lambda_function: aws_lambda.Function,
         interval: int,
+        invoke_target: aws_lambda.IFunction | None = None,
     ) -> None:
         super().__init__(scope, construct_id)
 
+        # e.g. a SnapStart alias; the state machine is still named after the function
+        invoke_target = invoke_target or lambda_function
+
         seconds_per_minute = 60
         assert seconds_per_minute % interval == 0, (
             "A minute has to be evenly divisible by interval! (60 mod interval = 0)"
@@ -75,9 +80,9 @@ class SubMinuteStepFunctionConstruct(Construct):
                 action="invoke",
                 service="lambda",
                 iam_action="lambda:InvokeFunction",
-                iam_resources=[lambda_function.function_arn],
+                iam_resources=[invoke_target.function_arn],
                 parameters={
-                    "FunctionName": lambda_function.function_arn,
+                    "FunctionName": invoke_target.function_arn,
                     "InvocationType": "Event",
                 },
                 result_path=stepfunctions.JsonPath.DISCARD,  # Discard the output and pass on the input
@@ -131,13 +136,32 @@ class EventBridgeConstruct(Construct):
             etl_settings = ETLSettings()
 
         lambda_env = {
-            "VEH_POSITION_URL": etl_settings.veh_position_url,
+            "VEH_POSITION_URL": etl_settings.veh_position_url or "",
+            "TRIP_UPDATE_URL": etl_settings.trip_update_url or "",
             "TIMEZONE": etl_settings.timezone,
             "DESTINATION_BUCKET": etl_settings.destination_bucket,
             "STAGE": stage,
             "API_KEY": etl_settings.api_key if etl_settings.api_key else "",
             "API_KEY_HEADER": etl_settings.api_key_header if etl_settings.api_key_header else "",
+            "GEOHASH_PRECISION": str(etl_settings.geohash_precision),
+            "DELTA_MODE": "true" if etl_settings.delta_mode else "",
+            "DELTA_KEYFRAME_SECONDS": str(etl_settings.delta_keyframe_seconds),
+            "STREAM_DECODE": "true" if etl_settings.stream_decode else "",
+            "STREAM_BATCH_ROWS": str(etl_settings.stream_batch_rows),
+            "SPATIAL_SORT": etl_settings.spatial_sort or "",
+            "PARTITION_KEYS": etl_settings.partition_keys or "",
+            "PARTITION_TIME": etl_settings.partition_time,
+            "MAX_LATENESS_SECONDS": str(etl_settings.max_lateness_seconds),
+            "MAX_FUTURE_SECONDS": str(etl_settings.max_future_seconds),
+            "FETCH_HEDGE": "true" if etl_settings.fetch_hedge else "false",
+            "FETCH_RESERVE_SECONDS": str(etl_settings.fetch_reserve_seconds),
+            "METRICS_NAMESPACE": etl_settings.metrics_namespace,
+            "PROFILE_SAMPLE_RATE": str(etl_settings.profile_sample_rate),
+            "PROFILE_MODES": etl_settings.profile_modes,
+            "ARCHIVE_RAW": "true" if etl_settings.archive_raw else "",
         }
+        if etl_settings.feeds:
+            lambda_env["FEEDS"] = json.dumps(etl_settings.feeds)
 
         destination_bucket = aws_s3.Bucket.from_bucket_name(
             self, "DestinationBucket", etl_settings.destination_bucket
@@ -167,6 +191,23 @@ class EventBridgeConstruct(Construct):
             timeout=Duration.seconds(10),
             application_log_level_v2=aws_lambda.ApplicationLogLevel.ERROR,
             logging_format=aws_lambda.LoggingFormat.JSON,
+            snap_start=(
+                aws_lambda.SnapStartConf.ON_PUBLISHED_VERSIONS
+                if etl_settings.snap_start
+                else None
+            ),
+        )
+
+        # SnapStart only applies to published versions, so invoke through an alias
+        invoke_target = (
+            aws_lambda.Alias(
+                self,
+                "live",
+                alias_name="live",
+                version=lambda_function.current_version,
+            )
+            if etl_settings.snap_start
+            else lambda_function
         )
 
         lambda_function.add_to_role_policy(
@@ -182,6 +223,8 @@ class EventBridgeConstruct(Construct):
         )
 
         destination_bucket.grant_write(lambda_function)
+        # read back the last processed feed state under <stage>/_state/
+        destination_bucket.grant_read(lambda_function)
 
         dlq = aws_sqs.Queue(self, "DLQ", queue_name=f"gtfs-realtime-etl-dlq-{stage}")
 
@@ -191,6 +234,7 @@ class EventBridgeConstruct(Construct):
                 "SubMinuteLambdaStepFunction",
                 lambda_function,
                 etl_settings.schedule_seconds,
+                invoke_target=invoke_target,
             )
 
             target = aws_scheduler_targets_alpha.StepFunctionsStartExecution(
@@ -201,7 +245,7 @@ class EventBridgeConstruct(Construct):
             )
         else:
             target = aws_scheduler_targets_alpha.LambdaInvoke(
-                lambda_function,
+                invoke_target,
                 dead_letter_queue=dlq,
                 max_event_age=Duration.minutes(15),
                 retry_attempts=0,
@@ -0,0 +1,198 @@
+"""
+Archive of the raw protobuf feed bodies, for replaying history.
+
+Derived Parquet can't be regenerated after a schema or enrichment change, so
+with ARCHIVE_RAW the handler and the poller also keep every new feed body.
+Bodies are not stored one object per poll: each stage and dataset appends
+them to a zstd compressed batch spooled to ``/tmp``, and a batch is written
+as one object once it is ARCHIVE_BATCH_SECONDS old or holds
+ARCHIVE_BATCH_BYTES of bodies, below
+
+    {stage}/{dataset}_archive/year=/month=/day=/{HHMMSS}-{id}.pb.zst
+
+named after its first poll. A batch never spans two days. Inside the zstd
+stream each body is framed by its poll time (int64 nanoseconds since the
+epoch) and its length (uint32), little endian. Arrow's zstd stream (level 1)
+is used, so nothing is added to the runtime, and it still stores feed bodies
+several times smaller.
+
+Batches live in the memory and ``/tmp`` of the process. A Lambda container
+can be recycled between any two invocations, so the handler writes its
+batches at the end of every invocation, one object per stage and dataset;
+only the long running poller batches across polls. ``replay.py``
+reprocesses archived days.
+"""
+
+import datetime as dt
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import uuid
+from zoneinfo import ZoneInfo
+
+import pyarrow as pa
+
+from partitioning import NANOSECONDS_PER_SECOND, day_partition
+
+logger = logging.getLogger()
+
+ARCHIVE_SUFFIX = ".pb.zst"
+
+DEFAULT_ARCHIVE_BATCH_SECONDS = 900
+DEFAULT_ARCHIVE_BATCH_BYTES = 256 * 1024 * 1024
+
+# poll time in nanoseconds since the epoch, body length
+FRAME_HEADER = struct.Struct("<qI")
+
+# bytes of a spooled body copied into the batch at once
+COPY_CHUNK_BYTES = 1024 * 1024
+
+
+def archive_prefix(city_name, dataset, date):
+    """
+    Key prefix of the archive batches of ``dataset`` opened on ``date``
+    """
+
+    return f"{city_name}/{dataset}_archive/{day_partition(date)}"
+
+
+def archive_object_key(city_name, dataset, opened, batch_id):
+    return f"{archive_prefix(city_name, dataset, opened)}{opened.strftime('%H%M%S')}-{batch_id}{ARCHIVE_SUFFIX}"
+
+
+class ArchiveBatch:
+    """Bodies of one stage and dataset waiting to be written."""
+
+    def __init__(self, opened, directory=None):
+        self.opened = opened
+        self.bodies = 0
+        self.bytes = 0
+        descriptor, self.path = tempfile.mkstemp(suffix=ARCHIVE_SUFFIX, dir=directory)
+        os.close(descriptor)
+        self.stream = pa.CompressedOutputStream(self.path, "zstd")
+
+    def append(self, poll_time, body):
+        """
+        Add ``body``, bytes or a binary file object spooling it, which is
+        copied from its start a chunk at a time
+        """
+
+        spooled = not isinstance(body, (bytes, bytearray, memoryview))
+        length = body.seek(0, os.SEEK_END) if spooled else len(body)
+        nanoseconds = int(poll_time.timestamp()) * NANOSECONDS_PER_SECOND + (
+            poll_time.microsecond * 1000
+        )
+        self.stream.write(FRAME_HEADER.pack(nanoseconds, length))
+        if spooled:
+            body.seek(0)
+            shutil.copyfileobj(body, self.stream, COPY_CHUNK_BYTES)
+        else:
+            self.stream.write(body)
+        self.bodies += 1
+        self.bytes += length
+
+    def due(self, now, batch_seconds, batch_bytes):
+        return (
+            self.bytes >= batch_bytes
+            or (now - self.opened).total_seconds() >= batch_seconds
+            or now.date() != self.opened.date()
+        )
+
+    def close(self):
+        """
+        Finish the zstd stream, returning the path of the spooled batch
+        """
+
+        self.stream.close()
+        return self.path
+
+
+class RawArchive:
+    """Batches feed bodies per stage and dataset and writes them to a sink."""
+
+    def __init__(
+        self,
+        sink,
+        batch_seconds=DEFAULT_ARCHIVE_BATCH_SECONDS,
+        batch_bytes=DEFAULT_ARCHIVE_BATCH_BYTES,
+        directory=None,
+    ):
+        self.sink = sink
+        self.batch_seconds = batch_seconds
+        self.batch_bytes = batch_bytes
+        self.directory = directory
+        self.batches = {}
+
+    def append(self, city_name, dataset, poll_time, body):
+        """
+        Archive one feed ``body`` (bytes or a binary file object, see
+        ``ArchiveBatch.append``) polled at ``poll_time``, an aware datetime
+        in the feed's time zone
+        """
+
+        key = (city_name, dataset)
+        batch = self.batches.get(key)
+        if batch is not None and poll_time.date() != batch.opened.date():
+            self.write(key)
+            batch = None
+        if batch is None:
+            batch = self.batches[key] = ArchiveBatch(poll_time, self.directory)
+        batch.append(poll_time, body)
+        if batch.due(poll_time, self.batch_seconds, self.batch_bytes):
+            self.write(key)
+
+    def write(self, key):
+        batch = self.batches.pop(key)
+        path = batch.close()
+        city_name, dataset = key
+        object_key = archive_object_key(city_name, dataset, batch.opened, uuid.uuid4().hex[:8])
+        try:
+            logger.info(
+                "Archiving %d %s bodies (%d bytes) to %s",
+                batch.bodies,
+                dataset,
+                batch.bytes,
+                self.sink.uri(object_key),
+            )
+            with open(path, "rb") as f:
+                self.sink.put_file(object_key, f)
+        finally:
+            os.remove(path)
+        return object_key
+
+    def flush(self, force=False):
+        """
+        Write the batches that are due, or all of them with ``force``
+        """
+
+        for key, batch in list(self.batches.items()):
+            now = dt.datetime.now(tz=batch.opened.tzinfo)
+            if force or batch.due(now, self.batch_seconds, self.batch_bytes):
+                try:
+                    self.write(key)
+                except Exception:
+                    logger.exception("Failed to archive %s %s", *key)
+
+
+def read_archive(data, timezone="UTC"):
+    """
+    (poll time, body) of every frame of an archive batch, read from its
+    bytes one body at a time
+    """
+
+    zone = ZoneInfo(timezone)
+    stream = pa.CompressedInputStream(pa.BufferReader(data), "zstd")
+    while True:
+        header = stream.read(FRAME_HEADER.size)
+        if not header:
+            return
+        if len(header) < FRAME_HEADER.size:
+            raise ValueError("Truncated archive frame header")
+        nanoseconds, length = FRAME_HEADER.unpack(header)
+        body = stream.read(length)
+        if len(body) < length:
+            raise ValueError("Truncated archive frame body")
+        poll_time = dt.datetime.fromtimestamp(nanoseconds / NANOSECONDS_PER_SECOND, zone)
+        yield poll_time, body
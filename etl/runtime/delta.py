@@ -0,0 +1,155 @@
+"""
+Per-vehicle delta mode.
+
+Between keyframes only the rows whose vehicle report changed since the
+previous poll (a new timestamp or a moved position) are written. A full
+snapshot (keyframe) is written on a cold start and then periodically, so a
+reader can rebuild the complete fleet state from the latest keyframe plus
+the deltas that follow it.
+
+State lives in the container. Concurrent containers each track their own
+state, which can only add rows to a delta, never drop a changed report.
+"""
+
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+DEFAULT_KEYFRAME_SECONDS = 600
+
+STATE_COLUMNS = ["vehicle_id", "timestamp", "latitude", "longitude"]
+ROW_INDEX = "__row"
+SEEN = "__seen"
+
+
+def _with_row_index(table):
+    return table.append_column(ROW_INDEX, pa.array(np.arange(table.num_rows)))
+
+
+def _state_columns(table):
+    """
+    The tracked columns of ``table`` with a plain string vehicle_id, so polls
+    with different dictionaries can be joined and compared
+    """
+
+    table = table.select(STATE_COLUMNS)
+    vehicle_id = table["vehicle_id"]
+    if pa.types.is_dictionary(vehicle_id.type):
+        table = table.set_column(0, "vehicle_id", vehicle_id.cast(pa.string()))
+    return table
+
+
+def _same(current, previous):
+    """
+    Null-aware equality: two nulls are the same value
+    """
+
+    equal = pc.fill_null(pc.equal(current, previous), False)
+    both_null = pc.and_(pc.is_null(current), pc.is_null(previous))
+    return pc.or_(equal, both_null)
+
+
+def latest_per_vehicle(table):
+    """
+    Last row of each vehicle_id, dropping rows without a vehicle_id
+    """
+
+    table = _with_row_index(
+        _state_columns(table).filter(pc.is_valid(table["vehicle_id"]))
+    )
+    latest = table.group_by("vehicle_id").aggregate([(ROW_INDEX, "max")])
+    return table.take(latest[f"{ROW_INDEX}_max"]).drop_columns([ROW_INDEX])
+
+
+def changed_rows(table, previous):
+    """
+    Boolean mask of the rows of ``table`` that differ from ``previous``
+
+    Rows without a vehicle_id are always treated as changed.
+    """
+
+    renamed = previous.rename_columns(
+        ["vehicle_id"] + [f"previous_{name}" for name in STATE_COLUMNS[1:]]
+    )
+    # marks vehicles that have a previous row, whatever its values
+    renamed = renamed.append_column(SEEN, pa.array(np.ones(previous.num_rows, dtype=np.bool_)))
+    joined = (
+        _with_row_index(_state_columns(table))
+        .join(renamed, keys="vehicle_id", join_type="left outer")
+        .sort_by(ROW_INDEX)
+    )
+
+    unchanged = pc.and_(pc.is_valid(joined["vehicle_id"]), pc.is_valid(joined[SEEN]))
+    for name in STATE_COLUMNS[1:]:
+        unchanged = pc.and_(unchanged, _same(joined[name], joined[f"previous_{name}"]))
+    return pc.invert(unchanged)
+
+
+class VehicleTracker:
+    """Last reported state of every vehicle of one stage."""
+
+    def __init__(self, keyframe_seconds=DEFAULT_KEYFRAME_SECONDS):
+        self.keyframe_seconds = keyframe_seconds
+        self.state = None
+        self.last_keyframe = None
+        self.pending = None
+
+    def keyframe_due(self, now):
+        return (
+            self.state is None
+            or self.last_keyframe is None
+            or now - self.last_keyframe >= self.keyframe_seconds
+        )
+
+    def filter(self, table, now=None):
+        """
+        Reduce a decoded snapshot to the rows that changed since the previous
+        poll, returning (table, is_keyframe)
+
+        The tracked state only moves forward on ``commit``, once the returned
+        rows have been written.
+        """
+
+        now = time.monotonic() if now is None else now
+        current = latest_per_vehicle(table)
+
+        keyframe = self.keyframe_due(now)
+        if not keyframe:
+            table = table.filter(changed_rows(table, self.state))
+
+        if self.state is None:
+            state = current
+        else:
+            retained = self.state.filter(
+                pc.invert(pc.is_in(self.state["vehicle_id"], value_set=current["vehicle_id"]))
+            )
+            state = pa.concat_tables([retained, current]).combine_chunks()
+
+        self.pending = (state, now if keyframe else self.last_keyframe)
+        return table, keyframe
+
+    def commit(self):
+        """
+        Make the state of the last filtered snapshot the reference for the next
+        """
+
+        if self.pending is not None:
+            self.state, self.last_keyframe = self.pending
+            self.pending = None
+
+
+_trackers = {}
+
+
+def tracker_for(stage, keyframe_seconds=DEFAULT_KEYFRAME_SECONDS):
+    """
+    Tracker of ``stage``, kept for the lifetime of the container
+    """
+
+    tracker = _trackers.get(stage)
+    if tracker is None:
+        tracker = _trackers[stage] = VehicleTracker(keyframe_seconds)
+    tracker.keyframe_seconds = keyframe_seconds
+    return tracker
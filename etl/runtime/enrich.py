@@ -0,0 +1,172 @@
+"""
+Vectorized enrichment of decoded vehicle positions.
+
+Geohash strings and WKB point geometry are computed with NumPy directly on
+the latitude/longitude column buffers, so no Python float is materialized
+per row. Rows without a position get a null geohash and a null geometry.
+"""
+
+import numpy as np
+import pyarrow as pa
+
+import geoarrow.pyarrow as ga
+
+from metrics import span
+from spatial import cluster_positions, geohash_bits
+
+DEFAULT_GEOHASH_PRECISION = 7
+MAX_GEOHASH_PRECISION = 12
+
+GEOHASH_ALPHABET = np.frombuffer(b"0123456789bcdefghjkmnpqrstuvwxyz", dtype=np.uint8)
+
+# little endian byte order flag, uint32 geometry type (1 = Point), x, y
+WKB_POINT_DTYPE = np.dtype(
+    [("byte_order", "u1"), ("geometry_type", "<u4"), ("x", "<f8"), ("y", "<f8")]
+)
+
+# no explicit crs: GeoParquet readers default to OGC:CRS84, and omitting it
+# keeps the geometry type identical to the files already in the bucket
+GEOMETRY_TYPE = ga.wkb()
+
+
+def _as_array(values):
+    if isinstance(values, pa.ChunkedArray):
+        return values.combine_chunks()
+    return values
+
+
+def _validity_buffer(valid):
+    """
+    Pack a boolean numpy mask into an Arrow validity bitmap, or None when
+    every slot is valid
+    """
+
+    if valid.all():
+        return None
+    return pa.py_buffer(np.packbits(valid, bitorder="little"))
+
+
+def _float_buffers(values):
+    """
+    Zero-copy numpy views of the values and validity of a float Arrow array
+
+    Reading the buffers directly keeps pyarrow.compute out of the import
+    graph. Values in null slots are undefined.
+    """
+
+    count = len(values)
+    offset = values.offset
+    validity, data = values.buffers()
+
+    dtype = np.dtype(values.type.to_pandas_dtype())
+    data = np.frombuffer(data, dtype=dtype, count=offset + count)[offset:]
+
+    if validity is None or not values.null_count:
+        valid = np.ones(count, dtype=np.bool_)
+    else:
+        bits = np.unpackbits(
+            np.frombuffer(validity, dtype=np.uint8), count=offset + count, bitorder="little"
+        )
+        valid = bits[offset:].view(np.bool_)
+
+    return data.astype(np.float64, copy=False), valid
+
+
+def geohash(latitude, longitude, precision=DEFAULT_GEOHASH_PRECISION):
+    """
+    Encode latitude/longitude arrays into a geohash ``pa.string()`` array
+
+    Null, non-finite or out of range coordinates produce a null geohash.
+    """
+
+    if not 1 <= precision <= MAX_GEOHASH_PRECISION:
+        raise ValueError(
+            f"Geohash precision must be between 1 and {MAX_GEOHASH_PRECISION}, "
+            f"but got {precision}."
+        )
+
+    lat, lat_valid = _float_buffers(_as_array(latitude))
+    lon, lon_valid = _float_buffers(_as_array(longitude))
+    count = len(lat)
+
+    valid = lat_valid & lon_valid
+    with np.errstate(invalid="ignore"):
+        valid &= (np.abs(lat) <= 90.0) & (np.abs(lon) <= 180.0)
+
+    code = geohash_bits(np.where(valid, lon, 0.0), np.where(valid, lat, 0.0), 5 * precision)
+
+    shifts = np.uint64(5) * np.arange(precision - 1, -1, -1, dtype=np.uint64)
+    characters = GEOHASH_ALPHABET[(code[:, None] >> shifts) & np.uint64(31)]
+
+    offsets = np.arange(0, (count + 1) * precision, precision, dtype=np.int32)
+
+    return pa.Array.from_buffers(
+        pa.string(),
+        count,
+        [
+            _validity_buffer(valid),
+            pa.py_buffer(offsets),
+            pa.py_buffer(np.ascontiguousarray(characters)),
+        ],
+    )
+
+
+def wkb_points(latitude, longitude):
+    """
+    Build a geoarrow WKB point array from latitude/longitude arrays
+
+    Rows where either coordinate is null produce a null geometry.
+    """
+
+    lat, lat_valid = _float_buffers(_as_array(latitude))
+    lon, lon_valid = _float_buffers(_as_array(longitude))
+    count = len(lat)
+    valid = lat_valid & lon_valid
+
+    points = np.empty(count, dtype=WKB_POINT_DTYPE)
+    points["byte_order"] = 1
+    points["geometry_type"] = 1
+    points["x"] = np.where(valid, lon, 0.0)
+    points["y"] = np.where(valid, lat, 0.0)
+
+    offsets = np.arange(
+        0, (count + 1) * WKB_POINT_DTYPE.itemsize, WKB_POINT_DTYPE.itemsize, dtype=np.int32
+    )
+
+    storage = pa.Array.from_buffers(
+        pa.binary(),
+        count,
+        [
+            _validity_buffer(valid),
+            pa.py_buffer(offsets),
+            pa.py_buffer(points.view(np.uint8)),
+        ],
+    )
+    return GEOMETRY_TYPE.wrap_array(storage)
+
+
+def enrich_positions(pa_table, precision=DEFAULT_GEOHASH_PRECISION, spatial_sort=None):
+    """
+    Append ``geohash`` and ``geometry`` columns and drop latitude/longitude
+
+    With ``spatial_sort`` ("hilbert" or "geohash") the rows are first ordered
+    along that curve, see ``spatial.cluster_positions``.
+    """
+
+    if spatial_sort:
+        with span("cluster"):
+            pa_table = cluster_positions(pa_table, spatial_sort)
+
+    latitude = pa_table["latitude"]
+    longitude = pa_table["longitude"]
+
+    with span("geohash"):
+        # neighbouring vehicles share cells, so the geohash is dictionary
+        # encoded like the identifiers
+        geohashes = geohash(latitude, longitude, precision=precision).dictionary_encode()
+    with span("wkb"):
+        geometry = wkb_points(latitude, longitude)
+
+    pa_table = pa_table.append_column(pa.field("geohash", geohashes.type), geohashes)
+    pa_table = pa_table.append_column(pa.field("geometry", geometry.type), geometry)
+    return pa_table.drop_columns(["latitude", "longitude"])
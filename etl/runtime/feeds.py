@@ -0,0 +1,70 @@
+"""
+Feed definitions for the ETL handler.
+
+A single invocation can ingest several agencies. Feeds come from the
+invocation event (``{"feeds": [...]}``), the ``FEEDS`` environment variable
+(a JSON list) or, for single-agency deployments, the legacy
+``VEH_POSITION_URL``/``TRIP_UPDATE_URL``/``TIMEZONE``/``STAGE``/``API_KEY*``
+variables.
+"""
+
+import json
+import os
+from dataclasses import dataclass, field
+
+
+@dataclass(frozen=True)
+class Feed:
+    """
+    A GTFS realtime vehicle position feed, the agency's optional trip update
+    feed and where their output goes
+    """
+
+    stage: str
+    url: str
+    timezone: str
+    headers: dict = field(default_factory=dict, hash=False)
+    trip_updates_url: str | None = None
+
+    @classmethod
+    def from_dict(cls, definition):
+        headers = dict(definition.get("headers") or {})
+        if definition.get("api_key") and definition.get("api_key_header"):
+            headers[definition["api_key_header"]] = definition["api_key"]
+        return cls(
+            stage=definition["stage"],
+            url=definition["url"],
+            timezone=definition["timezone"],
+            headers=headers,
+            trip_updates_url=definition.get("trip_updates_url"),
+        )
+
+
+def feed_from_environ():
+    headers = {}
+    api_key = os.environ.get("API_KEY")
+    api_key_header = os.environ.get("API_KEY_HEADER")
+    if api_key and api_key_header:
+        headers[api_key_header] = api_key
+
+    return Feed(
+        stage=os.environ.get("STAGE"),
+        url=os.environ.get("VEH_POSITION_URL"),
+        timezone=os.environ.get("TIMEZONE"),
+        headers=headers,
+        trip_updates_url=os.environ.get("TRIP_UPDATE_URL") or None,
+    )
+
+
+def load_feeds(event):
+    """
+    Resolve the list of feeds to ingest for an invocation
+    """
+
+    definitions = (event or {}).get("feeds")
+    if definitions is None and os.environ.get("FEEDS"):
+        definitions = json.loads(os.environ["FEEDS"])
+
+    if definitions:
+        return [Feed.from_dict(definition) for definition in definitions]
+    return [feed_from_environ()]
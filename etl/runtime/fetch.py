@@ -0,0 +1,328 @@
+"""
+HTTP fetching of GTFS realtime feeds over a pooled session.
+
+Connections are kept alive across feeds and warm invocations. The latency
+of recent downloads of every url is tracked, and each attempt times out
+after a multiple of their 95th percentile instead of a fixed 5 s. When the
+first attempt is still running at that percentile a hedged second request is
+sent and whichever answers first wins; transport errors and 5xx/429
+responses are retried. Everything runs under an optional overall deadline
+(e.g. the Lambda's remaining time), and the timing of every attempt is
+reported with the result.
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+
+import requests
+from requests.adapters import HTTPAdapter
+
+FETCH_TIMEOUT_SECONDS = 5
+
+# one keep-alive connection pool per host, shared by the worker threads
+POOL_MAXSIZE = 16
+
+# recent download times kept per url, and how many are needed to adapt
+LATENCY_WINDOW = 50
+MIN_LATENCY_SAMPLES = 5
+HEDGE_PERCENTILE = 95
+
+# an attempt times out after this multiple of the percentile, within
+# [MIN_TIMEOUT_SECONDS, FETCH_TIMEOUT_SECONDS]
+TIMEOUT_MULTIPLIER = 3.0
+MIN_TIMEOUT_SECONDS = 1.0
+
+# first request, hedge and retries together
+MAX_ATTEMPTS = 3
+
+_session = None
+_executor = None
+_executor_lock = threading.Lock()
+
+
+@dataclass
+class FetchAttempt:
+    """Timing of one request of a download, in seconds since it began."""
+
+    number: int
+    reason: str
+    started: float
+    seconds: float | None = None
+    status: int | None = None
+    outcome: str = "pending"
+    error: str | None = None
+
+
+@dataclass
+class FetchResult:
+    """
+    Body and validators of a feed download; content is None on a 304
+
+    Streamed downloads leave content unset and carry the open response, whose
+    body the caller reads and closes.
+    """
+
+    content: bytes | None
+    etag: str | None = None
+    last_modified: str | None = None
+    stream: requests.Response | None = None
+    attempts: list = field(default_factory=list)
+
+    @property
+    def not_modified(self):
+        return self.content is None and self.stream is None
+
+
+class LatencyTracker:
+    """Recent download times per url, kept across warm invocations."""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, url, seconds):
+        with self.lock:
+            self.samples.setdefault(url, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, url, percentile=HEDGE_PERCENTILE):
+        """
+        ``percentile`` of the recent download times of ``url``, None until
+        MIN_LATENCY_SAMPLES were recorded
+        """
+
+        with self.lock:
+            samples = sorted(self.samples.get(url, ()))
+        if len(samples) < MIN_LATENCY_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+
+latencies = LatencyTracker()
+
+
+def get_session():
+    """
+    Session reused across feeds and across warm invocations
+    """
+
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_MAXSIZE, pool_maxsize=POOL_MAXSIZE)
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+    return _session
+
+
+def reset_session():
+    """
+    Drop the pooled connections, e.g. after a SnapStart restore
+    """
+
+    global _session
+    _session = None
+    return get_session()
+
+
+def _attempt_executor():
+    # attempts never submit further work, so a shared pool can't deadlock
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=2 * POOL_MAXSIZE, thread_name_prefix="fetch"
+            )
+    return _executor
+
+
+def conditional_headers(feed, state=None):
+    """
+    Request headers for ``feed``, with If-None-Match/If-Modified-Since taken
+    from the validators of the last processed download
+    """
+
+    headers = dict(feed.headers)
+    if state is not None:
+        if state.etag:
+            headers["If-None-Match"] = state.etag
+        if state.last_modified:
+            headers["If-Modified-Since"] = state.last_modified
+    return headers
+
+
+def attempt_timeout(url, timeout=FETCH_TIMEOUT_SECONDS):
+    """
+    (timeout of one attempt, delay before hedging or None) for ``url`` from
+    its recent download times
+    """
+
+    p95 = latencies.percentile(url)
+    if p95 is None:
+        return timeout, None
+    return min(timeout, max(MIN_TIMEOUT_SECONDS, p95 * TIMEOUT_MULTIPLIER)), p95
+
+
+def _get(url, headers, timeout, stream):
+    """
+    One request; the body is read unless ``stream``, errors raise
+    """
+
+    response = get_session().get(url, timeout=timeout, headers=headers, stream=stream)
+    if response.status_code == 304:
+        response.close()
+        return response
+    try:
+        response.raise_for_status()
+        if not stream:
+            # read the body within the attempt, so it is part of its timing
+            response.content
+    except requests.RequestException:
+        response.close()
+        raise
+    return response
+
+
+def _retryable(exc):
+    """
+    Connection failures, timeouts and 5xx or 429 responses are retried;
+    bad URLs, other client errors and anything else fail fast
+    """
+
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(exc, "response", None)
+    if not isinstance(exc, requests.HTTPError) or response is None:
+        return False
+    return response.status_code >= 500 or response.status_code == 429
+
+
+def _close_abandoned(future):
+    try:
+        future.result().close()
+    except Exception:
+        pass
+
+
+def fetch_feed(
+    feed,
+    state=None,
+    timeout=FETCH_TIMEOUT_SECONDS,
+    url=None,
+    stream=False,
+    deadline=None,
+    hedge=True,
+):
+    """
+    Download the body of ``feed`` (or of another ``url`` of the same agency,
+    sent with the feed's headers), raising ``requests.RequestException`` on
+    transport errors and non 2xx responses
+
+    With ``stream`` only the headers are read and the response is returned
+    open, for the body to be decoded as it arrives. ``deadline`` is a
+    ``time.monotonic()`` value no attempt may run past. Every attempt is
+    reported in ``FetchResult.attempts``, and in the ``attempts`` attribute of
+    the exception raised when they all fail.
+    """
+
+    url = url or feed.url
+    headers = conditional_headers(feed, state) or None
+    per_attempt, hedge_after = attempt_timeout(url, timeout)
+    if not hedge:
+        hedge_after = None
+
+    began = time.monotonic()
+    attempts = []
+    pending = {}
+    errors = []
+
+    def launch(reason):
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            return
+        attempt = FetchAttempt(len(attempts) + 1, reason, time.monotonic() - began)
+        attempts.append(attempt)
+        request_timeout = per_attempt if remaining is None else min(per_attempt, remaining)
+        future = _attempt_executor().submit(_get, url, headers, request_timeout, stream)
+        pending[future] = attempt
+
+    launch("first")
+    winner = None
+    hedged = False
+    given_up = False
+    while pending and winner is None and not given_up:
+        now = time.monotonic()
+        waits = []
+        if deadline is not None:
+            waits.append(deadline - now)
+        if hedge_after is not None and not hedged and len(attempts) < MAX_ATTEMPTS:
+            waits.append(began + hedge_after - now)
+        done, _ = wait(
+            pending, timeout=max(0.0, min(waits)) if waits else None, return_when=FIRST_COMPLETED
+        )
+
+        if not done:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            if not hedged and hedge_after is not None and time.monotonic() >= began + hedge_after:
+                hedged = True
+                launch("hedge")
+            continue
+
+        for future in done:
+            attempt = pending.pop(future)
+            attempt.seconds = time.monotonic() - began - attempt.started
+            try:
+                response = future.result()
+            except requests.RequestException as exc:
+                attempt.outcome = "error"
+                attempt.error = str(exc)
+                attempt.status = getattr(getattr(exc, "response", None), "status_code", None)
+                if isinstance(exc, requests.Timeout):
+                    latencies.record(url, attempt.seconds)
+                errors.append(exc)
+                # the rest of ``done`` is still handled, so a response that
+                # arrived with the error is used or closed rather than leaked
+                if not _retryable(exc):
+                    given_up = True
+                elif not pending and not given_up and len(attempts) < MAX_ATTEMPTS:
+                    launch("retry")
+                continue
+
+            attempt.status = response.status_code
+            if winner is None:
+                attempt.outcome = "ok"
+                latencies.record(url, attempt.seconds)
+                winner = response
+            else:
+                attempt.outcome = "abandoned"
+                response.close()
+
+    # slower attempts still in flight are closed whenever they finish
+    for future, attempt in pending.items():
+        attempt.outcome = "abandoned"
+        future.add_done_callback(_close_abandoned)
+
+    if winner is None:
+        if errors:
+            exc = errors[-1]
+        else:
+            exc = requests.Timeout(f"Fetch deadline exceeded for {url}")
+        exc.attempts = attempts
+        raise exc
+
+    if winner.status_code == 304:
+        return FetchResult(
+            None, etag=state.etag, last_modified=state.last_modified, attempts=attempts
+        )
+
+    etag = winner.headers.get("ETag")
+    last_modified = winner.headers.get("Last-Modified")
+    if stream:
+        return FetchResult(
+            None, etag=etag, last_modified=last_modified, stream=winner, attempts=attempts
+        )
+    return FetchResult(winner.content, etag=etag, last_modified=last_modified, attempts=attempts)
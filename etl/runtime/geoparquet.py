@@ -0,0 +1,56 @@
+"""
+In-memory GeoParquet (and plain Parquet) serialization, plus the incremental
+writer used when decoding feeds as a stream.
+"""
+
+import io
+
+from geoarrow.rust.io import GeoParquetWriter
+from geoarrow.rust.io.enums import GeoParquetEncoding
+
+# zstd level 1 writes about as fast as snappy and raw position files come out
+# around 30% smaller; version 1 pages are slightly smaller and faster to write
+# for these few thousand row files and readable everywhere
+POSITIONS_COMPRESSION = "zstd(1)"
+POSITIONS_WRITER_VERSION = "parquet_1_0"
+
+
+def geoparquet_writer(file, schema, compression=POSITIONS_COMPRESSION):
+    """
+    Incremental GeoParquet writer over a binary file object, fed with
+    ``write_batch``/``write_table`` and finished with ``close``
+    """
+
+    return GeoParquetWriter(
+        file,
+        schema,
+        encoding=GeoParquetEncoding.WKB,
+        compression=compression,
+        writer_version=POSITIONS_WRITER_VERSION,
+        generate_covering=True,
+    )
+
+
+def write_geoparquet(pa_table, compression=POSITIONS_COMPRESSION):
+    """
+    Serialize ``pa_table`` to GeoParquet bytes without touching the filesystem
+    """
+
+    buffer = io.BytesIO()
+    writer = geoparquet_writer(buffer, pa_table.schema, compression)
+    writer.write_table(pa_table)
+    writer.close()
+    return buffer.getvalue()
+
+
+def write_parquet(pa_table, compression="snappy"):
+    """
+    Serialize a table without geometry, e.g. trip updates, to Parquet bytes
+    """
+
+    # only trip update feeds need it, keep it out of the vehicle position path
+    import pyarrow.parquet as pq
+
+    buffer = io.BytesIO()
+    pq.write_table(pa_table, buffer, compression=compression)
+    return buffer.getvalue()
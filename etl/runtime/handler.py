@@ -1,169 +1,622 @@
 import logging
 import os
-import json
-import array
-
-import boto3
-from botocore.exceptions import ClientError
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack, nullcontext
+from dataclasses import asdict
 
 import requests
 from google.transit import gtfs_realtime_pb2
 from zoneinfo import ZoneInfo
 
-import pyarrow as pa
-
-import geoarrow.pyarrow as ga
-
-from geoarrow.rust.io import GeoParquetWriter
-from geoarrow.rust.io.enums import GeoParquetEncoding
-
-import pygeohash as pgh
+from archive import RawArchive
+from decoder import decode_vehicle_positions, position_schema
+from enrich import DEFAULT_GEOHASH_PRECISION, enrich_positions
+from feed_state import (
+    TRIP_UPDATES,
+    VEHICLE_POSITIONS,
+    FeedState,
+    forget_states,
+    state_store_for,
+    unchanged_reason,
+)
+from feeds import load_feeds
+from fetch import fetch_feed, get_session, reset_session
+from geoparquet import write_geoparquet, write_parquet
+from ingest import (
+    archive_body,
+    check_unchanged,
+    decode_feed,
+    default_sink_uri,
+    header_time,
+    mark_late_days,
+    positions_object_key,
+    trip_updates_object_key,
+)
+from metrics import DEFAULT_NAMESPACE, Metrics, count, span
+from partitioning import (
+    DEFAULT_EVENT_TIME_WINDOW,
+    check_geohash_precision,
+    event_time_partitioning,
+    event_time_window,
+    parse_partitioning,
+    split_partitions,
+)
+from profiling import parse_modes, profiled, sampled
+from sinks import sink_from_uri
+from spatial import SPATIAL_SORTS
+from stream import STREAM_BATCH_ROWS, STREAM_CHUNK_BYTES, stream_vehicle_positions
+from trip_updates import decode_trip_updates, trip_update_schema
 
 import datetime as dt
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-s3 = boto3.client("s3", region_name="us-west-2")
-logger.info(f"loaded s3 client")
+# time left after the downloads for decoding, writing and returning
+FETCH_RESERVE_SECONDS = 3.0
+
+
+def process_feed(
+    feed,
+    fetched,
+    sink,
+    geohash_precision,
+    state_store,
+    delta=None,
+    spatial_sort=None,
+    partitioning=(),
+    event_time=True,
+    archive=None,
+    window=DEFAULT_EVENT_TIME_WINDOW,
+):
+    """
+    Decode, enrich and write one downloaded feed body, one file per
+    partition: per day (and ``partitioning`` keys) of the vehicle timestamps
+    with ``event_time``, else of the poll; vehicle timestamps outside
+    ``window`` around the poll count as the poll's
+
+    Feeds identical to the last one written for the stage are skipped before
+    decoding. New bodies are added to the raw ``archive``, if any, before
+    they are decoded.
+    """
 
+    with span("check"):
+        reason, state = check_unchanged(feed, fetched, state_store.load(feed.stage))
+    if reason:
+        logger.info("Feed for %s unchanged (%s); skipping", feed.stage, reason)
+        return {"stage": feed.stage, "status": "skipped", "reason": reason}
 
-def handler(event, context):
+    if archive is not None:
+        with span("archive"):
+            archive_body(archive, feed, "positions", fetched.content)
+
+    pa_table, keyframe = decode_feed(
+        feed, fetched.content, geohash_precision, delta, spatial_sort
+    )
+
+    if not pa_table.num_rows and keyframe:
+        logger.info("No vehicle position records to process; skipping parquet upload")
+        return {"stage": feed.stage, "status": "empty", "records": 0}
+
+    object_keys = []
+    size = 0
+    if pa_table.num_rows:
+        now = dt.datetime.now(tz=ZoneInfo(feed.timezone))
+        with span("partition"):
+            parts = split_partitions(
+                pa_table,
+                partitioning,
+                now,
+                event_time=event_time,
+                fallback=header_time(feed, state.header_timestamp),
+                window=window,
+            )
+        for partition, part in parts:
+            with span("write"):
+                data = write_geoparquet(part)
+
+            logger.info(f"serialized {part.num_rows} rows to {len(data)} bytes of parquet")
+
+            object_key = positions_object_key(
+                feed.stage, now, delta=not keyframe, partition=partition
+            )
+
+            logger.info("Uploading %s", sink.uri(object_key))
+            with span("upload"):
+                sink.put(object_key, data)
+            object_keys.append(object_key)
+            size += len(data)
+        mark_late_days(sink, feed.stage, "positions", [partition for partition, _ in parts], now)
+    else:
+        logger.info("No vehicle reports changed; skipping parquet upload")
+
+    if delta is not None:
+        delta.commit()
+    state_store.save(feed.stage, state)
+
+    return {
+        "stage": feed.stage,
+        "status": "ok",
+        "records": pa_table.num_rows,
+        "key": object_keys[0] if object_keys else None,
+        "keys": object_keys,
+        "bytes": size,
+        "keyframe": keyframe,
+    }
+
+
+def process_feed_stream(
+    feed,
+    fetched,
+    sink,
+    geohash_precision,
+    state_store,
+    batch_rows,
+    spatial_sort=None,
+    partitioning=(),
+    event_time=True,
+    window=DEFAULT_EVENT_TIME_WINDOW,
+    archive=None,
+):
     """
-    This saves GTFS vehicle position data to S3 bucket
+    Decode and write one feed body while it downloads, in bounded memory
+
+    The GeoParquet file of each partition is spooled to a temporary file
+    batch by batch, and with an ``archive`` so is the body, which is added
+    to the archive once it is known to be new. A header timestamp that didn't move forward stops the
+    download right after the header; a body identical to the last one is only
+    recognized once it has been read, and its output is dropped.
     """
 
-    position_url = os.environ.get("VEH_POSITION_URL")
-    timezone = os.environ.get("TIMEZONE")
-    destination_bucket = os.environ.get("DESTINATION_BUCKET")
-    city_name = os.environ.get("STAGE")
-    api_key = os.environ.get("API_KEY")
-    api_key_header = os.environ.get("API_KEY_HEADER")
+    previous = state_store.load(feed.stage)
+    now = dt.datetime.now(tz=ZoneInfo(feed.timezone))
+    # header time of the feed, for rows without a timestamp
+    fallback = None
+
+    def header_changed(header):
+        nonlocal fallback
+        timestamp = header.timestamp if header.HasField("timestamp") else None
+        fallback = header_time(feed, timestamp)
+        return unchanged_reason(previous, None, timestamp) is None
+
+    def partitions(pa_table):
+        return split_partitions(
+            pa_table, partitioning, now, event_time=event_time, fallback=fallback, window=window
+        )
+
+    with fetched.stream as response, ExitStack() as spooled:
+        outputs = {}
+        body = spooled.enter_context(tempfile.TemporaryFile()) if archive is not None else None
+
+        def output(partition):
+            outputs[partition] = spooled.enter_context(tempfile.TemporaryFile())
+            return outputs[partition]
+
+        with span("stream"):
+            streamed = stream_vehicle_positions(
+                response.iter_content(STREAM_CHUNK_BYTES),
+                output,
+                feed.timezone,
+                geohash_precision,
+                batch_rows,
+                on_header=header_changed,
+                spatial_sort=spatial_sort,
+                partitions=partitions,
+                tee=body,
+            )
+        count("bytes_in", streamed.bytes, "Bytes")
 
-    feed = gtfs_realtime_pb2.FeedMessage()
-    try:
-        if not api_key_header or not api_key:
-            response = requests.get(position_url, timeout=5)
+        if streamed.digest is None:
+            reason = "same-header-timestamp"
         else:
-            response = requests.get(position_url, timeout=5, headers={api_key_header: api_key})
-        response.raise_for_status()
-    except requests.RequestException as exc:
-        logger.exception("Failed to fetch vehicle positions from %s", position_url)
-        raise
-
-    feed.ParseFromString(response.content)
-
-    records = []
-    for entity in feed.entity:
-        if entity.HasField("vehicle"):
-            v = entity.vehicle
-            records.append(
-                {
-                    # tripid
-                    "trip_id": v.trip.trip_id if v.HasField("trip") else None,
-                    "route_id": v.trip.route_id if v.HasField("trip") else None,
-                    "direction_id": v.trip.route_id if v.HasField("trip") else None,
-                    # vehicle
-                    "vehicle_id": v.vehicle.id if v.HasField("vehicle") else None,
-                    # position
-                    "latitude": v.position.latitude if v.HasField("position") else None,
-                    "longitude": v.position.longitude
-                    if v.HasField("position")
-                    else None,
-                    "bearing": v.position.bearing if v.HasField("position") else None,
-                    "speed": v.position.speed if v.HasField("position") else None,
-                    # timestamp
-                    "timestamp": v.timestamp if v.HasField("timestamp") else None,
-                }
-            )
+            reason = unchanged_reason(previous, streamed.digest, streamed.header_timestamp)
+        if reason:
+            logger.info("Feed for %s unchanged (%s); skipping", feed.stage, reason)
+            return {"stage": feed.stage, "status": "skipped", "reason": reason}
+
+        if archive is not None:
+            with span("archive"):
+                archive_body(archive, feed, "positions", body)
+
+        logger.info(
+            f"Streamed {streamed.rows} vehicle position records for {feed.stage} "
+            f"in {streamed.batches} batches"
+        )
+        if not streamed.rows:
+            logger.info("No vehicle position records to process; skipping parquet upload")
+            return {"stage": feed.stage, "status": "empty", "records": 0}
+
+        object_keys = []
+        size = 0
+        for partition in streamed.partitions:
+            output = outputs[partition]
+            output_size = output.tell()
+            output.seek(0)
+            object_key = positions_object_key(feed.stage, now, partition=partition)
+            logger.info("Uploading %s (%d bytes)", sink.uri(object_key), output_size)
+            with span("upload"):
+                sink.put_file(object_key, output)
+            object_keys.append(object_key)
+            size += output_size
+        mark_late_days(sink, feed.stage, "positions", streamed.partitions, now)
+
+    state_store.save(
+        feed.stage,
+        FeedState(
+            etag=fetched.etag,
+            last_modified=fetched.last_modified,
+            header_timestamp=streamed.header_timestamp,
+            digest=streamed.digest,
+        ),
+    )
 
-    logger.info(f"Discovered {len(records)} vehicle position records")
+    return {
+        "stage": feed.stage,
+        "status": "ok",
+        "records": streamed.rows,
+        "key": object_keys[0],
+        "keys": object_keys,
+        "bytes": size,
+        "keyframe": True,
+    }
 
-    if not records:
-        logger.info("No vehicle position records to process; skipping parquet upload")
-        return {"records": 0}
-
-    schema = pa.schema(
-        [
-            pa.field("trip_id", pa.string()),
-            pa.field("route_id", pa.string()),
-            pa.field("direction_id", pa.string()),
-            pa.field("vehicle_id", pa.string()),
-            pa.field("latitude", pa.float64()),
-            pa.field("longitude", pa.float64()),
-            pa.field("bearing", pa.float64()),
-            pa.field("speed", pa.float64()),
-            pa.field("timestamp", pa.int64()),
-        ],
-    )
 
-    pa_table = pa.Table.from_pylist(records, schema=schema)
+def process_trip_updates(feed, fetched, sink, state_store, archive=None):
+    """
+    Decode and write one downloaded trip updates body, exploded to one row per
+    stop time update
+    """
 
-    # parse timestamp
+    previous = state_store.load(feed.stage, TRIP_UPDATES)
+    reason, state = check_unchanged(feed, fetched, previous)
+    if reason:
+        logger.info("Trip updates for %s unchanged (%s); skipping", feed.stage, reason)
+        return {"stage": feed.stage, "status": "skipped", "reason": reason}
 
-    parsed_time = pa.array(
-        [
-            dt.datetime.fromtimestamp(t, tz=ZoneInfo(timezone))
-            for t in pa_table["timestamp"].to_pylist()
-        ],
-        type=pa.timestamp("ns", tz=timezone),
-    )
+    if archive is not None:
+        with span("archive"):
+            archive_body(archive, feed, "trip_updates", fetched.content)
+
+    with span("parse"):
+        message = gtfs_realtime_pb2.FeedMessage()
+        message.ParseFromString(fetched.content)
+    with span("decode"):
+        pa_table = decode_trip_updates(message, feed.timezone)
+
+    logger.info(f"Discovered {pa_table.num_rows} stop time updates for {feed.stage}")
 
-    pa_table = pa_table.set_column(
-        pa_table.schema.get_field_index("timestamp"), "timestamp", parsed_time
+    if not pa_table.num_rows:
+        logger.info("No stop time updates to process; skipping parquet upload")
+        return {"stage": feed.stage, "status": "empty", "records": 0}
+
+    with span("write"):
+        data = write_parquet(pa_table)
+    object_key = trip_updates_object_key(
+        feed.stage, dt.datetime.now(tz=ZoneInfo(feed.timezone))
     )
 
-    # geohash
+    logger.info("Uploading %s", sink.uri(object_key))
+    with span("upload"):
+        sink.put(object_key, data)
+    state_store.save(feed.stage, state, kind=TRIP_UPDATES)
 
-    geohash_field = pa.field("geohash", pa.string())
+    return {
+        "stage": feed.stage,
+        "status": "ok",
+        "records": pa_table.num_rows,
+        "key": object_key,
+        "bytes": len(data),
+    }
 
-    latitudes = pa_table["latitude"].to_pylist()
-    longitudes = pa_table["longitude"].to_pylist()
 
-    geohashes = [
-        pgh.encode(lat, lon, precision=7) for lat, lon in zip(latitudes, longitudes)
-    ]
+def fetch_deadline(context, reserve=FETCH_RESERVE_SECONDS):
+    """
+    ``time.monotonic()`` value the downloads must finish by, leaving
+    ``reserve`` seconds of the invocation to process them; None without a
+    Lambda context
+    """
 
-    pa_table = pa_table.append_column(geohash_field, pa.array(geohashes))
+    if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+        return None
+    remaining = context.get_remaining_time_in_millis() / 1000
+    # never less than a second, a nearly spent invocation still tries once
+    return time.monotonic() + max(1.0, remaining - reserve)
 
-    # geometry
 
-    geom_field = geom_field = pa.field(
-        "geometry", ga.wkb(), metadata={b"ARROW:extension:name": b"geoarrow.wkb"}
-    )
+def attempt_report(attempts):
+    """
+    JSON friendly timing of the attempts of a download, logged when it needed
+    more than one
+    """
 
-    points = ga.point().from_geobuffers(
-        None, array.array("d", longitudes), array.array("d", latitudes)
-    )
+    report = []
+    for attempt in attempts:
+        attempt = asdict(attempt)
+        for name in ("started", "seconds"):
+            if attempt[name] is not None:
+                attempt[name] = round(attempt[name], 4)
+        report.append(attempt)
+    if len(report) > 1:
+        logger.info(
+            "Fetch attempts: %s",
+            ", ".join(
+                f"#{a['number']} {a['reason']} {a['outcome']}"
+                + (f" {a['seconds']:.3f}s" if a["seconds"] is not None else "")
+                for a in report
+            ),
+        )
+    return report
+
+
+def record_feed(metrics, result, attempts):
+    """
+    Add the download and the outcome of one feed to its metrics and emit them
+    """
 
-    wkb_array = ga.as_wkb(ga.with_crs(points, ga.OGC_CRS84))
+    finished = [a.started + a.seconds for a in attempts if a.seconds is not None]
+    if finished:
+        metrics.put("fetch_ms", max(finished) * 1e3, "Milliseconds")
+    metrics.count("fetch_attempts", len(attempts))
+    metrics.count("fetch_hedges", sum(a.reason == "hedge" for a in attempts))
+    metrics.count("errors", int(result["status"] == "error"))
+    metrics.count("skipped", int(result["status"] == "skipped"))
+    metrics.count("rows", result.get("records", 0))
+    keys = result.get("keys") or ([result["key"]] if result.get("key") else [])
+    metrics.count("objects_written", len(keys))
+
+    bytes_in = metrics.values.get("bytes_in")
+    bytes_out = result.get("bytes", 0)
+    metrics.count("bytes_out", bytes_out, "Bytes")
+    if bytes_in and bytes_out:
+        metrics.put("compression_ratio", bytes_in / bytes_out)
+
+    metrics.set_property("status", result["status"])
+    if "reason" in result:
+        metrics.set_property("reason", result["reason"])
+    metrics.flush()
 
-    pa_table = pa_table.append_column(geom_field, wkb_array)
-    pa_table = pa_table.drop_columns(['latitude','longitude'])
 
-    output_file = "/tmp/positions.parquet"
+def handler(event, context):
+    """
+    This saves GTFS vehicle position and trip update data to S3 bucket
+
+    Every feed is downloaded concurrently over a pooled session. Each body is
+    decoded and written as soon as it arrives, while the remaining downloads
+    are still in flight, and a failing feed doesn't affect the others. Polls
+    that return a feed already written are reported as skipped.
+
+    Downloads are hedged and retried within the invocation's remaining time
+    (see ``fetch.fetch_feed``), and each feed result lists its attempts.
+    Every feed also emits its stage timings and counters as an EMF record,
+    see ``metrics``, and with PROFILE_SAMPLE_RATE a sample of invocations
+    writes profiles of every feed next to the data, see ``profiling``.
+    """
 
-    writer = GeoParquetWriter(
-        output_file,
-        pa_table.schema,
-        encoding=GeoParquetEncoding.WKB,
-        compression="snappy",
-        generate_covering=True,
+    geohash_precision = int(
+        os.environ.get("GEOHASH_PRECISION") or DEFAULT_GEOHASH_PRECISION
     )
-    writer.write_table(pa_table)
-    writer.close()
 
-    logger.info(f"saved parquet file to {output_file}")
+    delta_mode = os.environ.get("DELTA_MODE", "").lower() in ("1", "true", "yes")
+    if delta_mode:
+        # pulls in pyarrow.compute and the join machinery, so only when used
+        from delta import DEFAULT_KEYFRAME_SECONDS, tracker_for
+
+        keyframe_seconds = int(
+            os.environ.get("DELTA_KEYFRAME_SECONDS") or DEFAULT_KEYFRAME_SECONDS
+        )
+
+    # decode vehicle positions as they download; delta mode needs whole snapshots
+    stream_decode = os.environ.get("STREAM_DECODE", "").lower() in ("1", "true", "yes")
+    if stream_decode and delta_mode:
+        logger.warning("STREAM_DECODE is ignored in delta mode")
+        stream_decode = False
+    batch_rows = int(os.environ.get("STREAM_BATCH_ROWS") or STREAM_BATCH_ROWS)
+
+    # keep the raw bodies for replays
+    archive_raw = os.environ.get("ARCHIVE_RAW", "").lower() in ("1", "true", "yes")
+
+    # cluster the rows of each file along a space filling curve
+    spatial_sort = os.environ.get("SPATIAL_SORT", "").lower() or None
+    if spatial_sort not in (None, *SPATIAL_SORTS):
+        raise ValueError(f"SPATIAL_SORT must be one of {SPATIAL_SORTS}, got {spatial_sort!r}")
+
+    # extra hive partition levels of the raw positions below day=
+    partitioning = parse_partitioning(os.environ.get("PARTITION_KEYS"))
+    check_geohash_precision(partitioning, geohash_precision)
+    # partition on the vehicle timestamps rather than the time of the poll
+    event_time = event_time_partitioning(os.environ.get("PARTITION_TIME"))
+    # vehicle timestamps this far from the poll are taken as the poll's
+    window = event_time_window(
+        os.environ.get("MAX_LATENESS_SECONDS"), os.environ.get("MAX_FUTURE_SECONDS")
+    )
 
-    latest_timestamp = dt.datetime.now(tz=ZoneInfo(timezone))
-    object_key = (
-        f"{city_name}/positions_raw/year={latest_timestamp.strftime('%Y')}/"
-        f"month={latest_timestamp.strftime('%m')}/day={latest_timestamp.strftime('%d')}/"
-        f"{latest_timestamp.strftime('%H%M%S')}.parquet"
+    # hedge downloads that run past their recent p95 with a second request
+    hedge = os.environ.get("FETCH_HEDGE", "true").lower() in ("1", "true", "yes")
+    deadline = fetch_deadline(
+        context, float(os.environ.get("FETCH_RESERVE_SECONDS") or FETCH_RESERVE_SECONDS)
     )
+    # empty to emit no metrics
+    namespace = os.environ.get("METRICS_NAMESPACE", DEFAULT_NAMESPACE)
+    # cProfile/tracemalloc dumps of a sample of the invocations
+    profile = sampled(os.environ.get("PROFILE_SAMPLE_RATE"))
+    profile_modes = parse_modes(os.environ.get("PROFILE_MODES"))
+    invocation = getattr(context, "aws_request_id", None) or uuid.uuid4().hex
+    if profile:
+        logger.info("Profiling invocation %s (%s)", invocation, ",".join(profile_modes))
+
+    feeds = load_feeds(event)
+    sink = sink_from_uri(default_sink_uri())
+    state_store = state_store_for(sink)
+    # written at the end of the invocation, one batch per stage and dataset
+    archive = RawArchive(sink) if archive_raw else None
+    jobs = [(feed, VEHICLE_POSITIONS, feed.url) for feed in feeds] + [
+        (feed, TRIP_UPDATES, feed.trip_updates_url) for feed in feeds if feed.trip_updates_url
+    ]
+
+    results = []
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        downloads = {
+            executor.submit(
+                fetch_feed,
+                feed,
+                state_store.load(feed.stage, kind),
+                url=url,
+                stream=stream_decode and kind == VEHICLE_POSITIONS,
+                deadline=deadline,
+                hedge=hedge,
+            ): (feed, kind, url)
+            for feed, kind, url in jobs
+        }
+
+        for download in as_completed(downloads):
+            feed, kind, url = downloads[download]
+            metrics = Metrics(namespace, "etl", Stage=feed.stage, Feed=kind)
+            try:
+                fetched = download.result()
+            except requests.RequestException as exc:
+                logger.exception("Failed to fetch %s from %s", kind, url)
+                attempts = getattr(exc, "attempts", [])
+                results.append(
+                    {
+                        "stage": feed.stage,
+                        "feed": kind,
+                        "status": "error",
+                        "error": str(exc),
+                        "attempts": attempt_report(attempts),
+                    }
+                )
+                record_feed(metrics, results[-1], attempts)
+                continue
+
+            profile_feed = (
+                profiled(
+                    sink.put,
+                    feed.stage,
+                    "etl",
+                    f"{kind}-{invocation}",
+                    dt.datetime.now(tz=ZoneInfo(feed.timezone)),
+                    profile_modes,
+                )
+                if profile
+                else nullcontext()
+            )
+            try:
+                with metrics.activate(), profile_feed:
+                    if fetched.content is not None:
+                        count("bytes_in", len(fetched.content), "Bytes")
+                    if kind == TRIP_UPDATES:
+                        result = process_trip_updates(
+                            feed, fetched, sink, state_store, archive
+                        )
+                    elif fetched.stream is not None:
+                        result = process_feed_stream(
+                            feed,
+                            fetched,
+                            sink,
+                            geohash_precision,
+                            state_store,
+                            batch_rows,
+                            spatial_sort,
+                            partitioning,
+                            event_time,
+                            window,
+                            archive,
+                        )
+                    else:
+                        delta = tracker_for(feed.stage, keyframe_seconds) if delta_mode else None
+                        result = process_feed(
+                            feed,
+                            fetched,
+                            sink,
+                            geohash_precision,
+                            state_store,
+                            delta,
+                            spatial_sort,
+                            partitioning,
+                            event_time,
+                            archive,
+                            window,
+                        )
+            except Exception as exc:
+                logger.exception("Failed to process %s for %s", kind, feed.stage)
+                result = {"stage": feed.stage, "status": "error", "error": str(exc)}
+            results.append({"feed": kind, **result, "attempts": attempt_report(fetched.attempts)})
+            record_feed(metrics, results[-1], fetched.attempts)
+
+    if archive is not None:
+        # the container may be recycled before the next invocation, so
+        # nothing is left in it
+        archive.flush(force=True)
+
+    if all(result["status"] == "error" for result in results):
+        raise RuntimeError(f"All feeds failed: {results}")
+
+    return {
+        "records": sum(result.get("records", 0) for result in results),
+        "skipped": sum(result["status"] == "skipped" for result in results),
+        "feeds": results,
+    }
+
+
+def prime():
+    """
+    Build the per-container objects during the init phase
 
+    Lambda runs init at full CPU outside the 10 s invocation timeout, so the
+    S3 client, HTTP session, schemas, time zones and the lazily initialized
+    parts of pyarrow/geoarrow are set up here rather than on the first poll.
+    """
+
+    get_session()
+
+    state_store = None
+    if os.environ.get("DESTINATION_URI") or os.environ.get("DESTINATION_BUCKET"):
+        state_store = state_store_for(sink_from_uri(default_sink_uri()))
+
+    for feed in load_feeds({}):
+        if not feed.timezone:
+            continue
+        ZoneInfo(feed.timezone)
+        position_schema(feed.timezone)
+        if feed.trip_updates_url:
+            trip_update_schema(feed.timezone)
+        if state_store is not None:
+            state_store.load(feed.stage)
+            if feed.trip_updates_url:
+                state_store.load(feed.stage, TRIP_UPDATES)
+
+    # one row through decode, enrich and serialize warms up the kernels
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.entity.add(id="prime").vehicle.position.latitude = 0.0
+    pa_table = decode_vehicle_positions(message, "UTC")
+    write_geoparquet(enrich_positions(pa_table))
+
+
+def after_restore():
+    """
+    Refresh what a SnapStart snapshot captured at init
+
+    Pooled keep-alive connections are dead after a restore and the cached
+    feed state may be older than what other containers have written since.
+    """
+
+    reset_session()
+    forget_states()
+
+
+if os.environ.get("PRIME_ON_INIT", "true").lower() in ("1", "true", "yes"):
     try:
-        logger.info("Uploading %s to bucket %s", object_key, destination_bucket)
-        s3.upload_file(output_file, destination_bucket, object_key)
-    except ClientError as e:
-        logging.error(e)
+        prime()
+    except Exception:
+        logger.exception("Priming the ETL runtime failed; continuing without it")
+
+try:
+    # only present in Lambda runtimes with SnapStart enabled
+    from snapshot_restore_py import register_after_restore
+
+    register_after_restore(after_restore)
+except ImportError:
+    pass
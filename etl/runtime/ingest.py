@@ -0,0 +1,160 @@
+"""
+The per-body steps of the ETL shared by the Lambda handler, the poller and
+replays: object keys, change detection, archiving and decoding.
+
+Importing it has no side effects, unlike ``handler``, which primes the
+Lambda runtime (S3 client, feed states, a warm-up decode) on import.
+"""
+
+import datetime as dt
+import logging
+import os
+from zoneinfo import ZoneInfo
+
+from google.transit import gtfs_realtime_pb2
+
+from decoder import decode_vehicle_positions, read_feed_header
+from enrich import enrich_positions
+from feed_state import FeedState, content_digest, unchanged_reason
+from metrics import span
+from partitioning import day_partition, late_days, late_marker_key
+
+logger = logging.getLogger()
+
+
+def default_sink_uri():
+    # optional override of the bucket, e.g. file:///tmp/gtfs or memory://
+    return os.environ.get("DESTINATION_URI") or (
+        f"s3://{os.environ.get('DESTINATION_BUCKET')}"
+    )
+
+
+def raw_object_key(city_name, dataset, timestamp, suffix=".parquet", partition=None):
+    day = day_partition(timestamp)
+    name = timestamp.strftime("%H%M%S")
+    if partition is None:
+        partition = day
+    elif not partition.startswith(day):
+        # rows of another day keep the poll date in their name, so they never
+        # replace the file of a poll at the same time of that day
+        name = timestamp.strftime("%Y%m%d-%H%M%S")
+    return f"{city_name}/{dataset}_raw/{partition}{name}{suffix}"
+
+
+def positions_object_key(city_name, timestamp, delta=False, partition=None):
+    """
+    Key of a raw positions file written by the poll at ``timestamp``; delta
+    files are suffixed ``.delta.parquet`` so readers can find the keyframes
+    they apply to. ``partition`` is the partition path from ``year=`` down,
+    see ``partitioning.split_partitions``, by default the poll's day.
+    """
+
+    suffix = ".delta.parquet" if delta else ".parquet"
+    return raw_object_key(city_name, "positions", timestamp, suffix, partition)
+
+
+def mark_late_days(sink, city_name, dataset, partitions, timestamp):
+    """
+    Leave a marker for every day before the poll at ``timestamp`` that it
+    wrote ``partitions`` of, so the compaction revisits those days
+    """
+
+    for label in late_days(partitions, timestamp):
+        sink.put(late_marker_key(city_name, dataset, label, timestamp), b"")
+
+
+def trip_updates_object_key(city_name, timestamp):
+    """
+    Key of a raw trip updates file, one row per stop time update
+    """
+
+    return raw_object_key(city_name, "trip_updates", timestamp)
+
+
+def header_time(feed, header_timestamp):
+    """
+    Feed header timestamp as an aware datetime in the feed's time zone
+    """
+
+    if not header_timestamp:
+        return None
+    return dt.datetime.fromtimestamp(header_timestamp, ZoneInfo(feed.timezone))
+
+
+def check_unchanged(feed, fetched, previous):
+    """
+    Compare a download with the last feed written for its stage
+
+    Returns (reason or None, FeedState of the download). The header timestamp
+    is read from the wire format, so nothing is decoded for unchanged feeds.
+    """
+
+    if fetched.not_modified:
+        return "not-modified", previous
+
+    content = fetched.content
+    digest = content_digest(content)
+    header = read_feed_header(content)
+    header_timestamp = None
+    if header is not None and header.HasField("timestamp"):
+        header_timestamp = header.timestamp
+
+    state = FeedState(
+        etag=fetched.etag,
+        last_modified=fetched.last_modified,
+        header_timestamp=header_timestamp,
+        digest=digest,
+    )
+    return unchanged_reason(previous, digest, header_timestamp), state
+
+
+def archive_body(archive, feed, dataset, content):
+    """
+    Add a new feed body, bytes or a file spooling it, to the raw archive;
+    failing to archive is logged and doesn't stop the body from being
+    processed
+    """
+
+    try:
+        archive.append(feed.stage, dataset, dt.datetime.now(tz=ZoneInfo(feed.timezone)), content)
+    except Exception:
+        logger.exception("Failed to archive %s for %s", dataset, feed.stage)
+
+
+def decode_feed(feed, content, geohash_precision, delta=None, spatial_sort=None):
+    """
+    Decode and enrich one feed body, returning (table, is_keyframe)
+
+    With a ``delta`` VehicleTracker only changed vehicle reports are kept
+    between keyframes; the caller commits the tracker once they are stored.
+    With ``spatial_sort`` the rows are clustered along that curve.
+    """
+
+    with span("parse"):
+        message = gtfs_realtime_pb2.FeedMessage()
+        message.ParseFromString(content)
+
+    with span("decode"):
+        pa_table = decode_vehicle_positions(message, feed.timezone)
+
+    logger.info(f"Discovered {pa_table.num_rows} vehicle position records for {feed.stage}")
+
+    if not pa_table.num_rows:
+        return pa_table, True
+
+    keyframe = True
+    if delta is not None:
+        decoded_rows = pa_table.num_rows
+        with span("delta"):
+            pa_table, keyframe = delta.filter(pa_table)
+        logger.info(
+            f"{'Keyframe' if keyframe else 'Delta'} keeps {pa_table.num_rows} "
+            f"of {decoded_rows} vehicle position records"
+        )
+
+    if pa_table.num_rows:
+        with span("enrich"):
+            pa_table = enrich_positions(
+                pa_table, precision=geohash_precision, spatial_sort=spatial_sort
+            )
+    return pa_table, keyframe
@@ -0,0 +1,252 @@
+"""
+Timing spans and counters emitted as CloudWatch Embedded Metric Format.
+
+A handler creates one ``Metrics`` per unit of work (a feed, a compacted
+dataset), activates it while the work runs and flushes it at the end, which
+emits a single EMF JSON line. CloudWatch turns the lines Lambda writes to
+stdout into metrics, one per span and counter, with the ``Service`` alone
+and with every other dimension (e.g. the agency's ``Stage``) as dimension
+sets, so both the totals and the per-agency hotspots can be graphed.
+
+Code deeper down records into the active set through the module level
+``span`` and ``count``, which do nothing when no set is active, so the
+decoder and the enrichment stay usable without any of this. Spans of the
+same name add up (e.g. over the batches of a streamed feed) and may nest.
+Sets activated on different threads (e.g. days compacted concurrently)
+record apart.
+``MemoryCollector`` keeps the records instead of printing them, for tests.
+Only the standard library is needed; the compaction function ships this
+module next to its handler.
+"""
+
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_NAMESPACE = "GtfsRealtimeEtl"
+
+# spans are reported in milliseconds as "{name}_ms"
+SPAN_UNIT = "Milliseconds"
+
+_active = None
+_local = threading.local()
+_collector = None
+
+
+class EmfCollector:
+    """Writes each record as one JSON line, for the Lambda log agent."""
+
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def emit(self, record):
+        stream = self.stream or sys.stdout
+        stream.write(json.dumps(record, separators=(",", ":")) + "\n")
+        stream.flush()
+
+
+class MemoryCollector:
+    """Keeps the emitted records in memory."""
+
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def values(self, name):
+        """
+        Value of metric ``name`` in every record that has it
+        """
+
+        return [record[name] for record in self.records if name in record]
+
+    def clear(self):
+        self.records.clear()
+
+
+def get_collector():
+    global _collector
+    if _collector is None:
+        _collector = EmfCollector()
+    return _collector
+
+
+def set_collector(collector):
+    """
+    Send the records of every later flush to ``collector``, returning the
+    previous one
+    """
+
+    global _collector
+    previous, _collector = _collector, collector
+    return previous
+
+
+class Metrics:
+    """
+    Spans and counters of one unit of work, emitted as one EMF record
+
+    A false ``namespace`` turns the record into a no-op.
+    """
+
+    def __init__(self, namespace=DEFAULT_NAMESPACE, service=None, **dimensions):
+        self.namespace = namespace
+        self.dimensions = {"Service": service, **dimensions} if service else dimensions
+        self.values = {}
+        self.units = {}
+        self.properties = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, value, unit="Count"):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+            self.units[name] = unit
+
+    def count(self, name, value=1, unit="Count"):
+        self.add(name, value, unit)
+
+    def put(self, name, value, unit="None"):
+        """
+        Set metric ``name`` to ``value`` rather than adding to it, e.g. a ratio
+        """
+
+        with self.lock:
+            self.values[name] = value
+            self.units[name] = unit
+
+    def set_property(self, name, value):
+        """
+        Attach ``value`` to the record without making it a metric
+        """
+
+        self.properties[name] = value
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(f"{name}_ms", (time.perf_counter() - start) * 1e3, SPAN_UNIT)
+
+    def timed(self, name, iterable):
+        """
+        Iterate ``iterable``, adding the time spent producing each item to
+        span ``name``
+        """
+
+        iterator = iter(iterable)
+        while True:
+            with self.span(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    @contextmanager
+    def activate(self):
+        """
+        Make this the set the module level ``span`` and ``count`` record into
+
+        The set is active for the calling thread and, as a process global, for
+        threads without a set of their own, so work Arrow runs on its own
+        threads is recorded too.
+        """
+
+        global _active
+        previous, _active = _active, self
+        previous_local = getattr(_local, "metrics", None)
+        _local.metrics = self
+        try:
+            yield self
+        finally:
+            _active = previous
+            _local.metrics = previous_local
+
+    def record(self):
+        """
+        The EMF record of everything recorded so far
+        """
+
+        names = list(self.dimensions)
+        dimension_sets = [names[:1], names] if len(names) > 1 else [names]
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": dimension_sets,
+                        "Metrics": [
+                            {"Name": name, "Unit": self.units[name]} for name in self.values
+                        ],
+                    }
+                ],
+            },
+            **self.properties,
+            **{name: str(value) for name, value in self.dimensions.items()},
+        }
+        for name, value in self.values.items():
+            record[name] = round(value, 3) if isinstance(value, float) else value
+        return record
+
+    def flush(self, collector=None):
+        """
+        Emit the record and start over; nothing is emitted without a
+        namespace or without metrics
+        """
+
+        with self.lock:
+            empty = not self.values
+        if self.namespace and not empty:
+            (collector or get_collector()).emit(self.record())
+        with self.lock:
+            self.values.clear()
+            self.units.clear()
+        self.properties.clear()
+
+
+def current():
+    """
+    Set of metrics active for the calling thread, if any
+    """
+
+    return getattr(_local, "metrics", None) or _active
+
+
+@contextmanager
+def span(name):
+    """
+    Time the block into the active set of metrics, if any
+    """
+
+    metrics = current()
+    if metrics is None:
+        yield
+        return
+    with metrics.span(name):
+        yield
+
+
+def count(name, value=1, unit="Count"):
+    metrics = current()
+    if metrics is not None:
+        metrics.add(name, value, unit)
+
+
+def timed(name, iterable):
+    """
+    ``iterable`` with the time spent producing its items added to span
+    ``name`` of the set active when iteration starts, if any
+    """
+
+    metrics = current()
+    if metrics is None:
+        yield from iterable
+        return
+    yield from metrics.timed(name, iterable)
+
@@ -0,0 +1,585 @@
+"""
+Configurable secondary hive partitioning of vehicle positions.
+
+Positions are always partitioned by ``year=/month=/day=``. PARTITION_KEYS
+adds more levels below the day, in the given order:
+
+    hour              ``hour=HH`` in the feed's time zone
+    route_bucket:N    ``route_bucket=B``, B = crc32(route_id) % N (default 16)
+    geohashN          ``geohashN=`` the first N characters of the row's geohash
+
+The day and hour are those of each vehicle report's own timestamp (event
+time, PARTITION_TIME=event, the default), or of the poll that fetched it
+with PARTITION_TIME=poll. Event times more than MAX_LATENESS_SECONDS before
+the poll or MAX_FUTURE_SECONDS after it, e.g. of a stuck clock reporting 0,
+are placed at the poll time instead. A poll writing rows of an earlier day
+leaves a marker below ``{stage}/_late/`` naming that day, and the compaction
+revisits the marked days.
+
+e.g. ``PARTITION_KEYS=hour,route_bucket:16,geohash4``. Rows without a route
+or a position go to ``__HIVE_DEFAULT_PARTITION__``, which DuckDB and pyarrow
+read back as null. ``split_partitions`` splits a table into one table per
+partition for the writers, ``partition_prefixes`` turns query filters into
+the minimal list of object prefixes a reader has to scan. Only pyarrow is
+needed, the compaction function ships this module next to its handler
+(together with ``metrics``).
+"""
+
+import datetime as dt
+import re
+import zlib
+from dataclasses import dataclass
+from itertools import groupby
+
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import pyarrow as pa
+
+from metrics import count
+
+HIVE_DEFAULT_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+NANOSECONDS_PER_SECOND = 1_000_000_000
+QUARTER_HOUR_NS = 15 * 60 * NANOSECONDS_PER_SECOND
+
+DEFAULT_ROUTE_BUCKETS = 16
+
+PARTITION_TIMES = ("event", "poll")
+DEFAULT_PARTITION_TIME = "event"
+
+# event times further from the poll than this are placed at the poll time
+DEFAULT_MAX_LATENESS_SECONDS = 24 * 60 * 60
+DEFAULT_MAX_FUTURE_SECONDS = 15 * 60
+DEFAULT_EVENT_TIME_WINDOW = (
+    dt.timedelta(seconds=DEFAULT_MAX_LATENESS_SECONDS),
+    dt.timedelta(seconds=DEFAULT_MAX_FUTURE_SECONDS),
+)
+
+# markers of the earlier days a poll wrote rows to, for the compaction
+LATE_MARKERS = "_late"
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# a bounding box covering more geohash cells than this isn't worth listing
+# one prefix per cell, its geohash level is left unfiltered instead
+GEOHASH_COVER_LIMIT = 256
+
+# raw files are named HHMMSS after the poll time, prefixed with the poll date
+# (YYYYMMDD-HHMMSS) when they hold rows of another day
+RAW_FILE_NAME = re.compile(r"(\d{2})\d{4}(\.delta)?\.parquet$")
+HOUR_SEGMENT = re.compile(r"/hour=([^/]+)/")
+# poll date (of rows of an earlier day) and time in a raw file name
+RAW_POLL_TIME = re.compile(r"(?:(\d{8})-)?(\d{6})(?:\.delta)?\.parquet$")
+DAY_SEGMENTS = re.compile(r"year=(\d{4})/month=(\d{2})/day=(\d{2})/")
+
+
+@dataclass(frozen=True)
+class PartitionKey:
+    """One partition level below ``day=``."""
+
+    name: str
+    kind: str
+    size: int = 0
+
+    @property
+    def type(self):
+        return pa.int32() if self.kind == "route_bucket" else pa.string()
+
+
+def parse_partitioning(spec):
+    """
+    Partition keys of a PARTITION_KEYS value such as
+    ``"hour,route_bucket:16,geohash4"``; an empty value means none
+    """
+
+    keys = []
+    for token in (token.strip() for token in (spec or "").split(",")):
+        if not token:
+            continue
+        if token == "hour":
+            keys.append(PartitionKey("hour", "hour"))
+        elif token.split(":")[0] == "route_bucket":
+            _, _, buckets = token.partition(":")
+            buckets = int(buckets or DEFAULT_ROUTE_BUCKETS)
+            if buckets < 1:
+                raise ValueError(f"route_bucket needs at least one bucket, got {token!r}")
+            keys.append(PartitionKey("route_bucket", "route_bucket", buckets))
+        elif re.fullmatch(r"geohash(\d+)", token):
+            precision = int(token[len("geohash") :])
+            if not 1 <= precision <= 12:
+                raise ValueError(f"Geohash partitions need 1 to 12 characters, got {token!r}")
+            keys.append(PartitionKey(token, "geohash", precision))
+        else:
+            raise ValueError(
+                f"Unknown partition key {token!r}, expected hour, route_bucket[:N] or geohashN"
+            )
+
+    names = [key.name for key in keys]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Partition keys are repeated in {spec!r}")
+    return tuple(keys)
+
+
+def event_time_partitioning(partition_time):
+    """
+    Whether a PARTITION_TIME value partitions on event time
+    """
+
+    partition_time = (partition_time or DEFAULT_PARTITION_TIME).lower()
+    if partition_time not in PARTITION_TIMES:
+        raise ValueError(
+            f"PARTITION_TIME must be one of {PARTITION_TIMES}, got {partition_time!r}"
+        )
+    return partition_time == "event"
+
+
+def event_time_window(max_lateness_seconds=None, max_future_seconds=None):
+    """
+    (max lateness, max future) of MAX_LATENESS_SECONDS and MAX_FUTURE_SECONDS
+    values as timedeltas; empty values mean the defaults
+    """
+
+    lateness = float(max_lateness_seconds or DEFAULT_MAX_LATENESS_SECONDS)
+    future = float(max_future_seconds or DEFAULT_MAX_FUTURE_SECONDS)
+    if lateness < 0 or future < 0:
+        raise ValueError(
+            f"MAX_LATENESS_SECONDS and MAX_FUTURE_SECONDS can't be negative, got "
+            f"{max_lateness_seconds!r} and {max_future_seconds!r}"
+        )
+    return dt.timedelta(seconds=lateness), dt.timedelta(seconds=future)
+
+
+def check_geohash_precision(keys, precision):
+    """
+    Fail early when a geohash partition is longer than the geohashes written
+    """
+
+    for key in keys:
+        if key.kind == "geohash" and key.size > precision:
+            raise ValueError(
+                f"Partition key {key.name} needs a geohash precision of at least "
+                f"{key.size}, but GEOHASH_PRECISION is {precision}"
+            )
+
+
+def route_bucket(route_id, buckets):
+    """
+    Bucket of a route id; stable across processes, unlike ``hash``
+    """
+
+    return zlib.crc32(route_id.encode()) % buckets
+
+
+def _dictionary(column):
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    if not pa.types.is_dictionary(column.type):
+        column = column.dictionary_encode()
+    return column
+
+
+def partition_arrays(data, keys, hour=None):
+    """
+    One array per partition key with the partition value of every row of
+    ``data`` (a ``pa.Table`` or ``pa.RecordBatch``); nulls go to the default
+    partition. ``hour`` is the hour of the poll the rows belong to, or an
+    array with the hour of each row (see ``event_hours``).
+    """
+
+    arrays = []
+    for key in keys:
+        if key.kind == "hour":
+            if isinstance(hour, (pa.Array, pa.ChunkedArray)):
+                arrays.append(hour)
+            else:
+                arrays.append(pa.repeat(pa.scalar(hour, pa.string()), data.num_rows))
+            continue
+
+        column = _dictionary(data.column("route_id" if key.kind == "route_bucket" else "geohash"))
+        values = column.dictionary.to_pylist()
+        if key.kind == "route_bucket":
+            mapped = pa.array(
+                [None if value is None else route_bucket(value, key.size) for value in values],
+                type=pa.int32(),
+            )
+        else:
+            mapped = pa.array(
+                [None if value is None else value[: key.size] for value in values],
+                type=pa.string(),
+            )
+        arrays.append(mapped.take(column.indices))
+    return arrays
+
+
+def day_partition(timestamp):
+    """
+    ``year=/month=/day=/`` path of an aware datetime, in its own time zone
+    """
+
+    return (
+        f"year={timestamp.strftime('%Y')}/month={timestamp.strftime('%m')}/"
+        f"day={timestamp.strftime('%d')}/"
+    )
+
+
+def partition_path(keys, values):
+    """
+    ``name=value/`` path segments of one partition
+    """
+
+    return "".join(
+        f"{key.name}={HIVE_DEFAULT_PARTITION if value is None else value}/"
+        for key, value in zip(keys, values)
+    )
+
+
+def _nanoseconds(column):
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    return column.cast(pa.timestamp("ns", tz=column.type.tz)).cast(pa.int64())
+
+
+def local_periods(nanoseconds, timezone):
+    """
+    (day partition, hour) in ``timezone`` of UTC nanosecond timestamps, as
+    the distinct periods and the index of each timestamp's period
+
+    Timestamps are bucketed by UTC quarter hour first, every UTC offset in
+    use being a multiple of 15 minutes, so only a few datetimes are built.
+    """
+
+    buckets, inverse = np.unique(nanoseconds // QUARTER_HOUR_NS, return_inverse=True)
+    local = [
+        dt.datetime.fromtimestamp(bucket * QUARTER_HOUR_NS // NANOSECONDS_PER_SECOND, timezone)
+        for bucket in buckets.tolist()
+    ]
+    periods = sorted({(day_partition(time), time.strftime("%H")) for time in local})
+    index = {period: i for i, period in enumerate(periods)}
+    codes = np.array(
+        [index[(day_partition(time), time.strftime("%H"))] for time in local], dtype=np.int32
+    )
+    return periods, codes[inverse.reshape(-1)]
+
+
+def event_hours(column):
+    """
+    Local hour (``HH``) of every timestamp of a zoned timestamp ``column``,
+    null where the timestamp is
+    """
+
+    nanoseconds = _nanoseconds(column)
+    periods, codes = local_periods(
+        nanoseconds.fill_null(0).to_numpy(), ZoneInfo(column.type.tz or "UTC")
+    )
+    hours = pa.array([hour for _, hour in periods], type=pa.string())
+    return hours.take(pa.array(codes, mask=np.asarray(nanoseconds.is_null())))
+
+
+def clamp_event_times(nanoseconds, poll_time, window):
+    """
+    UTC nanosecond timestamps with those outside ``window``, (max lateness,
+    max future) timedeltas around ``poll_time``, replaced by the poll time;
+    either bound can be None
+    """
+
+    max_lateness, max_future = window
+    poll = int(poll_time.timestamp()) * NANOSECONDS_PER_SECOND
+    outside = np.zeros(len(nanoseconds), dtype=bool)
+    if max_lateness is not None:
+        outside |= nanoseconds < poll - int(max_lateness.total_seconds()) * NANOSECONDS_PER_SECOND
+    if max_future is not None:
+        outside |= nanoseconds > poll + int(max_future.total_seconds()) * NANOSECONDS_PER_SECOND
+    clamped = int(outside.sum())
+    if not clamped:
+        return nanoseconds
+    count("rows_out_of_window", clamped)
+    return np.where(outside, poll, nanoseconds)
+
+
+def event_periods(nanoseconds, poll_time, fallback=None, window=DEFAULT_EVENT_TIME_WINDOW):
+    """
+    ``local_periods`` of the UTC nanosecond Arrow array ``nanoseconds`` of
+    the rows of a poll at ``poll_time``, in its time zone
+
+    Null times are placed at ``fallback`` (e.g. the feed header time), else
+    at the poll time, and times outside ``window`` at the poll time, see
+    ``clamp_event_times``.
+    """
+
+    fallback = fallback or poll_time
+    if nanoseconds.null_count:
+        nanoseconds = nanoseconds.fill_null(int(fallback.timestamp()) * NANOSECONDS_PER_SECOND)
+    nanoseconds = clamp_event_times(nanoseconds.to_numpy(), poll_time, window)
+    return local_periods(nanoseconds, poll_time.tzinfo)
+
+
+def split_partitions(
+    pa_table, keys, poll_time, event_time=False, fallback=None, window=DEFAULT_EVENT_TIME_WINDOW
+):
+    """
+    Split ``pa_table`` into (partition path, table) pairs, keeping the row
+    order inside each partition; the path starts with ``year=/month=/day=/``
+
+    By default every row belongs to the day (and hour) of ``poll_time``, an
+    aware datetime. With ``event_time`` rows are placed by their own
+    ``timestamp`` in the time zone of ``poll_time``, or by ``fallback`` (e.g.
+    the feed header time, else the poll time) when they have none, so a
+    snapshot spanning midnight, or reports arriving late, land in the day
+    they happened. Times outside ``window`` (see ``clamp_event_times``) are
+    placed at the poll time, so a broken clock can't write to days the
+    compaction never revisits.
+    """
+
+    if event_time:
+        periods, codes = event_periods(
+            _nanoseconds(pa_table["timestamp"]), poll_time, fallback, window
+        )
+    else:
+        periods, codes = [(day_partition(poll_time), poll_time.strftime("%H"))], None
+
+    if not any(key.kind == "hour" for key in keys) and len(periods) > 1:
+        # only the day is a partition level, merge the hours of a day
+        days = sorted({day for day, _ in periods})
+        codes = np.array([days.index(day) for day, _ in periods], dtype=np.int32)[codes]
+        periods = [(day, None) for day in days]
+
+    def path(period, values):
+        day, hour = period
+        values = iter(values)
+        return day + partition_path(
+            keys, [hour if key.kind == "hour" else next(values) for key in keys]
+        )
+
+    row_keys = [key for key in keys if key.kind != "hour"]
+    if len(periods) == 1 and not row_keys:
+        return [(path(periods[0], []), pa_table)]
+
+    names = [key.name for key in row_keys]
+    columns = partition_arrays(pa_table, row_keys)
+    if codes is None:
+        codes = np.zeros(pa_table.num_rows, dtype=np.int32)
+    grouped = (
+        pa.table(
+            [pa.array(codes)] + columns + [pa.array(np.arange(pa_table.num_rows))],
+            names=["period"] + names + ["row"],
+        )
+        .group_by(["period"] + names, use_threads=False)
+        .aggregate([("row", "list")])
+    )
+
+    rows = grouped["row_list"].to_pylist()
+    period_codes = grouped["period"].to_pylist()
+    values = [grouped[name].to_pylist() for name in names]
+    return [
+        (
+            path(periods[period_codes[i]], [column[i] for column in values]),
+            pa_table.take(rows[i]),
+        )
+        for i in range(grouped.num_rows)
+    ]
+
+
+def partition_label(partition):
+    """
+    ``YYYY-MM-DD`` of a partition path starting with ``year=/month=/day=/``
+    """
+
+    year, month, day = (segment.split("=", 1)[1] for segment in partition.split("/")[:3])
+    return f"{year}-{month}-{day}"
+
+
+def late_days(partitions, poll_time):
+    """
+    ``YYYY-MM-DD`` of the days before the day of ``poll_time`` among the
+    partition paths a poll wrote to
+    """
+
+    poll_day = poll_time.strftime("%Y-%m-%d")
+    labels = {partition_label(partition) for partition in partitions}
+    return sorted(label for label in labels if label < poll_day)
+
+
+def late_marker_prefix(city_name, dataset=None):
+    """
+    Prefix of the late markers of a stage, or of one of its datasets
+    """
+
+    return f"{city_name}/{LATE_MARKERS}/" + (f"{dataset}/" if dataset else "")
+
+
+def late_marker_key(city_name, dataset, label, poll_time):
+    """
+    Marker of the rows of day ``label`` written by the poll at
+    ``poll_time``; the compaction removes it once it compacted the day
+    """
+
+    return f"{late_marker_prefix(city_name, dataset)}{label}/{poll_time.strftime('%Y%m%d-%H%M%S')}"
+
+
+def hour_of_key(key):
+    """
+    Poll hour of a positions object: its ``hour=`` partition or, for raw
+    files, the HHMMSS file name; None when neither is there
+    """
+
+    match = HOUR_SEGMENT.search(key)
+    if match:
+        return None if match.group(1) == HIVE_DEFAULT_PARTITION else match.group(1)
+    match = RAW_FILE_NAME.search(key.rsplit("/", 1)[-1])
+    return match.group(1) if match else None
+
+
+def poll_time_of_key(key, timezone):
+    """
+    Time of the poll that wrote the raw positions object ``key``, from its
+    day partition and ``HHMMSS`` (or ``YYYYMMDD-HHMMSS``) name; None for
+    other objects, such as compacted files
+    """
+
+    name = RAW_POLL_TIME.search(key.rsplit("/", 1)[-1])
+    day = DAY_SEGMENTS.search(key)
+    if name is None or (day is None and name.group(1) is None):
+        return None
+    date = name.group(1) or "".join(day.groups())
+    return dt.datetime.strptime(date + name.group(2), "%Y%m%d%H%M%S").replace(tzinfo=timezone)
+
+
+def object_event_hours(key, column, window=DEFAULT_EVENT_TIME_WINDOW):
+    """
+    Event hour (``HH``) of the rows of the positions object ``key``, whose
+    zoned timestamps are ``column``, as the ETL placed them
+
+    That is the ``hour=`` partition of the key when there is one, a single
+    value. Otherwise the rows of a raw file are placed like
+    ``split_partitions`` does, around the poll time in its name, with null
+    times at the poll time (the ETL used the feed header time, seconds
+    earlier). Rows of other objects get the hour of their own timestamp.
+    """
+
+    if HOUR_SEGMENT.search(key):
+        return hour_of_key(key)
+    timezone = ZoneInfo(column.type.tz or "UTC")
+    poll_time = poll_time_of_key(key, timezone)
+    if poll_time is None:
+        return event_hours(column)
+    periods, codes = event_periods(_nanoseconds(column), poll_time, window=window)
+    return pa.array([hour for _, hour in periods], type=pa.string()).take(pa.array(codes))
+
+
+def hour_groups(uris):
+    """
+    (hour, uris) runs of consecutive objects of the same poll hour
+    """
+
+    return [(hour, list(group)) for hour, group in groupby(uris, key=hour_of_key)]
+
+
+def _geohash(latitude, longitude, precision):
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    code = []
+    bits = 0
+    value = 0
+    even = True
+    while len(code) < precision:
+        interval, coordinate = (lon_range, longitude) if even else (lat_range, latitude)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            code.append(GEOHASH_ALPHABET[value])
+            bits = 0
+            value = 0
+    return "".join(code)
+
+
+def geohash_cover(bbox, precision, limit=GEOHASH_COVER_LIMIT):
+    """
+    Geohash cells of ``precision`` characters intersecting ``bbox``
+    (min longitude, min latitude, max longitude, max latitude), or None when
+    there are more than ``limit``
+    """
+
+    xmin, ymin, xmax, ymax = bbox
+    width = 360.0 / (1 << ((5 * precision + 1) // 2))
+    height = 180.0 / (1 << (5 * precision // 2))
+
+    columns = range(
+        int((max(xmin, -180.0) + 180.0) // width), int((min(xmax, 180.0) + 180.0) // width) + 1
+    )
+    rows = range(
+        int((max(ymin, -90.0) + 90.0) // height), int((min(ymax, 90.0) + 90.0) // height) + 1
+    )
+    if len(columns) * len(rows) > limit:
+        return None
+
+    cells = set()
+    for column in columns:
+        for row in rows:
+            longitude = min(-180.0 + (column + 0.5) * width, 180.0)
+            latitude = min(-90.0 + (row + 0.5) * height, 90.0)
+            cells.add(_geohash(latitude, longitude, precision))
+    return sorted(cells)
+
+
+def _days(start, end):
+    day = start.date() if isinstance(start, dt.datetime) else start
+    last = end.date() if isinstance(end, dt.datetime) else end
+    while day <= last:
+        yield day
+        day += dt.timedelta(days=1)
+
+
+def _hours(day, start, end):
+    """
+    Hours of ``day`` between ``start`` and ``end``, None for the whole day
+    """
+
+    first = start.hour if isinstance(start, dt.datetime) and start.date() == day else 0
+    last = end.hour if isinstance(end, dt.datetime) and end.date() == day else 23
+    if first == 0 and last == 23:
+        return None
+    return [f"{hour:02d}" for hour in range(first, last + 1)]
+
+
+def partition_prefixes(city_name, dataset, keys, start, end=None, route_ids=None, bbox=None):
+    """
+    Minimal list of object prefixes holding the rows of ``dataset`` (e.g.
+    ``positions`` or ``positions_raw``) that can match the filters
+
+    ``start``/``end`` are dates or datetimes in the feed's time zone, both
+    inclusive (``end`` defaults to ``start``), ``route_ids`` a list of route
+    ids and ``bbox`` (min longitude, min latitude, max longitude, max
+    latitude). A prefix stops at the first partition level with nothing to
+    filter on; scan everything below it, e.g. ``s3://bucket/{prefix}**``.
+    """
+
+    end = start if end is None else end
+
+    filters = {}
+    for key in keys:
+        if key.kind == "route_bucket" and route_ids is not None:
+            filters[key.name] = sorted({route_bucket(route_id, key.size) for route_id in route_ids})
+        elif key.kind == "geohash" and bbox is not None:
+            filters[key.name] = geohash_cover(bbox, key.size)
+
+    prefixes = []
+    for day in _days(start, end):
+        paths = [
+            f"{city_name}/{dataset}/year={day.strftime('%Y')}/"
+            f"month={day.strftime('%m')}/day={day.strftime('%d')}/"
+        ]
+        for key in keys:
+            values = _hours(day, start, end) if key.kind == "hour" else filters.get(key.name)
+            if values is None:
+                break
+            paths = [f"{path}{key.name}={value}/" for path in paths for value in values]
+        prefixes += paths
+    return prefixes
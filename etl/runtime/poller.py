@@ -0,0 +1,277 @@
+"""
+Long running poller for GTFS realtime vehicle positions.
+
+An alternative to the scheduled Lambda for a container or a local machine.
+Feeds are polled every POLL_SECONDS over one keep-alive session. Each decoded
+snapshot is buffered as Arrow data, and one GeoParquet file per feed is
+written every FLUSH_SECONDS, or sooner once FLUSH_ROWS rows are buffered.
+The buffers are flushed on SIGTERM/SIGINT before the process exits.
+
+It reads the same environment variables as the handler (FEEDS or
+VEH_POSITION_URL/TIMEZONE/STAGE, DESTINATION_BUCKET or DESTINATION_URI,
+GEOHASH_PRECISION, SPATIAL_SORT, PARTITION_KEYS, PARTITION_TIME,
+MAX_LATENESS_SECONDS, MAX_FUTURE_SECONDS, ARCHIVE_RAW, ARCHIVE_BATCH_SECONDS,
+ARCHIVE_BATCH_BYTES). With SPATIAL_SORT all snapshots
+of a file are clustered together when it is flushed, and one file is written
+per partition. Rows are partitioned on their own timestamps, or on the time
+the buffer was opened with PARTITION_TIME=poll:
+
+    python etl/runtime/poller.py
+"""
+
+import datetime as dt
+import logging
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from zoneinfo import ZoneInfo
+
+import pyarrow as pa
+
+from archive import DEFAULT_ARCHIVE_BATCH_BYTES, DEFAULT_ARCHIVE_BATCH_SECONDS, RawArchive
+from enrich import DEFAULT_GEOHASH_PRECISION
+from feed_state import state_store_for
+from feeds import load_feeds
+from fetch import fetch_feed
+from geoparquet import write_geoparquet
+from ingest import (
+    archive_body,
+    check_unchanged,
+    decode_feed,
+    mark_late_days,
+    positions_object_key,
+)
+from partitioning import (
+    DEFAULT_EVENT_TIME_WINDOW,
+    check_geohash_precision,
+    event_time_partitioning,
+    event_time_window,
+    parse_partitioning,
+    split_partitions,
+)
+from sinks import sink_from_uri
+from spatial import cluster_positions
+
+logger = logging.getLogger()
+
+DEFAULT_POLL_SECONDS = 15
+DEFAULT_FLUSH_SECONDS = 300
+DEFAULT_FLUSH_ROWS = 1_000_000
+
+
+class FeedBuffer:
+    """Decoded snapshots of one feed waiting to be written."""
+
+    def __init__(self, feed):
+        self.feed = feed
+        self.tables = []
+        self.rows = 0
+        self.opened = None
+        self.state = None
+
+    def add(self, pa_table, state, now):
+        if self.opened is None:
+            self.opened = now
+        self.tables.append(pa_table)
+        self.rows += pa_table.num_rows
+        self.state = state
+
+    def due(self, now, flush_seconds, flush_rows):
+        if self.opened is None:
+            return False
+        return (
+            self.rows >= flush_rows
+            or (now - self.opened).total_seconds() >= flush_seconds
+            # keep each file inside one day partition
+            or now.date() != self.opened.date()
+        )
+
+    def clear(self):
+        self.tables = []
+        self.rows = 0
+        self.opened = None
+
+
+class Poller:
+    """Polls a set of feeds and writes micro-batched GeoParquet files."""
+
+    def __init__(
+        self,
+        feeds,
+        sink,
+        poll_seconds=DEFAULT_POLL_SECONDS,
+        flush_seconds=DEFAULT_FLUSH_SECONDS,
+        flush_rows=DEFAULT_FLUSH_ROWS,
+        geohash_precision=DEFAULT_GEOHASH_PRECISION,
+        spatial_sort=None,
+        partitioning=(),
+        event_time=True,
+        archive=None,
+        window=DEFAULT_EVENT_TIME_WINDOW,
+    ):
+        self.feeds = feeds
+        self.sink = sink
+        self.poll_seconds = poll_seconds
+        self.flush_seconds = flush_seconds
+        self.flush_rows = flush_rows
+        self.geohash_precision = geohash_precision
+        self.spatial_sort = spatial_sort
+        self.partitioning = partitioning
+        self.event_time = event_time
+        # a buffer holds polls up to flush_seconds after it was opened
+        max_lateness, max_future = window
+        self.window = (max_lateness, max_future + dt.timedelta(seconds=flush_seconds))
+        # RawArchive of the new feed bodies, if any
+        self.archive = archive
+        check_geohash_precision(partitioning, geohash_precision)
+
+        self.state_store = state_store_for(sink)
+        self.buffers = {feed.stage: FeedBuffer(feed) for feed in feeds}
+        self.executor = ThreadPoolExecutor(max_workers=len(feeds))
+
+    def poll_once(self):
+        """
+        Fetch every feed concurrently and buffer the ones that changed
+        """
+
+        # a download never runs into the next poll
+        deadline = time.monotonic() + self.poll_seconds
+        downloads = {
+            feed: self.executor.submit(
+                fetch_feed, feed, self.state_store.load(feed.stage), deadline=deadline
+            )
+            for feed in self.feeds
+        }
+
+        for feed, download in downloads.items():
+            try:
+                fetched = download.result()
+                reason, state = check_unchanged(
+                    feed, fetched, self.state_store.load(feed.stage)
+                )
+                if reason:
+                    logger.info("Feed for %s unchanged (%s); skipping", feed.stage, reason)
+                    continue
+
+                if self.archive is not None:
+                    archive_body(self.archive, feed, "positions", fetched.content)
+                pa_table, _ = decode_feed(feed, fetched.content, self.geohash_precision)
+                # persisted together with the data it describes on flush
+                self.state_store.save(feed.stage, state, persist=False)
+                if pa_table.num_rows:
+                    self.buffers[feed.stage].add(
+                        pa_table, state, dt.datetime.now(tz=ZoneInfo(feed.timezone))
+                    )
+            except Exception:
+                logger.exception("Failed to poll vehicle positions for %s", feed.stage)
+
+    def flush(self, buffer):
+        """
+        Write the buffered snapshots of one feed as one GeoParquet file per
+        partition, returning their keys
+
+        On failure the buffer is kept and the write retried on the next flush.
+        """
+
+        if not buffer.rows:
+            return []
+
+        feed = buffer.feed
+        pa_table = pa.concat_tables(buffer.tables)
+        if self.spatial_sort:
+            pa_table = cluster_positions(pa_table, self.spatial_sort)
+        object_keys = []
+        parts = split_partitions(
+            pa_table,
+            self.partitioning,
+            buffer.opened,
+            event_time=self.event_time,
+            window=self.window,
+        )
+        for partition, part in parts:
+            data = write_geoparquet(part)
+            object_key = positions_object_key(feed.stage, buffer.opened, partition=partition)
+
+            logger.info(
+                "Uploading %s rows (%s bytes) to %s", part.num_rows, len(data), self.sink.uri(object_key)
+            )
+            self.sink.put(object_key, data)
+            object_keys.append(object_key)
+        mark_late_days(
+            self.sink, feed.stage, "positions", [partition for partition, _ in parts], buffer.opened
+        )
+        self.state_store.save(feed.stage, buffer.state)
+        buffer.clear()
+        return object_keys
+
+    def flush_due(self, force=False):
+        for buffer in self.buffers.values():
+            now = dt.datetime.now(tz=ZoneInfo(buffer.feed.timezone))
+            if force or buffer.due(now, self.flush_seconds, self.flush_rows):
+                try:
+                    self.flush(buffer)
+                except Exception:
+                    logger.exception("Failed to flush vehicle positions for %s", buffer.feed.stage)
+        if self.archive is not None:
+            self.archive.flush(force)
+
+    def run(self, stop):
+        """
+        Poll until ``stop`` (a threading.Event) is set, then flush everything
+        """
+
+        next_poll = time.monotonic()
+        try:
+            while not stop.is_set():
+                self.poll_once()
+                self.flush_due()
+
+                next_poll += self.poll_seconds
+                stop.wait(max(0.0, next_poll - time.monotonic()))
+        finally:
+            logger.info("Stopping poller; flushing buffered snapshots")
+            self.flush_due(force=True)
+            self.executor.shutdown()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    destination_uri = os.environ.get("DESTINATION_URI") or (
+        f"s3://{os.environ.get('DESTINATION_BUCKET')}"
+    )
+
+    poller = Poller(
+        load_feeds({}),
+        sink_from_uri(destination_uri),
+        poll_seconds=float(os.environ.get("POLL_SECONDS") or DEFAULT_POLL_SECONDS),
+        flush_seconds=float(os.environ.get("FLUSH_SECONDS") or DEFAULT_FLUSH_SECONDS),
+        flush_rows=int(os.environ.get("FLUSH_ROWS") or DEFAULT_FLUSH_ROWS),
+        geohash_precision=int(
+            os.environ.get("GEOHASH_PRECISION") or DEFAULT_GEOHASH_PRECISION
+        ),
+        spatial_sort=os.environ.get("SPATIAL_SORT", "").lower() or None,
+        partitioning=parse_partitioning(os.environ.get("PARTITION_KEYS")),
+        event_time=event_time_partitioning(os.environ.get("PARTITION_TIME")),
+        window=event_time_window(
+            os.environ.get("MAX_LATENESS_SECONDS"), os.environ.get("MAX_FUTURE_SECONDS")
+        ),
+    )
+    if os.environ.get("ARCHIVE_RAW", "").lower() in ("1", "true", "yes"):
+        poller.archive = RawArchive(
+            poller.sink,
+            float(os.environ.get("ARCHIVE_BATCH_SECONDS") or DEFAULT_ARCHIVE_BATCH_SECONDS),
+            int(os.environ.get("ARCHIVE_BATCH_BYTES") or DEFAULT_ARCHIVE_BATCH_BYTES),
+        )
+
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+
+    poller.run(stop)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+"""
+Sampled cProfile and tracemalloc dumps of handler invocations.
+
+With ``PROFILE_SAMPLE_RATE`` above 0 a handler profiles that fraction of its
+invocations: each unit of work (a feed, a compacted dataset) is run under
+cProfile and tracemalloc and two objects are written next to the data, below
+``{stage}/_profiles/{service}/year=/month=/day=/``:
+
+- ``{name}.pstats``, the cProfile stats of the handler thread, readable with
+  ``pstats`` or snakeviz
+- ``{name}.json``, the wall time, the process's peak RSS, tracemalloc's
+  peak and the top allocation sites of the largest snapshot taken while
+  memory grew
+
+Snapshots are taken by a background thread whenever the traced memory grew
+by SNAPSHOT_GROWTH since the last one, so the sites are those alive near the
+peak rather than at the end. Both profilers slow the code down (tracemalloc
+by 2-3x and it adds to the memory used), which is why only a sample of
+invocations is profiled; ``PROFILE_MODES=cpu`` leaves tracemalloc off.
+tracemalloc only sees Python allocations, not Arrow's buffers, which the
+peak RSS includes.
+
+Run as a script on dumps copied from the bucket to aggregate the hot
+functions and allocation sites per agency:
+
+    aws s3 sync s3://bucket/ dumps --exclude "*" --include "*/_profiles/*"
+    python etl/runtime/profiling.py dumps --top 20
+
+Only the standard library is needed; the compaction function ships this
+module next to its handler.
+"""
+
+import argparse
+import cProfile
+import json
+import logging
+import marshal
+import os
+import pstats
+import random
+import resource
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+
+PROFILE_MODES = ("cpu", "memory")
+
+# frames kept per allocation, enough to see the caller of library code
+TRACEMALLOC_FRAMES = 10
+
+# the traced memory is checked this often, and a new snapshot is taken once
+# it grew by this factor since the last one
+SNAPSHOT_INTERVAL_SECONDS = 0.05
+SNAPSHOT_GROWTH = 1.1
+
+# allocation sites kept per dump
+ALLOCATION_SITES = 100
+
+# held by the block running each profiler: since Python 3.12 a single
+# cProfile can be active in the process, and tracemalloc is process wide
+_cpu_profiler = threading.Lock()
+_memory_profiler = threading.Lock()
+
+
+def parse_modes(value):
+    """
+    Profilers named in a comma separated ``value``, all of them when empty
+    """
+
+    if not value:
+        return PROFILE_MODES
+    modes = tuple(mode.strip().lower() for mode in value.split(",") if mode.strip())
+    for mode in modes:
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unsupported profile mode {mode!r}, expected one of {PROFILE_MODES}")
+    return modes
+
+
+def sampled(rate):
+    """
+    Whether to profile this invocation, true for a ``rate`` fraction of them
+    """
+
+    rate = float(rate or 0)
+    return rate > 0 and random.random() < rate
+
+
+def profile_key(stage, service, timestamp, name, suffix):
+    return (
+        f"{stage}/_profiles/{service}/year={timestamp.strftime('%Y')}/"
+        f"month={timestamp.strftime('%m')}/day={timestamp.strftime('%d')}/"
+        f"{timestamp.strftime('%H%M%S')}-{name}{suffix}"
+    )
+
+
+class PeakSnapshots:
+    """Snapshots of the traced memory, keeping the one taken nearest the peak."""
+
+    def __init__(self, interval=SNAPSHOT_INTERVAL_SECONDS, growth=SNAPSHOT_GROWTH):
+        self.interval = interval
+        self.growth = growth
+        self.snapshot = None
+        self.size = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="peak-snapshots", daemon=True)
+
+    def take(self):
+        current, _ = tracemalloc.get_traced_memory()
+        if current > self.size * self.growth:
+            self.snapshot = tracemalloc.take_snapshot()
+            self.size = current
+
+    def run(self):
+        while not self.stop.wait(self.interval):
+            self.take()
+
+    def start(self):
+        self.thread.start()
+
+    def finish(self):
+        self.stop.set()
+        self.thread.join()
+        self.take()
+
+
+def allocation_sites(snapshot, limit=ALLOCATION_SITES):
+    """
+    Largest allocation sites of ``snapshot`` as JSON friendly dicts
+    """
+
+    snapshot = snapshot.filter_traces(
+        [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ]
+    )
+    return [
+        {
+            "site": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+            "size": stat.size,
+            "count": stat.count,
+        }
+        for stat in snapshot.statistics("lineno")[:limit]
+    ]
+
+
+def _start_cpu_profile():
+    """
+    An enabled cProfile, or None when another block or tool is profiling
+    """
+
+    if not _cpu_profiler.acquire(blocking=False):
+        return None
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # "Another profiling tool is already active"
+        _cpu_profiler.release()
+        return None
+    return profile
+
+
+@contextmanager
+def profiled(write, stage, service, name, timestamp, modes=PROFILE_MODES):
+    """
+    Profile the block and store its dumps with ``write(key, data)``
+
+    ``name`` (e.g. the feed and the invocation id) and ``timestamp`` make
+    the keys. Failing to write a dump is logged, never raised. Blocks run
+    concurrently, e.g. by threads compacting partitions, don't wait for
+    each other: a profiler already running for another block, or any other
+    tool, is left out of this block's dump.
+    """
+
+    profile = _start_cpu_profile() if "cpu" in modes else None
+    # leave tracemalloc alone when something else is already tracing
+    trace = "memory" in modes and _memory_profiler.acquire(blocking=False)
+    if trace and tracemalloc.is_tracing():
+        _memory_profiler.release()
+        trace = False
+
+    if trace:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        snapshots = PeakSnapshots()
+        snapshots.start()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if profile is not None:
+            profile.disable()
+            _cpu_profiler.release()
+        memory = None
+        if trace:
+            snapshots.finish()
+            current, peak = tracemalloc.get_traced_memory()
+            memory = {
+                "peak_bytes": peak,
+                "current_bytes": current,
+                "snapshot_bytes": snapshots.size,
+                "sites": allocation_sites(snapshots.snapshot) if snapshots.snapshot else [],
+            }
+            tracemalloc.stop()
+            _memory_profiler.release()
+
+        summary = {
+            "stage": stage,
+            "service": service,
+            "name": name,
+            "timestamp": timestamp.isoformat(),
+            "seconds": seconds,
+            # kilobytes on Linux, high-water mark of the whole process so far
+            "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "cpu": None,
+            "memory": memory,
+        }
+        try:
+            if profile is not None:
+                profile.create_stats()
+                key = profile_key(stage, service, timestamp, name, ".pstats")
+                write(key, marshal.dumps(profile.stats))
+                summary["cpu"] = key.rsplit("/", 1)[-1]
+            write(
+                profile_key(stage, service, timestamp, name, ".json"),
+                json.dumps(summary).encode(),
+            )
+        except Exception:
+            logger.exception("Failed to write the profile of %s for %s", name, stage)
+
+
+def load_dumps(paths):
+    """
+    (summary, pstats path or None) of every dump below the ``paths``
+    directories
+    """
+
+    for root in paths:
+        for directory, _, files in os.walk(root):
+            for file in sorted(files):
+                if not file.endswith(".json"):
+                    continue
+                with open(os.path.join(directory, file)) as f:
+                    summary = json.load(f)
+                if "service" not in summary or "seconds" not in summary:
+                    continue
+                cpu = summary.get("cpu")
+                cpu = os.path.join(directory, cpu) if cpu else None
+                yield summary, cpu if cpu and os.path.exists(cpu) else None
+
+
+def hot_functions(pstats_paths, top, sort="tottime"):
+    """
+    ``top`` functions of the merged stats by ``sort`` ("tottime" or
+    "cumtime"), as (calls, tottime, cumtime, function) tuples
+    """
+
+    stats = pstats.Stats(*pstats_paths)
+    column = {"tottime": 2, "cumtime": 3}[sort]
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][column], reverse=True)
+    return [
+        (calls, tottime, cumtime, pstats.func_std_string(function))
+        for function, (_, calls, tottime, cumtime, _) in rows[:top]
+    ]
+
+
+def aggregate(paths, top=20, stage=None, service=None, sort="tottime"):
+    """
+    Per (stage, service): invocation count, wall time and peak memory
+    percentiles, the hot functions over all its cpu dumps and the allocation
+    sites summed over its memory dumps
+    """
+
+    groups = defaultdict(list)
+    for summary, cpu in load_dumps(paths):
+        if stage and summary["stage"] != stage:
+            continue
+        if service and summary["service"] != service:
+            continue
+        groups[(summary["stage"], summary["service"])].append((summary, cpu))
+
+    report = {}
+    for key, dumps in sorted(groups.items()):
+        seconds = [summary["seconds"] for summary, _ in dumps]
+        peaks = [summary["memory"]["peak_bytes"] for summary, _ in dumps if summary["memory"]]
+        rss = [summary.get("max_rss_bytes", 0) for summary, _ in dumps]
+        sites = defaultdict(lambda: [0, 0])
+        for summary, _ in dumps:
+            for site in (summary["memory"] or {}).get("sites", []):
+                sites[site["site"]][0] += site["size"]
+                sites[site["site"]][1] += 1
+        cpu = [path for _, path in dumps if path]
+        report[key] = {
+            "dumps": len(dumps),
+            "seconds_median": statistics.median(seconds),
+            "seconds_max": max(seconds),
+            "rss_max": max(rss),
+            "peak_median": statistics.median(peaks) if peaks else None,
+            "peak_max": max(peaks) if peaks else None,
+            "functions": hot_functions(cpu, top, sort) if cpu else [],
+            # mean size at the snapshot of the dumps the site shows up in
+            "sites": [
+                (site, size / seen, seen)
+                for site, (size, seen) in sorted(
+                    sites.items(), key=lambda item: item[1][0], reverse=True
+                )[:top]
+            ],
+        }
+    return report
+
+
+def print_report(report, sort="tottime"):
+    for (stage, service), group in report.items():
+        print(f"== {stage} {service}: {group['dumps']} dumps")
+        print(
+            f"   wall s median {group['seconds_median']:.2f} max {group['seconds_max']:.2f}"
+        )
+        print(f"   max RSS MB {group['rss_max'] / 1e6:.1f}")
+        if group["peak_max"] is not None:
+            print(
+                f"   traced peak MB median {group['peak_median'] / 1e6:.1f} "
+                f"max {group['peak_max'] / 1e6:.1f}"
+            )
+        if group["functions"]:
+            print(f"   hot functions by {sort}:")
+            print(f"   {'calls':>10} {'tottime':>9} {'cumtime':>9}  function")
+            for calls, tottime, cumtime, function in group["functions"]:
+                print(f"   {calls:>10} {tottime:>9.3f} {cumtime:>9.3f}  {function}")
+        if group["sites"]:
+            print("   allocation sites near the peak:")
+            print(f"   {'MB':>8} {'dumps':>6}  site")
+            for site, size, seen in group["sites"]:
+                print(f"   {size / 1e6:>8.2f} {seen:>6}  {site}")
+        print()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Aggregate profile dumps into hot functions and allocation sites per agency"
+    )
+    parser.add_argument("paths", nargs="+", help="directories holding the dumps")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--stage", help="only this agency")
+    parser.add_argument("--service", choices=("etl", "compaction"))
+    parser.add_argument("--sort", choices=("tottime", "cumtime"), default="tottime")
+    args = parser.parse_args()
+
+    report = aggregate(args.paths, args.top, args.stage, args.service, args.sort)
+    if not report:
+        print("No profile dumps found", file=sys.stderr)
+        return 1
+    print_report(report, args.sort)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,450 @@
+"""
+Replay archived feed bodies through the ETL into compacted daily files.
+
+Reads the raw archive (see ``archive``) of one agency over a date range and
+runs every body through the same decode, enrichment and partitioning as the
+handler, across all cores. Each archive batch is decoded by a worker process
+into local staging GeoParquet files, one per partition, written batch by
+batch so memory stays bounded. As soon as every batch a day depends on is
+done, another worker compacts that day with the compaction function's
+``compact_dataset`` and uploads the result in place of the day's compacted
+files:
+
+    python etl/runtime/replay.py --stage ttc --start 2024-05-01 --end 2024-05-31
+
+The source and destination default to DESTINATION_URI or DESTINATION_BUCKET,
+the time zone to the stage's entry in FEEDS, and GEOHASH_PRECISION,
+SPATIAL_SORT, PARTITION_KEYS, PARTITION_TIME, MAX_LATENESS_SECONDS and
+MAX_FUTURE_SECONDS are read as the handler reads them, SORT_KEYS as the
+compaction function does. With event time partitioning, positions reported
+late after midnight are taken from the archives of the following days, as
+far as MAX_LATENESS_SECONDS reaches; rows of days outside the
+range are dropped, so the compacted files of those days are never replaced
+by a part of them. Compacted files the replay doesn't replace are deleted,
+and on S3 the day's compaction manifest is rewritten to match the replayed
+files. The compaction handler is loaded from the repository, so replays run
+from a checkout.
+"""
+
+import argparse
+import datetime as dt
+import importlib.util
+import logging
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import ExitStack
+from dataclasses import dataclass
+from multiprocessing import get_context
+from zoneinfo import ZoneInfo
+
+import pyarrow.parquet as pq
+from google.transit import gtfs_realtime_pb2
+from pyarrow import fs
+
+from archive import archive_prefix, read_archive
+from decoder import read_feed_header
+from enrich import DEFAULT_GEOHASH_PRECISION
+from feeds import Feed, load_feeds
+from geoparquet import geoparquet_writer
+from ingest import decode_feed, default_sink_uri, header_time
+from partitioning import (
+    DEFAULT_EVENT_TIME_WINDOW,
+    check_geohash_precision,
+    day_partition,
+    event_time_partitioning,
+    event_time_window,
+    parse_partitioning,
+    split_partitions,
+)
+from sinks import S3Sink, sink_from_uri
+from spatial import SPATIAL_SORTS
+from trip_updates import decode_trip_updates
+
+logger = logging.getLogger()
+
+DATASETS = ("positions", "trip_updates")
+
+COMPACTION_HANDLER = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "compaction", "runtime", "handler.py"
+)
+
+_compaction = None
+
+
+@dataclass(frozen=True)
+class ReplayOptions:
+    """How bodies are decoded and compacted, as the handler is configured."""
+
+    geohash_precision: int = DEFAULT_GEOHASH_PRECISION
+    spatial_sort: str | None = None
+    partitioning: tuple = ()
+    event_time: bool = True
+    # (max lateness, max future) of the event times around each poll
+    window: tuple = DEFAULT_EVENT_TIME_WINDOW
+    # None sorts by the compaction function's DEFAULT_SORT_KEYS
+    sort_keys: tuple | None = None
+
+
+def load_compaction():
+    """
+    The compaction handler module, imported once per process under its own
+    name so it doesn't clash with the ETL ``handler``
+    """
+
+    global _compaction
+    if _compaction is None:
+        # the handler builds its S3 clients at import time
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+        spec = importlib.util.spec_from_file_location("compaction_handler", COMPACTION_HANDLER)
+        _compaction = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(_compaction)
+    return _compaction
+
+
+def replay_days(start, end):
+    days = []
+    day = start
+    while day <= end:
+        days.append(day)
+        day += dt.timedelta(days=1)
+    return days
+
+
+def local_day(day, timezone):
+    # an aware datetime well inside ``day``, whatever the DST shift
+    return dt.datetime.combine(day, dt.time(12), ZoneInfo(timezone))
+
+
+def source_days(dataset, day, options):
+    """
+    Archive days whose bodies may hold rows of ``day``: positions partitioned
+    on event time take late reports from the archives of the days the
+    maximum lateness reaches into
+    """
+
+    if dataset == "positions" and options.event_time:
+        # days of polls up to the window's bounds away, at least the next and previous
+        max_lateness, max_future = (
+            bound or dt.timedelta(days=1) for bound in options.window
+        )
+        after = max(1, math.ceil(max_lateness / dt.timedelta(days=1)))
+        before = max(1, math.ceil(max_future / dt.timedelta(days=1)))
+        return [day + dt.timedelta(days=n) for n in range(-before, after + 1)]
+    return [day]
+
+
+def staging_name(key, poll_time):
+    # file order is poll order, the batch id keeps batches opened the same second apart
+    batch_id = key.rsplit("/", 1)[-1].split(".", 1)[0].rsplit("-", 1)[-1]
+    return f"{poll_time.strftime('%Y%m%d-%H%M%S')}-{batch_id}.parquet"
+
+
+def replay_batch(source_uri, key, dataset, feed, staging, day_paths, options):
+    """
+    Decode every body of the archive batch at ``key`` into staging files
+    below ``staging/dataset/``, one per partition path of the ``day_paths``
+    days; returns (bodies, rows)
+    """
+
+    data = sink_from_uri(source_uri).get(key)
+    if data is None:
+        logger.warning("Archive batch %s is gone; skipping", key)
+        return 0, 0
+
+    writers = {}
+    name = None
+    bodies = rows = 0
+    files = ExitStack()
+
+    def writer(path, schema):
+        if path not in writers:
+            directory = os.path.join(staging, dataset, *path.split("/"))
+            os.makedirs(directory, exist_ok=True)
+            file = files.enter_context(open(os.path.join(directory, name), "wb"))
+            if dataset == "positions":
+                writers[path] = geoparquet_writer(file, schema)
+            else:
+                writers[path] = pq.ParquetWriter(file, schema, compression="snappy")
+        return writers[path]
+
+    with files:
+        for poll_time, body in read_archive(data, feed.timezone):
+            if name is None:
+                name = staging_name(key, poll_time)
+            bodies += 1
+            if dataset == "positions":
+                pa_table, _ = decode_feed(feed, body, options.geohash_precision)
+                if not pa_table.num_rows:
+                    continue
+                header = read_feed_header(body)
+                fallback = None
+                if header is not None and header.HasField("timestamp"):
+                    fallback = header_time(feed, header.timestamp)
+                parts = split_partitions(
+                    pa_table,
+                    options.partitioning,
+                    poll_time,
+                    event_time=options.event_time,
+                    fallback=fallback,
+                    window=options.window,
+                )
+            else:
+                message = gtfs_realtime_pb2.FeedMessage()
+                message.ParseFromString(body)
+                pa_table = decode_trip_updates(message, feed.timezone)
+                if not pa_table.num_rows:
+                    continue
+                parts = [(day_partition(poll_time), pa_table)]
+
+            for path, part in parts:
+                if not path.startswith(day_paths):
+                    continue
+                writer(path, part.schema).write_table(part)
+                rows += part.num_rows
+        for path_writer in writers.values():
+            path_writer.close()
+    return bodies, rows
+
+
+def compact_day(staging, dataset, feed, day, destination_uri, options):
+    """
+    Compact the staging files of one day and upload them below the day's
+    compacted partition, returning (objects, bytes) uploaded
+
+    Compacted files of the day the replay didn't write, e.g. of another
+    partition layout, are deleted. On S3 the day's manifest is written too,
+    counting every raw object of the day as merged, so the next scheduled
+    compaction merges into the replayed files instead of rebuilding the day
+    from its raw objects.
+    """
+
+    compaction = load_compaction()
+    date = local_day(day, feed.timezone)
+    path = day_partition(date)
+    day_dir = os.path.join(staging, dataset, *path.strip("/").split("/"))
+    uris = sorted(
+        os.path.join(directory, file)
+        for directory, _, files in os.walk(day_dir)
+        for file in files
+        if file.endswith(".parquet")
+    )
+    if not uris:
+        return 0, 0
+
+    output_dir = os.path.join(staging, "_compacted", dataset, *path.strip("/").split("/"))
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+    sort_keys = compaction.DEFAULT_SORT_KEYS if options.sort_keys is None else options.sort_keys
+    written = compaction.compact_dataset(
+        uris,
+        fs.LocalFileSystem(),
+        output_dir,
+        basename=dataset,
+        spatial_sort=options.spatial_sort,
+        partitioning=options.partitioning if dataset == "positions" else (),
+        event_time=options.event_time,
+        sort_keys=sort_keys,
+        window=options.window,
+    )
+
+    destination = sink_from_uri(destination_uri)
+    prefix = f"{feed.stage}/{dataset}/{path}"
+    rows = {}
+    size = 0
+    for relative, file_rows, file_size in written:
+        with open(os.path.join(output_dir, *relative.split("/")), "rb") as f:
+            destination.put_file(f"{prefix}{relative}", f)
+        rows[f"{prefix}{relative}"] = file_rows
+        size += file_size
+
+    # older compacted files would hold the day's rows a second time
+    for key in destination.list(prefix):
+        if key.endswith(".parquet") and key not in rows:
+            destination.delete(key)
+            logger.info("Removed %s", destination.uri(key))
+
+    if isinstance(destination, S3Sink):
+        compaction.record_compaction(
+            destination.bucket,
+            feed.stage,
+            dataset,
+            date,
+            compaction.compaction_settings(
+                options.spatial_sort, options.partitioning, options.event_time, sort_keys
+            ),
+            rows,
+        )
+    shutil.rmtree(output_dir, ignore_errors=True)
+    shutil.rmtree(day_dir, ignore_errors=True)
+    return len(rows), size
+
+
+def replay(
+    feed,
+    start,
+    end,
+    source_uri,
+    destination_uri,
+    staging,
+    datasets=DATASETS,
+    options=ReplayOptions(),
+    workers=None,
+):
+    """
+    Replay the archived ``datasets`` of ``feed`` from ``start`` to ``end``
+    (dates, inclusive) into compacted daily files, returning totals
+    """
+
+    source = sink_from_uri(source_uri)
+    days = replay_days(start, end)
+    day_paths = tuple(day_partition(local_day(day, feed.timezone)) for day in days)
+    totals = {"batches": 0, "bodies": 0, "rows": 0, "days": 0, "objects": 0, "bytes": 0}
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+        batches = {}
+        pending = {}
+        for dataset in datasets:
+            listed = set()
+            for day in days:
+                for archive_day in source_days(dataset, day, options):
+                    listed.add(archive_day)
+            for archive_day in sorted(listed):
+                prefix = archive_prefix(feed.stage, dataset, local_day(archive_day, feed.timezone))
+                for key in source.list(prefix):
+                    future = pool.submit(
+                        replay_batch, source_uri, key, dataset, feed, staging, day_paths, options
+                    )
+                    batches[future] = (dataset, archive_day)
+                    pending[(dataset, archive_day)] = pending.get((dataset, archive_day), 0) + 1
+        logger.info("Replaying %d archive batches of %d days", len(batches), len(days))
+        totals["batches"] = len(batches)
+
+        waiting = [(dataset, day) for dataset in datasets for day in days]
+        compactions = {}
+        running = set(batches)
+        while running or waiting:
+            ready = [
+                (dataset, day)
+                for dataset, day in waiting
+                if not any(pending.get((dataset, other)) for other in source_days(dataset, day, options))
+            ]
+            for dataset, day in ready:
+                waiting.remove((dataset, day))
+                future = pool.submit(
+                    compact_day, staging, dataset, feed, day, destination_uri, options
+                )
+                compactions[future] = (dataset, day)
+                running.add(future)
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                running.remove(future)
+                if future in batches:
+                    dataset, archive_day = batches[future]
+                    pending[(dataset, archive_day)] -= 1
+                    bodies, rows = future.result()
+                    totals["bodies"] += bodies
+                    totals["rows"] += rows
+                else:
+                    dataset, day = compactions[future]
+                    objects, size = future.result()
+                    if objects:
+                        totals["days"] += 1
+                        logger.info(
+                            "Compacted %s %s into %d objects (%d bytes)",
+                            dataset,
+                            day.isoformat(),
+                            objects,
+                            size,
+                        )
+                    totals["objects"] += objects
+                    totals["bytes"] += size
+    return totals
+
+
+def resolve_feed(stage, timezone):
+    if timezone:
+        return Feed(stage=stage, url="", timezone=timezone)
+    for feed in load_feeds({}):
+        if feed.stage == stage and feed.timezone:
+            return feed
+    raise ValueError(f"No time zone for {stage}; pass --timezone or define it in FEEDS")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay archived feed bodies into compacted daily files"
+    )
+    parser.add_argument("--stage", required=True, help="agency whose archive is replayed")
+    parser.add_argument("--start", required=True, type=dt.date.fromisoformat)
+    parser.add_argument("--end", type=dt.date.fromisoformat, help="last day, the start by default")
+    parser.add_argument("--source", help="sink uri holding the archive")
+    parser.add_argument("--destination", help="sink uri the compacted days go to")
+    parser.add_argument("--staging", help="local directory for intermediate files")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--timezone", help="time zone of the feed, else taken from FEEDS")
+    parser.add_argument("--datasets", default=",".join(DATASETS))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    precision = int(os.environ.get("GEOHASH_PRECISION") or DEFAULT_GEOHASH_PRECISION)
+    spatial_sort = os.environ.get("SPATIAL_SORT", "").lower() or None
+    if spatial_sort not in (None, *SPATIAL_SORTS):
+        raise ValueError(f"SPATIAL_SORT must be one of {SPATIAL_SORTS}, got {spatial_sort!r}")
+    partitioning = parse_partitioning(os.environ.get("PARTITION_KEYS"))
+    check_geohash_precision(partitioning, precision)
+    options = ReplayOptions(
+        geohash_precision=precision,
+        spatial_sort=spatial_sort,
+        partitioning=tuple(partitioning),
+        event_time=event_time_partitioning(os.environ.get("PARTITION_TIME")),
+        window=event_time_window(
+            os.environ.get("MAX_LATENESS_SECONDS"), os.environ.get("MAX_FUTURE_SECONDS")
+        ),
+        sort_keys=load_compaction().parse_sort_keys(os.environ.get("SORT_KEYS")),
+    )
+    datasets = tuple(dataset.strip() for dataset in args.datasets.split(",") if dataset.strip())
+    for dataset in datasets:
+        if dataset not in DATASETS:
+            parser.error(f"unknown dataset {dataset!r}, expected {DATASETS}")
+
+    feed = resolve_feed(args.stage, args.timezone)
+    source_uri = args.source or default_sink_uri()
+    destination_uri = args.destination or source_uri
+    staging = args.staging or tempfile.mkdtemp(prefix="replay-")
+    os.makedirs(staging, exist_ok=True)
+
+    started = time.perf_counter()
+    try:
+        totals = replay(
+            feed,
+            args.start,
+            args.end or args.start,
+            source_uri,
+            destination_uri,
+            staging,
+            datasets,
+            options,
+            args.workers,
+        )
+    finally:
+        if not args.staging:
+            shutil.rmtree(staging, ignore_errors=True)
+    seconds = time.perf_counter() - started
+    print(
+        f"Replayed {totals['bodies']} bodies ({totals['rows']} rows) of {totals['batches']} "
+        f"batches into {totals['objects']} objects for {totals['days']} days "
+        f"in {seconds:.1f} s ({totals['bodies'] / seconds:.0f} bodies/s)"
+    )
+    return 0 if totals["batches"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,129 @@
+"""
+Versioned schema of the raw vehicle position files.
+
+Version 1 stored every identifier as a plain string, bearing and speed as
+float64 and the route id a second time in ``direction_id``. Version 2
+dictionary encodes the identifiers and the geohash, keeps bearing and speed
+at the float32 precision of the feed, stores the trip's real
+``direction_id`` as uint8 and adds ``current_status``, ``stop_id`` and
+``occupancy_status``, null when a feed doesn't report them.
+
+The version is written to the schema metadata; files without it are
+version 1. ``upgrade_positions`` brings a table or batch read from an older
+file to the current version, so old and new files can be read, and
+compacted, together. Only pyarrow is needed, the compaction function ships
+this module next to its handler.
+"""
+
+import pyarrow as pa
+
+POSITIONS_SCHEMA_VERSION = 2
+SCHEMA_VERSION_KEY = b"gtfs_rt_etl:positions_schema_version"
+
+# identifiers repeat across the rows of a poll and across polls
+ID_TYPE = pa.dictionary(pa.int32(), pa.string())
+
+# enum columns store the names, dictionary encoded
+ENUM_TYPE = pa.dictionary(pa.int8(), pa.string())
+
+# columns of the current version in file order; None keeps the type of the
+# file, e.g. the time zone of ``timestamp`` or the geometry extension type
+POSITION_COLUMNS = (
+    ("trip_id", ID_TYPE),
+    ("route_id", ID_TYPE),
+    ("direction_id", pa.uint8()),
+    ("vehicle_id", ID_TYPE),
+    ("bearing", pa.float32()),
+    ("speed", pa.float32()),
+    ("timestamp", None),
+    ("current_status", ENUM_TYPE),
+    ("stop_id", ID_TYPE),
+    ("occupancy_status", ENUM_TYPE),
+    ("geohash", ID_TYPE),
+    ("geometry", None),
+)
+
+# columns whose version 1 values can't be carried over
+DROPPED_V1_VALUES = ("direction_id",)
+
+
+def schema_metadata(metadata=None):
+    """
+    ``metadata`` with the current positions schema version set
+    """
+
+    return {**(metadata or {}), SCHEMA_VERSION_KEY: str(POSITIONS_SCHEMA_VERSION).encode()}
+
+
+def positions_schema_version(schema):
+    """
+    Version of the positions schema a file was written with
+    """
+
+    return int((schema.metadata or {}).get(SCHEMA_VERSION_KEY, b"1"))
+
+
+def upgraded_schema(schema, version=None):
+    """
+    Current version of a positions file ``schema``, keeping its metadata and
+    any column the versions don't know about (e.g. the bbox covering)
+    """
+
+    if version is None:
+        version = positions_schema_version(schema)
+    if version == POSITIONS_SCHEMA_VERSION:
+        return schema
+
+    fields = []
+    for name, type in POSITION_COLUMNS:
+        index = schema.get_field_index(name)
+        if type is None:
+            if index < 0:
+                continue
+            fields.append(schema.field(index))
+        else:
+            fields.append(pa.field(name, type))
+    known = {field.name for field in fields}
+    fields += [field for field in schema if field.name not in known]
+    return pa.schema(fields, metadata=schema_metadata(schema.metadata))
+
+
+def upgrade_positions(data, version=None):
+    """
+    Bring a ``pa.Table`` or ``pa.RecordBatch`` read from a positions file of
+    any version to the current version
+
+    ``version`` is the version of the file, taken from the schema metadata
+    of ``data`` when not given. Columns added since are null, and the version
+    1 ``direction_id``, which held the route id, becomes null.
+    """
+
+    schema = data.schema
+    if version is None:
+        version = positions_schema_version(schema)
+    if version == POSITIONS_SCHEMA_VERSION:
+        return data
+
+    target = upgraded_schema(schema, version)
+    columns = []
+    for field in target:
+        index = schema.get_field_index(field.name)
+        if index < 0 or (version == 1 and field.name in DROPPED_V1_VALUES):
+            columns.append(pa.nulls(data.num_rows, type=field.type))
+        else:
+            column = data.column(index)
+            columns.append(column if column.type == field.type else column.cast(field.type))
+
+    if isinstance(data, pa.RecordBatch):
+        return pa.RecordBatch.from_arrays(columns, schema=target)
+    return pa.Table.from_arrays(columns, schema=target)
+
+
+def read_positions(source, filesystem=None):
+    """
+    Read one positions file of any version as a table of the current version
+    """
+
+    import pyarrow.parquet as pq
+
+    return upgrade_positions(pq.read_table(source, filesystem=filesystem))
@@ -0,0 +1,209 @@
+"""
+Output sinks for serialized objects written by the runtime.
+
+A sink stores bytes under a ``/`` separated key. ``S3Sink`` is what the
+deployed functions use; ``LocalSink`` and ``MemorySink`` let the pipeline
+run without network access or, for the in-memory sink, without disk, e.g.
+in the tests.
+"""
+
+import io
+import os
+import shutil
+from abc import ABC, abstractmethod
+from functools import lru_cache
+
+# objects above this size are uploaded as a multipart upload
+MULTIPART_THRESHOLD = 16 * 1024 * 1024
+
+
+class Sink(ABC):
+    """Base class for output sinks."""
+
+    @abstractmethod
+    def put(self, key, data):
+        """
+        Store ``data`` (bytes) under ``key``
+        """
+
+    def put_file(self, key, fileobj):
+        """
+        Store the rest of the binary file object ``fileobj`` under ``key``
+        """
+        self.put(key, fileobj.read())
+
+    @abstractmethod
+    def get(self, key):
+        """
+        Return the bytes stored under ``key`` or None when it doesn't exist
+        """
+
+    @abstractmethod
+    def list(self, prefix):
+        """
+        Sorted keys starting with ``prefix``
+        """
+
+    @abstractmethod
+    def delete(self, key):
+        """
+        Remove the object under ``key``, if there is one
+        """
+
+    def uri(self, key):
+        """
+        Human readable location of ``key`` used in log messages
+        """
+        return key
+
+
+class S3Sink(Sink):
+    """Writes objects to an S3 bucket."""
+
+    def __init__(self, bucket, client=None, multipart_threshold=MULTIPART_THRESHOLD):
+        if client is None:
+            # only the S3 sink needs boto3, keep it out of local and test runs
+            import boto3
+
+            client = boto3.client("s3", region_name="us-west-2")
+        self.bucket = bucket
+        self.client = client
+        self.multipart_threshold = multipart_threshold
+
+    def put(self, key, data):
+        if len(data) < self.multipart_threshold:
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+        else:
+            # s3transfer is a sizeable import that only large feeds need
+            from boto3.s3.transfer import TransferConfig
+
+            self.client.upload_fileobj(
+                io.BytesIO(data),
+                self.bucket,
+                key,
+                Config=TransferConfig(multipart_threshold=self.multipart_threshold),
+            )
+
+    def put_file(self, key, fileobj):
+        # read and sent part by part, the file is never loaded whole
+        from boto3.s3.transfer import TransferConfig
+
+        self.client.upload_fileobj(
+            fileobj,
+            self.bucket,
+            key,
+            Config=TransferConfig(multipart_threshold=self.multipart_threshold),
+        )
+
+    def get(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=key)
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return response["Body"].read()
+
+    def list(self, prefix):
+        keys = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            keys.extend(item["Key"] for item in page.get("Contents", []))
+        return sorted(keys)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def uri(self, key):
+        return f"s3://{self.bucket}/{key}"
+
+
+class LocalSink(Sink):
+    """Writes objects below a directory on the local filesystem."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write next to the target and rename so readers never see a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def put_file(self, key, fileobj):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            shutil.copyfileobj(fileobj, f)
+        os.replace(tmp_path, path)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def list(self, prefix):
+        # walk the deepest directory the prefix names, then filter on the rest
+        directory = prefix.rsplit("/", 1)[0] if "/" in prefix else ""
+        keys = []
+        for path, _, files in os.walk(self._path(directory)):
+            relative = os.path.relpath(path, self.root).replace(os.sep, "/")
+            for file in files:
+                key = file if relative == "." else f"{relative}/{file}"
+                if key.startswith(prefix) and not file.endswith(".tmp"):
+                    keys.append(key)
+        return sorted(keys)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def uri(self, key):
+        return self._path(key)
+
+
+class MemorySink(Sink):
+    """Keeps objects in a dict, for tests and benchmarks."""
+
+    def __init__(self):
+        self.objects = {}
+
+    def put(self, key, data):
+        self.objects[key] = bytes(data)
+
+    def get(self, key):
+        return self.objects.get(key)
+
+    def list(self, prefix):
+        return sorted(key for key in self.objects if key.startswith(prefix))
+
+    def delete(self, key):
+        self.objects.pop(key, None)
+
+    def uri(self, key):
+        return f"memory://{key}"
+
+
+@lru_cache(maxsize=None)
+def sink_from_uri(uri):
+    """
+    Build (once per container) the sink for ``s3://bucket``, ``file:///path``
+    or ``memory://``
+    """
+
+    if uri.startswith("s3://"):
+        return S3Sink(uri[len("s3://") :].strip("/"))
+    if uri.startswith("file://"):
+        return LocalSink(uri[len("file://") :])
+    if uri.startswith("memory://"):
+        return MemorySink()
+    raise ValueError(f"Unsupported sink uri: {uri}")
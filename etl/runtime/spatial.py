@@ -0,0 +1,208 @@
+"""
+Spatial clustering of position rows.
+
+Rows are ordered on a space filling curve key, either a Hilbert curve or
+the Z-order of geohashes, so rows that are close on the map end up close in
+the file. Each row group then covers a small area and its ``bbox`` covering
+statistics let readers skip the row groups a spatial filter can't match,
+instead of every row group spanning the whole city.
+
+Keys are computed on a fixed global grid, so files sorted separately (e.g.
+the raw polls of a day) are ordered consistently. Rows without a position
+sort last. Only NumPy and pyarrow are needed, the compaction function ships
+this module next to its handler.
+"""
+
+import numpy as np
+import pyarrow as pa
+
+SPATIAL_SORTS = ("hilbert", "geohash")
+
+# cells per axis of the Hilbert grid are 2**HILBERT_ORDER, ~38 m of longitude
+HILBERT_ORDER = 20
+
+# bits per axis of the Z-order key, as many as a 12 character geohash
+GEOHASH_BITS = 30
+
+# byte order flag, uint32 geometry type (1 = Point), x, y
+WKB_POINT_SIZE = 21
+
+
+def _quantize(values, low, high, bits):
+    """
+    Cell index of each value after ``bits`` halvings of [low, high]
+
+    Values sitting exactly on a cell edge go to the upper cell, as they do in
+    pygeohash. Float32 feed coordinates hit those dyadic edges often.
+    """
+
+    cells = 1 << bits
+    index = np.floor((values - low) / (high - low) * cells)
+    return np.clip(index, 0, cells - 1).astype(np.uint64)
+
+
+def _spread_bits(values):
+    """
+    Insert a zero bit above every bit of a (up to 32 bit) unsigned integer
+    """
+
+    values = values & np.uint64(0x00000000FFFFFFFF)
+    values = (values | (values << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    values = (values | (values << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    values = (values | (values << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    values = (values | (values << np.uint64(2))) & np.uint64(0x3333333333333333)
+    values = (values | (values << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return values
+
+
+def geohash_bits(longitude, latitude, total_bits):
+    """
+    The first ``total_bits`` (up to 64) bits of the geohash of each point, as
+    a uint64 array
+
+    Geohash bits alternate longitude, latitude, ... starting with longitude,
+    so longitude gets the extra bit of an odd ``total_bits``.
+    """
+
+    lon_bits = (total_bits + 1) // 2
+    lat_bits = total_bits // 2
+    padding = np.uint64(lon_bits - lat_bits)
+
+    code = (_spread_bits(_quantize(longitude, -180.0, 180.0, lon_bits)) << np.uint64(1)) | (
+        _spread_bits(_quantize(latitude, -90.0, 90.0, lat_bits) << padding)
+    )
+    return code >> padding
+
+
+def hilbert_index(x, y, order=HILBERT_ORDER):
+    """
+    Distance along a Hilbert curve of order ``order`` of the cells (x, y),
+    both unsigned integer arrays below ``2**order``
+    """
+
+    x = x.astype(np.uint64)
+    y = y.astype(np.uint64)
+    last = np.uint64((1 << order) - 1)
+    index = np.zeros(len(x), dtype=np.uint64)
+
+    s = 1 << (order - 1)
+    while s > 0:
+        bit = np.uint64(s)
+        rx = (x & bit) > 0
+        ry = (y & bit) > 0
+        index += bit * bit * ((3 * rx) ^ ry).astype(np.uint64)
+
+        # rotate the quadrant so the curve stays continuous
+        flip = rx & ~ry
+        x = np.where(flip, last - x, x)
+        y = np.where(flip, last - y, y)
+        swap = ~ry
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        s >>= 1
+    return index
+
+
+def spatial_key(longitude, latitude, valid, method="hilbert"):
+    """
+    uint64 sort key of each point; rows that aren't ``valid`` get the largest
+    key so they sort last
+    """
+
+    if method not in SPATIAL_SORTS:
+        raise ValueError(f"Unsupported spatial sort {method!r}, expected one of {SPATIAL_SORTS}")
+
+    with np.errstate(invalid="ignore"):
+        valid = valid & (np.abs(latitude) <= 90.0) & (np.abs(longitude) <= 180.0)
+    longitude = np.where(valid, longitude, 0.0)
+    latitude = np.where(valid, latitude, 0.0)
+
+    if method == "hilbert":
+        key = hilbert_index(
+            _quantize(longitude, -180.0, 180.0, HILBERT_ORDER),
+            _quantize(latitude, -90.0, 90.0, HILBERT_ORDER),
+        )
+    else:
+        key = geohash_bits(longitude, latitude, 2 * GEOHASH_BITS)
+
+    return np.where(valid, key, np.iinfo(np.uint64).max)
+
+
+def _validity(array):
+    validity = array.buffers()[0]
+    if validity is None or not array.null_count:
+        return np.ones(len(array), dtype=np.bool_)
+    bits = np.unpackbits(
+        np.frombuffer(validity, dtype=np.uint8),
+        count=array.offset + len(array),
+        bitorder="little",
+    )
+    return bits[array.offset :].view(np.bool_)
+
+
+def _float_values(array):
+    array = array.cast(pa.float64())
+    values = np.frombuffer(array.buffers()[1], dtype=np.float64, count=array.offset + len(array))
+    return values[array.offset :], _validity(array)
+
+
+def point_coordinates(geometry):
+    """
+    (longitude, latitude, valid) NumPy arrays of a little endian WKB point
+    array, read straight from its buffers
+
+    Null geometries and anything that isn't a 2D point are not valid.
+    """
+
+    if isinstance(geometry, pa.ChunkedArray):
+        geometry = geometry.combine_chunks()
+    if isinstance(geometry.type, pa.ExtensionType):
+        geometry = geometry.storage
+
+    count = len(geometry)
+    offset_type = np.int64 if pa.types.is_large_binary(geometry.type) else np.int32
+    _, offsets, data = geometry.buffers()
+    offsets = np.frombuffer(offsets, dtype=offset_type, count=geometry.offset + count + 1)
+    offsets = offsets[geometry.offset :]
+    data = np.frombuffer(data, dtype=np.uint8) if data is not None else np.empty(0, np.uint8)
+
+    starts = offsets[:-1]
+    valid = _validity(geometry) & (np.diff(offsets) == WKB_POINT_SIZE)
+    header = starts[valid, None] + np.arange(5)
+    points = data[header]
+    is_point = (points[:, 0] == 1) & (points[:, 1:].view("<u4")[:, 0] == 1)
+    valid[valid] = is_point
+
+    coordinates = data[starts[valid, None] + np.arange(5, WKB_POINT_SIZE)].view("<f8")
+    longitude = np.zeros(count)
+    latitude = np.zeros(count)
+    longitude[valid] = coordinates[:, 0]
+    latitude[valid] = coordinates[:, 1]
+    return longitude, latitude, valid
+
+
+def spatial_order(pa_table, method="hilbert"):
+    """
+    Row order of ``pa_table`` along the ``method`` curve, from its latitude
+    and longitude columns or, once enriched, its WKB point geometry
+    """
+
+    names = pa_table.column_names
+    if "latitude" in names and "longitude" in names:
+        longitude, longitude_valid = _float_values(pa_table["longitude"].combine_chunks())
+        latitude, latitude_valid = _float_values(pa_table["latitude"].combine_chunks())
+        valid = longitude_valid & latitude_valid
+    else:
+        longitude, latitude, valid = point_coordinates(pa_table["geometry"])
+
+    # stable, so rows of the same cell keep their feed order
+    return np.argsort(spatial_key(longitude, latitude, valid, method), kind="stable")
+
+
+def cluster_positions(pa_table, method="hilbert"):
+    """
+    ``pa_table`` with its rows sorted along the ``method`` curve
+    """
+
+    if pa_table.num_rows < 2:
+        return pa_table
+    return pa_table.take(pa.array(spatial_order(pa_table, method)))
@@ -0,0 +1,144 @@
+"""
+Bounded memory decoding of very large vehicle position feeds.
+
+The body is read in chunks and split into the top level fields of the
+FeedMessage straight from the wire format, so the whole body, the whole
+parsed message and the whole table are never held at once. Entities are
+collected ``batch_rows`` at a time, each batch is decoded and enriched into
+an Arrow table and appended to an incremental GeoParquet writer. Peak memory
+is one batch plus the writer's open row group, whatever the size of the feed.
+"""
+
+import hashlib
+from dataclasses import dataclass, field
+
+from google.transit import gtfs_realtime_pb2
+
+from decoder import FEED_HEADER_FIELD, decode_vehicle_positions
+from enrich import DEFAULT_GEOHASH_PRECISION, enrich_positions
+from geoparquet import geoparquet_writer
+from metrics import span
+from wire import LENGTH_DELIMITED, iter_chunked_fields
+
+# FeedMessage field numbers
+FEED_ENTITY_FIELD = 2
+
+# bytes read from the response per chunk
+STREAM_CHUNK_BYTES = 1024 * 1024
+
+# entities decoded per record batch
+STREAM_BATCH_ROWS = 65536
+
+
+@dataclass
+class StreamResult:
+    """Outcome of a streamed decode; digest is None when it was abandoned."""
+
+    header_timestamp: int | None
+    rows: int = 0
+    batches: int = 0
+    # body bytes read
+    bytes: int = 0
+    digest: str | None = None
+    # rows written per partition path
+    partitions: dict = field(default_factory=dict)
+
+
+def _hashed(chunks, digest, result, tee=None):
+    for chunk in chunks:
+        digest.update(chunk)
+        result.bytes += len(chunk)
+        if tee is not None:
+            tee.write(chunk)
+        yield chunk
+
+
+def _decode_batch(entities, timezone, geohash_precision, spatial_sort=None):
+    # the encoded entity fields join into a FeedMessage without a header
+    with span("parse"):
+        message = gtfs_realtime_pb2.FeedMessage()
+        message.MergeFromString(b"".join(entities))
+    with span("decode"):
+        pa_table = decode_vehicle_positions(message, timezone)
+    if pa_table.num_rows:
+        with span("enrich"):
+            pa_table = enrich_positions(
+                pa_table, precision=geohash_precision, spatial_sort=spatial_sort
+            )
+    return pa_table
+
+
+def stream_vehicle_positions(
+    chunks,
+    output,
+    timezone,
+    geohash_precision=DEFAULT_GEOHASH_PRECISION,
+    batch_rows=STREAM_BATCH_ROWS,
+    on_header=None,
+    spatial_sort=None,
+    partitions=None,
+    tee=None,
+):
+    """
+    Decode a FeedMessage read as byte ``chunks`` into GeoParquet written to the
+    binary file object ``output``, ``batch_rows`` entities at a time
+
+    ``on_header`` is called with the FeedHeader as soon as it has been read,
+    and the rest of the body is left unread when it returns False. Nothing is
+    written to ``output`` when the feed has no vehicle positions. With
+    ``spatial_sort`` the rows of each batch are clustered along that curve.
+
+    With ``partitions``, a callable splitting a table into (partition path,
+    table) pairs, ``output`` is a callable returning the file object of a
+    partition path, called once per partition. Every chunk read is also
+    written to the binary file object ``tee``, if any, e.g. to archive the
+    body.
+    """
+
+    digest = hashlib.sha256()
+    result = StreamResult(header_timestamp=None)
+    writers = {}
+    entities = []
+
+    def write(entities):
+        pa_table = _decode_batch(entities, timezone, geohash_precision, spatial_sort)
+        if not pa_table.num_rows:
+            return
+        with span("partition"):
+            parts = partitions(pa_table) if partitions else [(None, pa_table)]
+        for path, part in parts:
+            with span("write"):
+                if path not in writers:
+                    writers[path] = geoparquet_writer(
+                        output(path) if partitions else output, part.schema
+                    )
+                writers[path].write_table(part)
+            result.partitions[path] = result.partitions.get(path, 0) + part.num_rows
+        result.rows += pa_table.num_rows
+        result.batches += 1
+
+    for field_number, wire_type, data in iter_chunked_fields(_hashed(chunks, digest, result, tee)):
+        if wire_type != LENGTH_DELIMITED:
+            continue
+        if field_number == FEED_ENTITY_FIELD:
+            entities.append(data)
+            if len(entities) >= batch_rows:
+                write(entities)
+                entities = []
+        elif field_number == FEED_HEADER_FIELD:
+            message = gtfs_realtime_pb2.FeedMessage()
+            message.MergeFromString(data)
+            header = message.header
+            if header.HasField("timestamp"):
+                result.header_timestamp = header.timestamp
+            if on_header is not None and on_header(header) is False:
+                return result
+
+    if entities:
+        write(entities)
+    with span("write"):
+        for writer in writers.values():
+            writer.close()
+
+    result.digest = digest.hexdigest()
+    return result
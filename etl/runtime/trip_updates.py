@@ -0,0 +1,268 @@
+"""
+Columnar decoder for GTFS realtime trip update feeds.
+
+Trip updates are exploded to one row per ``stop_time_update``, so arrival
+and departure predictions can be queried directly instead of being
+reconstructed from vehicle positions. Trip level fields are decoded once
+per trip and repeated onto its stop rows with a single ``take``, which
+keeps a poll with hundreds of thousands of stop predictions to a few
+compact column buffers. A trip update without stop time updates (e.g. a
+cancelled trip) becomes one row with null stop columns.
+"""
+
+import array
+from functools import lru_cache
+
+import numpy as np
+import pyarrow as pa
+from google.transit import gtfs_realtime_pb2
+
+from decoder import enum_array, null_mask, posix_to_timestamp
+from schemas import ENUM_TYPE
+
+TRIP_SCHEDULE_RELATIONSHIP = gtfs_realtime_pb2.TripDescriptor.ScheduleRelationship
+STOP_SCHEDULE_RELATIONSHIP = (
+    gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.ScheduleRelationship
+)
+
+
+@lru_cache(maxsize=None)
+def trip_update_schema(timezone):
+    """
+    Schema of the decoded trip update table for a given time zone
+    """
+
+    timestamp = pa.timestamp("ns", tz=timezone)
+    return pa.schema(
+        [
+            pa.field("trip_id", pa.string()),
+            pa.field("route_id", pa.string()),
+            pa.field("direction_id", pa.uint32()),
+            pa.field("start_date", pa.string()),
+            pa.field("start_time", pa.string()),
+            pa.field("trip_schedule_relationship", ENUM_TYPE),
+            pa.field("vehicle_id", pa.string()),
+            pa.field("timestamp", timestamp),
+            pa.field("delay", pa.int32()),
+            pa.field("stop_sequence", pa.uint32()),
+            pa.field("stop_id", pa.string()),
+            pa.field("arrival_time", timestamp),
+            pa.field("arrival_delay", pa.int32()),
+            pa.field("arrival_uncertainty", pa.int32()),
+            pa.field("departure_time", timestamp),
+            pa.field("departure_delay", pa.int32()),
+            pa.field("departure_uncertainty", pa.int32()),
+            pa.field("schedule_relationship", ENUM_TYPE),
+        ],
+    )
+
+
+class _Column:
+    """Typed values plus a validity flag per row."""
+
+    __slots__ = ("values", "valid")
+
+    def __init__(self, typecode):
+        self.values = array.array(typecode)
+        self.valid = bytearray()
+
+    def append(self, value):
+        self.values.append(value)
+        self.valid.append(1)
+
+    def append_null(self):
+        self.values.append(0)
+        self.valid.append(0)
+
+    def to_arrow(self, type):
+        dtype = np.dtype(self.values.typecode)
+        return pa.array(
+            np.frombuffer(self.values, dtype=dtype), type=type, mask=null_mask(self.valid)
+        )
+
+
+class _StopTimeEvent:
+    """Columns of one StopTimeEvent (arrival or departure)."""
+
+    __slots__ = ("time", "delay", "uncertainty")
+
+    def __init__(self):
+        self.time = _Column("q")
+        self.delay = _Column("i")
+        self.uncertainty = _Column("i")
+
+    def append_null(self):
+        self.time.append_null()
+        self.delay.append_null()
+        self.uncertainty.append_null()
+
+    def append(self, stop, name):
+        """
+        Append the ``name`` event of a StopTimeUpdate, nulls when it is unset
+        """
+
+        # runs for every stop of every trip, so the appends are spelled out
+        if not stop.HasField(name):
+            return self.append_null()
+
+        event = getattr(stop, name)
+        has = event.HasField
+        time, delay, uncertainty = self.time, self.delay, self.uncertainty
+        if has("time"):
+            time.values.append(event.time)
+            time.valid.append(1)
+        else:
+            time.values.append(0)
+            time.valid.append(0)
+        if has("delay"):
+            delay.values.append(event.delay)
+            delay.valid.append(1)
+        else:
+            delay.values.append(0)
+            delay.valid.append(0)
+        if has("uncertainty"):
+            uncertainty.values.append(event.uncertainty)
+            uncertainty.valid.append(1)
+        else:
+            uncertainty.values.append(0)
+            uncertainty.valid.append(0)
+
+    def to_arrow(self, timezone):
+        return (
+            posix_to_timestamp(
+                np.frombuffer(self.time.values, dtype=np.int64),
+                timezone,
+                mask=null_mask(self.time.valid),
+            ),
+            self.delay.to_arrow(pa.int32()),
+            self.uncertainty.to_arrow(pa.int32()),
+        )
+
+
+def decode_trip_updates(feed, timezone):
+    """
+    Decode the trip update entities of a FeedMessage into a ``pa.Table`` with
+    one row per stop time update
+    """
+
+    # one entry per trip update
+    trip_ids = []
+    route_ids = []
+    start_dates = []
+    start_times = []
+    vehicle_ids = []
+    direction_ids = _Column("I")
+    trip_relationships = _Column("i")
+    timestamps = _Column("q")
+    delays = _Column("i")
+
+    # one entry per row: the trip update it belongs to, then the stop columns
+    trip_index = array.array("q")
+    stop_sequences = _Column("I")
+    stop_ids = []
+    stop_relationships = _Column("i")
+    arrivals = _StopTimeEvent()
+    departures = _StopTimeEvent()
+
+    sequence_values, sequence_valid = stop_sequences.values, stop_sequences.valid
+    relationship_values, relationship_valid = (
+        stop_relationships.values,
+        stop_relationships.valid,
+    )
+
+    for entity in feed.entity:
+        if not entity.HasField("trip_update"):
+            continue
+        update = entity.trip_update
+        trip = update.trip
+
+        trip_ids.append(trip.trip_id if trip.HasField("trip_id") else None)
+        route_ids.append(trip.route_id if trip.HasField("route_id") else None)
+        start_dates.append(trip.start_date if trip.HasField("start_date") else None)
+        start_times.append(trip.start_time if trip.HasField("start_time") else None)
+        if trip.HasField("direction_id"):
+            direction_ids.append(trip.direction_id)
+        else:
+            direction_ids.append_null()
+        if trip.HasField("schedule_relationship"):
+            trip_relationships.append(trip.schedule_relationship)
+        else:
+            trip_relationships.append_null()
+
+        vehicle_ids.append(update.vehicle.id if update.HasField("vehicle") else None)
+        if update.HasField("timestamp"):
+            timestamps.append(update.timestamp)
+        else:
+            timestamps.append_null()
+        if update.HasField("delay"):
+            delays.append(update.delay)
+        else:
+            delays.append_null()
+
+        index = len(trip_ids) - 1
+        stop_time_updates = update.stop_time_update
+        if not stop_time_updates:
+            trip_index.append(index)
+            stop_sequences.append_null()
+            stop_ids.append(None)
+            stop_relationships.append_null()
+            arrivals.append_null()
+            departures.append_null()
+            continue
+
+        for stop in stop_time_updates:
+            has = stop.HasField
+            trip_index.append(index)
+            if has("stop_sequence"):
+                sequence_values.append(stop.stop_sequence)
+                sequence_valid.append(1)
+            else:
+                sequence_values.append(0)
+                sequence_valid.append(0)
+            stop_ids.append(stop.stop_id if has("stop_id") else None)
+            if has("schedule_relationship"):
+                relationship_values.append(stop.schedule_relationship)
+                relationship_valid.append(1)
+            else:
+                relationship_values.append(0)
+                relationship_valid.append(0)
+            arrivals.append(stop, "arrival")
+            departures.append(stop, "departure")
+
+    rows = pa.array(np.frombuffer(trip_index, dtype=np.int64), type=pa.int64())
+
+    trip_columns = [
+        pa.array(trip_ids, type=pa.string()),
+        pa.array(route_ids, type=pa.string()),
+        direction_ids.to_arrow(pa.uint32()),
+        pa.array(start_dates, type=pa.string()),
+        pa.array(start_times, type=pa.string()),
+        enum_array(
+            trip_relationships.values,
+            trip_relationships.valid,
+            TRIP_SCHEDULE_RELATIONSHIP,
+        ),
+        pa.array(vehicle_ids, type=pa.string()),
+        posix_to_timestamp(
+            np.frombuffer(timestamps.values, dtype=np.int64),
+            timezone,
+            mask=null_mask(timestamps.valid),
+        ),
+        delays.to_arrow(pa.int32()),
+    ]
+
+    return pa.Table.from_arrays(
+        [column.take(rows) for column in trip_columns]
+        + [
+            stop_sequences.to_arrow(pa.uint32()),
+            pa.array(stop_ids, type=pa.string()),
+            *arrivals.to_arrow(timezone),
+            *departures.to_arrow(timezone),
+            enum_array(
+                stop_relationships.values,
+                stop_relationships.valid,
+                STOP_SCHEDULE_RELATIONSHIP,
+            ),
+        ],
+        schema=trip_update_schema(timezone),
+    )
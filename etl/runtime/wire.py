@@ -0,0 +1,100 @@
+"""
+Minimal protobuf wire format helpers.
+
+Used to look at the top level fields of a serialized FeedMessage without
+parsing the whole message, or to split a body into its fields while it is
+still downloading.
+"""
+
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+
+def read_varint(buffer, position):
+    """
+    Decode the varint starting at ``position``, returning (value, next position)
+    """
+
+    result = 0
+    shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+
+
+def _field_bounds(buffer, position):
+    """
+    Read the field starting at ``position``, returning
+    (field_number, wire_type, start, stop)
+    """
+
+    tag, position = read_varint(buffer, position)
+    field_number, wire_type = tag >> 3, tag & 0x7
+
+    if wire_type == VARINT:
+        start = position
+        _, position = read_varint(buffer, position)
+    elif wire_type == LENGTH_DELIMITED:
+        length, start = read_varint(buffer, position)
+        position = start + length
+    elif wire_type == FIXED64:
+        start = position
+        position += 8
+    elif wire_type == FIXED32:
+        start = position
+        position += 4
+    else:
+        raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+    return field_number, wire_type, start, position
+
+
+def iter_fields(buffer, position=0, end=None):
+    """
+    Yield (field_number, wire_type, start, stop) for every field of a message
+
+    For length delimited fields ``start:stop`` is the payload, for the other
+    wire types it is the encoded value.
+    """
+
+    end = len(buffer) if end is None else end
+    while position < end:
+        field_number, wire_type, start, position = _field_bounds(buffer, position)
+        if position > end:
+            raise ValueError("Truncated protobuf message")
+        yield field_number, wire_type, start, position
+
+
+def iter_chunked_fields(chunks):
+    """
+    Yield (field_number, wire_type, data) for every field of a message read
+    as an iterable of byte chunks, e.g. an HTTP body
+
+    ``data`` is the encoded field, tag included, so fields can be joined back
+    into a message. Only the unread part of the current field is buffered.
+    """
+
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        position = 0
+        end = len(buffer)
+        while position < end:
+            try:
+                field_number, wire_type, _, stop = _field_bounds(buffer, position)
+            except IndexError:
+                # the tag or length runs into the next chunk
+                break
+            if stop > end:
+                break
+            yield field_number, wire_type, bytes(buffer[position:stop])
+            position = stop
+        del buffer[:position]
+
+    if buffer:
+        raise ValueError("Truncated protobuf message")
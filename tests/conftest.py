@@ -0,0 +1,78 @@
+"""
+Shared fixtures: the runtime modules are imported from etl/runtime, the
+compaction handler under its own name, and S3 is the filesystem backed
+stand-in of ``benchmarks/stubs.py``.
+"""
+
+import importlib.util
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUNTIME_DIR = os.path.join(REPO_DIR, "etl", "runtime")
+BENCHMARKS_DIR = os.path.join(REPO_DIR, "benchmarks")
+COMPACTION_HANDLER = os.path.join(REPO_DIR, "compaction", "runtime", "handler.py")
+
+sys.path.insert(0, RUNTIME_DIR)
+# after the runtime, whose modules some benchmarks share a name with
+sys.path.append(BENCHMARKS_DIR)
+
+BUCKET = "test"
+
+
+@pytest.fixture(scope="session")
+def s3_server(tmp_path_factory):
+    """
+    S3 stand-in, with the AWS environment pointing boto3 at it
+    """
+
+    from stubs import start_stub_server
+
+    server = start_stub_server([], str(tmp_path_factory.mktemp("s3")))
+    server.endpoint = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ.update(
+        AWS_ENDPOINT_URL_S3=server.endpoint,
+        AWS_ACCESS_KEY_ID="test",
+        AWS_SECRET_ACCESS_KEY="test",
+        AWS_DEFAULT_REGION="us-west-2",
+    )
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def bucket(s3_server):
+    """
+    An empty bucket of the S3 stand-in
+    """
+
+    if s3_server.store.has_bucket(BUCKET):
+        for key in s3_server.store.keys(BUCKET):
+            s3_server.store.delete(BUCKET, key)
+    else:
+        s3_server.store.create_bucket(BUCKET)
+    return BUCKET
+
+
+@pytest.fixture(scope="session")
+def compaction(s3_server):
+    """
+    The compaction handler module, its S3 clients talking to the stand-in
+    """
+
+    from pyarrow import fs
+
+    spec = importlib.util.spec_from_file_location("compaction_handler", COMPACTION_HANDLER)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # boto3 follows AWS_ENDPOINT_URL_S3, pyarrow needs the stand-in spelled out
+    module.s3fs = fs.S3FileSystem(
+        access_key="test",
+        secret_key="test",
+        region="us-west-2",
+        endpoint_override=s3_server.endpoint,
+        scheme="http",
+    )
+    return module
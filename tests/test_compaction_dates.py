@@ -0,0 +1,80 @@
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+from google.transit import gtfs_realtime_pb2
+
+from decoder import decode_vehicle_positions
+from enrich import enrich_positions
+from geoparquet import write_geoparquet
+from ingest import positions_object_key
+from synthetic import FleetSimulator
+
+STAGE = "ttc"
+TIMEZONE = "America/Toronto"
+POLLED_AT = datetime(2024, 5, 1, 12, 30, 15, tzinfo=ZoneInfo(TIMEZONE))
+
+
+@pytest.fixture
+def raw(s3_server, bucket):
+    simulator = FleetSimulator(20, seed=0, start=int(POLLED_AT.timestamp()))
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.ParseFromString(simulator.feed())
+    table = enrich_positions(decode_vehicle_positions(message, TIMEZONE))
+    s3_server.store.put(bucket, positions_object_key(STAGE, POLLED_AT), write_geoparquet(table))
+    return table
+
+
+def compact(compaction, bucket, **event):
+    return compaction.handler(
+        {
+            "s3_bucket": bucket,
+            "timezone": TIMEZONE,
+            "stage": STAGE,
+            "datasets": ["positions"],
+            "metrics_namespace": "",
+            "workers": 1,
+            **event,
+        },
+        None,
+    )
+
+
+def statuses(response):
+    return [(result["date"], result["status"]) for result in response["results"]]
+
+
+def test_dates_of_days(compaction, s3_server, bucket, raw):
+    response = compact(compaction, bucket, dates=["2024-05-01", "2024-05-02"])
+
+    assert statuses(response) == [("2024-05-01", "ok"), ("2024-05-02", "empty")]
+    assert s3_server.store.keys(bucket, f"{STAGE}/positions/year=2024/month=05/day=01/")
+
+
+def test_dates_of_months(compaction, s3_server, bucket, raw):
+    compact(compaction, bucket, dates=["2024-05-01"])
+
+    response = compact(compaction, bucket, dates=["2024-05"])
+
+    assert statuses(response) == [("2024-05", "ok")]
+    assert response["results"][0]["rows"] == raw.num_rows
+
+
+def test_dates_take_precedence_over_previous_periods(compaction, bucket, raw):
+    response = compact(compaction, bucket, dates=["2024-05-01"], previous_months=1)
+
+    assert statuses(response) == [("2024-05-01", "ok")]
+
+
+@pytest.mark.parametrize(
+    "event, message",
+    [
+        ({"dates": ["2024-05-01", "2024-05"]}, "all days or all months"),
+        ({"dates": ["2024-05-01T12:00"]}, "Invalid date"),
+        ({"dates": ["2024-13"]}, "Invalid date"),
+        ({}, "previous_days or previous_months is required"),
+    ],
+)
+def test_invalid_dates(compaction, bucket, event, message):
+    with pytest.raises(ValueError, match=message):
+        compact(compaction, bucket, **event)
@@ -0,0 +1,160 @@
+import pyarrow as pa
+import pytest
+
+from delta import VehicleTracker, changed_rows, latest_per_vehicle, tracker_for
+
+
+def snapshot(rows, dictionary=False):
+    """
+    Positions table of (vehicle_id, timestamp, latitude, longitude) rows
+    """
+
+    vehicle_id, timestamp, latitude, longitude = (list(column) for column in zip(*rows))
+    vehicle_id = pa.array(vehicle_id, pa.string())
+    if dictionary:
+        vehicle_id = vehicle_id.dictionary_encode()
+    return pa.table(
+        {
+            "vehicle_id": vehicle_id,
+            "timestamp": pa.array(timestamp, pa.int64()),
+            "latitude": pa.array(latitude, pa.float64()),
+            "longitude": pa.array(longitude, pa.float64()),
+            "speed": pa.array([1.0] * len(rows), pa.float32()),
+        }
+    )
+
+
+FIRST = [
+    ("a", 100, 43.65, -79.38),
+    ("b", 100, 43.66, -79.39),
+    ("c", 100, None, None),
+]
+
+
+def test_first_poll_is_a_keyframe():
+    tracker = VehicleTracker(keyframe_seconds=600)
+    table, keyframe = tracker.filter(snapshot(FIRST), now=0)
+
+    assert keyframe
+    assert table.num_rows == len(FIRST)
+
+
+def test_unchanged_rows_are_suppressed():
+    tracker = VehicleTracker(keyframe_seconds=600)
+    tracker.filter(snapshot(FIRST), now=0)
+    tracker.commit()
+
+    table, keyframe = tracker.filter(snapshot(FIRST, dictionary=True), now=30)
+
+    assert not keyframe
+    assert table.num_rows == 0
+    # the other columns are kept
+    assert table.schema.names == ["vehicle_id", "timestamp", "latitude", "longitude", "speed"]
+
+
+def test_changed_new_and_unidentified_rows_are_kept():
+    tracker = VehicleTracker(keyframe_seconds=600)
+    tracker.filter(snapshot(FIRST), now=0)
+    tracker.commit()
+
+    table, _ = tracker.filter(
+        snapshot(
+            [
+                ("a", 100, 43.65, -79.38),  # unchanged
+                ("b", 130, 43.66, -79.39),  # new timestamp
+                ("c", 100, 43.70, -79.40),  # first position
+                ("d", 130, 43.67, -79.37),  # new vehicle
+                (None, 130, 43.68, -79.36),  # no vehicle_id
+            ]
+        ),
+        now=30,
+    )
+
+    assert table["vehicle_id"].to_pylist() == ["b", "c", "d", None]
+
+
+def test_vehicles_missing_from_a_poll_keep_their_state():
+    tracker = VehicleTracker(keyframe_seconds=600)
+    tracker.filter(snapshot(FIRST), now=0)
+    tracker.commit()
+    tracker.filter(snapshot(FIRST[:1]), now=30)
+    tracker.commit()
+
+    table, _ = tracker.filter(snapshot(FIRST), now=60)
+
+    assert table.num_rows == 0
+
+
+def test_keyframe_cadence():
+    tracker = VehicleTracker(keyframe_seconds=600)
+    keyframes = []
+    for now in range(0, 1500, 30):
+        _, keyframe = tracker.filter(snapshot(FIRST), now=now)
+        tracker.commit()
+        if keyframe:
+            keyframes.append(now)
+
+    assert keyframes == [0, 600, 1200]
+
+
+def test_keyframe_writes_every_row():
+    tracker = VehicleTracker(keyframe_seconds=600)
+    tracker.filter(snapshot(FIRST), now=0)
+    tracker.commit()
+
+    table, keyframe = tracker.filter(snapshot(FIRST), now=600)
+
+    assert keyframe
+    assert table.num_rows == len(FIRST)
+
+
+def test_state_moves_forward_on_commit_only():
+    tracker = VehicleTracker(keyframe_seconds=600)
+    tracker.filter(snapshot(FIRST), now=0)
+    # the keyframe was never written, so the next poll is a keyframe again
+    _, keyframe = tracker.filter(snapshot(FIRST), now=30)
+    assert keyframe
+    tracker.commit()
+
+    moved = [("a", 160, 43.70, -79.30)] + FIRST[1:]
+    table, _ = tracker.filter(snapshot(moved), now=60)
+    assert table["vehicle_id"].to_pylist() == ["a"]
+    # not committed: the same rows are changed on the retry
+    table, _ = tracker.filter(snapshot(moved), now=90)
+    assert table["vehicle_id"].to_pylist() == ["a"]
+    # the keyframe time didn't move with an uncommitted delta
+    tracker.commit()
+    assert tracker.last_keyframe == 30
+
+
+def test_latest_per_vehicle_keeps_the_last_row():
+    table = snapshot(
+        [
+            ("a", 100, 43.65, -79.38),
+            (None, 110, 43.66, -79.39),
+            ("a", 120, 43.67, -79.40),
+        ]
+    )
+
+    latest = latest_per_vehicle(table)
+
+    assert latest.to_pylist() == [
+        {"vehicle_id": "a", "timestamp": 120, "latitude": 43.67, "longitude": -79.40}
+    ]
+
+
+def test_changed_rows_treats_nulls_as_equal():
+    previous = latest_per_vehicle(snapshot([("a", None, None, None)]))
+
+    changed = changed_rows(snapshot([("a", None, None, None), ("a", 100, None, None)]), previous)
+
+    assert changed.to_pylist() == [False, True]
+
+
+@pytest.mark.parametrize("keyframe_seconds", [60, 900])
+def test_tracker_for_keeps_one_tracker_per_stage(keyframe_seconds):
+    tracker = tracker_for("test-delta", keyframe_seconds)
+
+    assert tracker_for("test-delta", keyframe_seconds) is tracker
+    assert tracker_for("test-delta-other") is not tracker
+    assert tracker.keyframe_seconds == keyframe_seconds
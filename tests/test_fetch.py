@@ -0,0 +1,277 @@
+import threading
+import time
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import fetch
+
+URL = "https://feeds.example.com/vehicle-positions"
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, content=b"feed", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def http_error(status_code):
+    return requests.HTTPError(f"{status_code} error", response=FakeResponse(status_code))
+
+
+class FakeExecutor:
+    """
+    Runs no requests: every submitted attempt gets the next scripted
+    outcome, a response or an exception, after its delay in seconds, or
+    stays pending with a delay of None until ``resolve`` is called
+    """
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.futures = []
+        self.timeouts = []
+        self.timers = []
+
+    def submit(self, fn, url, headers, timeout, stream):
+        assert fn is fetch._get
+        self.timeouts.append(timeout)
+        future = Future()
+        self.futures.append(future)
+        delay, outcome = self.outcomes.pop(0)
+        if callable(outcome):
+            outcome = outcome(self)
+        if delay == 0:
+            self.resolve(future, outcome)
+        elif delay is not None:
+            timer = threading.Timer(delay, self.resolve, (future, outcome))
+            self.timers.append(timer)
+            timer.start()
+        return future
+
+    @staticmethod
+    def resolve(future, outcome):
+        if isinstance(outcome, BaseException):
+            future.set_exception(outcome)
+        else:
+            future.set_result(outcome)
+
+    def join(self):
+        for timer in self.timers:
+            timer.join()
+
+
+@pytest.fixture(autouse=True)
+def latencies(monkeypatch):
+    tracker = fetch.LatencyTracker()
+    monkeypatch.setattr(fetch, "latencies", tracker)
+    return tracker
+
+
+@pytest.fixture
+def executor(monkeypatch):
+    def install(*outcomes):
+        executor = FakeExecutor(*outcomes)
+        monkeypatch.setattr(fetch, "_attempt_executor", lambda: executor)
+        return executor
+
+    return install
+
+
+def warm(latencies, seconds):
+    """
+    Record enough downloads of ``seconds`` for attempts to adapt and hedge
+    """
+
+    for _ in range(fetch.MIN_LATENCY_SAMPLES):
+        latencies.record(URL, seconds)
+
+
+FEED = SimpleNamespace(url=URL, headers={"apikey": "secret"})
+
+
+def outcomes(result):
+    return [(attempt.reason, attempt.outcome) for attempt in result.attempts]
+
+
+def test_first_attempt_wins(executor, latencies):
+    executor((0, FakeResponse(headers={"ETag": '"v1"', "Last-Modified": "today"})))
+
+    result = fetch.fetch_feed(FEED)
+
+    assert result.content == b"feed"
+    assert (result.etag, result.last_modified) == ('"v1"', "today")
+    assert outcomes(result) == [("first", "ok")]
+    assert result.attempts[0].status == 200
+    assert latencies.samples[URL]
+
+
+def test_not_modified_keeps_the_validators(executor):
+    executor((0, FakeResponse(304, content=None)))
+    state = SimpleNamespace(etag='"v1"', last_modified="today")
+
+    result = fetch.fetch_feed(FEED, state=state)
+
+    assert result.not_modified
+    assert (result.etag, result.last_modified) == ('"v1"', "today")
+
+
+def test_conditional_headers():
+    state = SimpleNamespace(etag='"v1"', last_modified="today")
+
+    assert fetch.conditional_headers(FEED, state) == {
+        "apikey": "secret",
+        "If-None-Match": '"v1"',
+        "If-Modified-Since": "today",
+    }
+    assert fetch.conditional_headers(FEED) == {"apikey": "secret"}
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        http_error(503),
+        http_error(429),
+        requests.ConnectionError("reset"),
+        requests.ConnectTimeout("connect"),
+        requests.ReadTimeout("read"),
+    ],
+)
+def test_retryable_errors_are_retried(executor, error):
+    executor((0, error), (0, FakeResponse()))
+
+    result = fetch.fetch_feed(FEED)
+
+    assert result.content == b"feed"
+    assert outcomes(result) == [("first", "error"), ("retry", "ok")]
+
+
+def test_retries_are_bounded(executor):
+    executor(*[(0, http_error(502))] * fetch.MAX_ATTEMPTS)
+
+    with pytest.raises(requests.HTTPError) as raised:
+        fetch.fetch_feed(FEED)
+
+    assert len(raised.value.attempts) == fetch.MAX_ATTEMPTS
+    assert [attempt.status for attempt in raised.value.attempts] == [502] * fetch.MAX_ATTEMPTS
+
+
+def test_client_errors_are_not_retried(executor):
+    executor((0, http_error(404)))
+
+    with pytest.raises(requests.HTTPError) as raised:
+        fetch.fetch_feed(FEED)
+
+    assert [(a.reason, a.outcome, a.status) for a in raised.value.attempts] == [
+        ("first", "error", 404)
+    ]
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        requests.exceptions.MissingSchema("no scheme"),
+        requests.exceptions.InvalidURL("bad url"),
+        requests.exceptions.TooManyRedirects("loop"),
+    ],
+)
+def test_bad_requests_fail_fast(executor, error):
+    executor((0, error))
+
+    with pytest.raises(type(error)) as raised:
+        fetch.fetch_feed(FEED)
+
+    assert outcomes(raised.value) == [("first", "error")]
+
+
+def test_slow_first_attempt_is_hedged(executor, latencies):
+    warm(latencies, 0.02)
+    slow = FakeResponse(content=b"slow")
+    fake = executor((1.0, slow), (0, FakeResponse(content=b"hedge")))
+
+    result = fetch.fetch_feed(FEED)
+
+    assert result.content == b"hedge"
+    assert outcomes(result) == [("first", "abandoned"), ("hedge", "ok")]
+    # the abandoned attempt is closed once it finishes
+    fake.join()
+    assert slow.closed
+
+
+def test_hedging_can_be_turned_off(executor, latencies):
+    warm(latencies, 0.02)
+    executor((0.2, FakeResponse()))
+
+    result = fetch.fetch_feed(FEED, hedge=False)
+
+    assert outcomes(result) == [("first", "ok")]
+
+
+def test_attempt_timeout_follows_recent_downloads(latencies):
+    assert fetch.attempt_timeout(URL) == (fetch.FETCH_TIMEOUT_SECONDS, None)
+
+    warm(latencies, 0.1)
+    assert fetch.attempt_timeout(URL) == (fetch.MIN_TIMEOUT_SECONDS, 0.1)
+
+    warm(latencies, 1.0)
+    assert fetch.attempt_timeout(URL) == (fetch.TIMEOUT_MULTIPLIER * 1.0, 1.0)
+
+    warm(latencies, 10.0)
+    assert fetch.attempt_timeout(URL)[0] == fetch.FETCH_TIMEOUT_SECONDS
+
+
+def test_deadline_stops_waiting(executor):
+    slow = FakeResponse()
+    fake = executor((1.0, slow))
+
+    start = time.monotonic()
+    with pytest.raises(requests.Timeout) as raised:
+        fetch.fetch_feed(FEED, deadline=start + 0.1)
+
+    assert time.monotonic() - start < 0.9
+    assert [attempt.outcome for attempt in raised.value.attempts] == ["abandoned"]
+    # the request itself can't run past the deadline either
+    assert fake.timeouts[0] <= 0.1
+    fake.join()
+    assert slow.closed
+
+
+def test_no_attempt_starts_past_the_deadline(executor):
+    fake = executor()
+
+    with pytest.raises(requests.Timeout) as raised:
+        fetch.fetch_feed(FEED, deadline=time.monotonic() - 1)
+
+    assert raised.value.attempts == []
+    assert fake.futures == []
+
+
+def test_response_finishing_with_a_client_error_is_not_leaked(executor, latencies):
+    """
+    A hedge that fails with a 404 while the first attempt answers: both
+    land in the same ``done`` set, and the response must not be dropped
+    """
+
+    warm(latencies, 0.02)
+    response = FakeResponse()
+
+    def finish_both(fake):
+        # resolve the first attempt as the hedge completes, so the next wait
+        # returns both futures at once
+        fake.resolve(fake.futures[0], response)
+        return http_error(404)
+
+    executor((None, None), (0, finish_both))
+
+    result = fetch.fetch_feed(FEED)
+
+    assert result.content == b"feed"
+    assert not response.closed
+    assert sorted(outcomes(result)) == [("first", "ok"), ("hedge", "error")]
+
@@ -0,0 +1,229 @@
+import json
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from google.transit import gtfs_realtime_pb2
+
+from decoder import decode_vehicle_positions
+from enrich import enrich_positions
+from geoparquet import write_geoparquet
+from ingest import positions_object_key
+from synthetic import FleetSimulator
+
+STAGE = "ttc"
+TIMEZONE = "America/Toronto"
+DATE = datetime(2024, 5, 1, tzinfo=ZoneInfo(TIMEZONE))
+DAY = "year=2024/month=05/day=01/"
+RAW_PREFIX = f"{STAGE}/positions_raw/{DAY}"
+COMPACTED_PREFIX = f"{STAGE}/positions/{DAY}"
+MANIFEST = f"{STAGE}/_manifests/positions/2024-05-01.json"
+
+# columns compared between the raw and the compacted rows
+ROW_COLUMNS = ("vehicle_id", "trip_id", "timestamp", "geohash", "speed")
+
+SETTINGS = {"spatial_sort": None, "partitioning": [], "event_time": True, "sort_keys": ["a"]}
+
+
+def manifest(inputs, outputs, settings=SETTINGS):
+    return {
+        "settings": settings,
+        "inputs": {key: {"etag": etag, "size": 1, "rows": 1} for key, etag in inputs.items()},
+        "outputs": {key: {"etag": etag, "rows": 1, "bytes": 1} for key, etag in outputs.items()},
+    }
+
+
+def listed(**etags):
+    return {key: {"ETag": etag, "Size": 1} for key, etag in etags.items()}
+
+
+def test_plan_without_a_manifest(compaction):
+    assert compaction.plan_compaction(None, listed(a="1"), {}, SETTINGS) == ("full", "no manifest")
+
+
+def test_plan_with_changed_settings(compaction):
+    plan = compaction.plan_compaction(
+        manifest({"a": "1"}, {"out": "x"}), listed(a="1"), {"out": "x"}, dict(SETTINGS, sort_keys=[])
+    )
+
+    assert plan == ("full", "settings changed")
+
+
+@pytest.mark.parametrize("outputs", [{}, {"out": "y"}, {"out": "x", "other": "z"}])
+def test_plan_with_changed_outputs(compaction, outputs):
+    plan = compaction.plan_compaction(
+        manifest({"a": "1"}, {"out": "x"}), listed(a="1"), outputs, SETTINGS
+    )
+
+    assert plan == ("full", "compacted files changed")
+
+
+@pytest.mark.parametrize("inputs", [listed(a="2"), listed(b="1")])
+def test_plan_with_a_changed_or_removed_input(compaction, inputs):
+    plan = compaction.plan_compaction(manifest({"a": "1"}, {"out": "x"}), inputs, {"out": "x"}, SETTINGS)
+
+    assert plan == ("full", "a changed")
+
+
+def test_plan_unchanged(compaction):
+    plan = compaction.plan_compaction(
+        manifest({"a": "1", "b": "2"}, {"out": "x"}), listed(a="1", b="2"), {"out": "x"}, SETTINGS
+    )
+
+    assert plan == ("unchanged", [])
+
+
+def test_plan_merges_added_inputs(compaction):
+    plan = compaction.plan_compaction(
+        manifest({"a": "1"}, {"out": "x"}), listed(a="1", b="2", c="3"), {"out": "x"}, SETTINGS
+    )
+
+    assert plan == ("merge", ["b", "c"])
+
+
+class RawDay:
+    """
+    Raw position files of DATE written straight into the S3 stand-in
+    """
+
+    def __init__(self, server, bucket, vehicles=200):
+        self.server = server
+        self.bucket = bucket
+        self.simulator = FleetSimulator(vehicles, seed=0, start=int(DATE.timestamp()) + 12 * 3600)
+
+    def poll(self, polled_at=None):
+        self.simulator.step(30)
+        message = gtfs_realtime_pb2.FeedMessage()
+        message.ParseFromString(self.simulator.feed())
+        table = enrich_positions(decode_vehicle_positions(message, TIMEZONE))
+        polled_at = polled_at or datetime.fromtimestamp(message.header.timestamp, DATE.tzinfo)
+        key = positions_object_key(STAGE, polled_at)
+        assert key.startswith(RAW_PREFIX)
+        self.server.store.put(self.bucket, key, write_geoparquet(table))
+        return key
+
+    def rows(self, prefix):
+        tables = [
+            pq.read_table(pa.BufferReader(self.server.store.read(self.bucket, key)))
+            for key in self.server.store.keys(self.bucket, prefix)
+            if key.endswith(".parquet")
+        ]
+        table = pa.concat_tables(tables, promote_options="permissive")
+        rows = zip(*(table[name].to_pylist() for name in ROW_COLUMNS))
+        # nulls sort first
+        return sorted(rows, key=lambda row: [(value is not None, value) for value in row])
+
+    def manifest(self):
+        return json.loads(self.server.store.read(self.bucket, MANIFEST))
+
+
+@pytest.fixture
+def raw(s3_server, bucket):
+    return RawDay(s3_server, bucket)
+
+
+def compact(compaction, bucket, **options):
+    return compaction.merge_objects_from_s3(
+        bucket, DATE, "days", STAGE, metrics_namespace=None, **options
+    )
+
+
+def assert_holds_raw(raw):
+    """
+    The compacted files hold every raw row exactly once
+    """
+
+    assert raw.rows(COMPACTED_PREFIX) == raw.rows(RAW_PREFIX)
+
+
+def test_full_merge_unchanged(compaction, bucket, raw):
+    first = [raw.poll() for _ in range(3)]
+
+    result = compact(compaction, bucket)
+    assert (result["status"], result["mode"], result["objects_read"]) == ("ok", "full", 3)
+    assert_holds_raw(raw)
+    manifest = raw.manifest()
+    assert sorted(manifest["inputs"]) == first
+    assert sorted(manifest["outputs"]) == raw.server.store.keys(bucket, COMPACTED_PREFIX)
+    assert sum(output["rows"] for output in manifest["outputs"].values()) == result["rows"]
+
+    added = [raw.poll() for _ in range(2)]
+    result = compact(compaction, bucket)
+    # the compacted file and the two new raw objects
+    assert (result["status"], result["mode"], result["objects_read"]) == ("ok", "merge", 3)
+    assert_holds_raw(raw)
+    assert sorted(raw.manifest()["inputs"]) == first + added
+    assert result["rows"] == len(raw.rows(RAW_PREFIX))
+
+    result = compact(compaction, bucket)
+    assert (result["status"], result["objects_read"]) == ("unchanged", 0)
+    assert_holds_raw(raw)
+
+
+def test_changed_input_is_compacted_again(compaction, bucket, raw):
+    keys = [raw.poll() for _ in range(2)]
+    compact(compaction, bucket)
+
+    # a poll rewritten under the same key, e.g. by a replay
+    raw.server.store.put(bucket, keys[0], raw.server.store.read(bucket, keys[1]))
+
+    result = compact(compaction, bucket)
+    assert (result["status"], result["mode"]) == ("ok", "full")
+    assert_holds_raw(raw)
+
+
+def test_changed_output_is_compacted_again(compaction, bucket, raw):
+    raw.poll()
+    compact(compaction, bucket)
+    [output] = raw.server.store.keys(bucket, COMPACTED_PREFIX)
+
+    # a compacted file the manifest doesn't know, e.g. of another layout
+    stray = f"{COMPACTED_PREFIX}positions_stray.parquet"
+    raw.server.store.put(bucket, stray, raw.server.store.read(bucket, output))
+    raw.poll()
+
+    result = compact(compaction, bucket)
+    assert (result["status"], result["mode"]) == ("ok", "full")
+    assert stray not in raw.server.store.keys(bucket, COMPACTED_PREFIX)
+    assert_holds_raw(raw)
+
+
+def test_failed_run_without_a_manifest_is_rebuilt(compaction, bucket, raw):
+    raw.poll()
+    compact(compaction, bucket)
+    raw.poll()
+    # a run that committed its compacted files but died before the manifest
+    compact(compaction, bucket)
+    raw.server.store.delete(bucket, MANIFEST)
+    raw.poll()
+
+    result = compact(compaction, bucket)
+    assert (result["status"], result["mode"]) == ("ok", "full")
+    assert_holds_raw(raw)
+    assert len(raw.manifest()["inputs"]) == 3
+
+
+def test_changed_settings_compact_again(compaction, bucket, raw):
+    raw.poll()
+    compact(compaction, bucket)
+    raw.poll()
+
+    result = compact(compaction, bucket, sort_keys=("route_id", "trip_id", "timestamp"))
+    assert (result["status"], result["mode"]) == ("ok", "full")
+    assert_holds_raw(raw)
+    assert raw.manifest()["settings"]["sort_keys"] == ["route_id", "trip_id", "timestamp"]
+
+
+def test_incremental_off_always_compacts_everything(compaction, bucket, raw):
+    raw.poll()
+    compact(compaction, bucket)
+
+    result = compact(compaction, bucket, incremental=False)
+    assert (result["status"], result["mode"], result["objects_read"]) == ("ok", "full", 1)
+    assert_holds_raw(raw)
+
+
+def test_empty_day(compaction, bucket):
+    assert compact(compaction, bucket)["status"] == "empty"
@@ -0,0 +1,54 @@
+import subprocess
+import sys
+from datetime import datetime
+from types import SimpleNamespace
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from conftest import RUNTIME_DIR
+from ingest import check_unchanged, header_time, positions_object_key
+
+POLLED_AT = datetime(2024, 5, 1, 12, 30, 15, tzinfo=ZoneInfo("America/Toronto"))
+
+
+@pytest.mark.parametrize("module", ["ingest", "poller", "replay"])
+def test_import_does_not_prime_the_lambda(module):
+    # priming would build an S3 client and load feed states on import
+    code = f"import sys, {module}; sys.exit('handler' in sys.modules)"
+    env = {"PRIME_ON_INIT": "true", "PATH": ""}
+    assert subprocess.run([sys.executable, "-c", code], cwd=RUNTIME_DIR, env=env).returncode == 0
+
+
+def test_positions_object_key():
+    assert positions_object_key("ttc", POLLED_AT) == (
+        "ttc/positions_raw/year=2024/month=05/day=01/123015.parquet"
+    )
+    assert positions_object_key("ttc", POLLED_AT, delta=True).endswith("/123015.delta.parquet")
+    # rows of an earlier day are named after the poll date
+    assert positions_object_key(
+        "ttc", POLLED_AT, partition="year=2024/month=04/day=30/hour=23/"
+    ) == "ttc/positions_raw/year=2024/month=04/day=30/hour=23/20240501-123015.parquet"
+
+
+def test_header_time():
+    feed = SimpleNamespace(timezone="America/Toronto")
+
+    assert header_time(feed, int(POLLED_AT.timestamp())) == POLLED_AT
+    assert header_time(feed, 0) is None
+
+
+def test_check_unchanged():
+    fetched = SimpleNamespace(
+        not_modified=False, content=b"\x0a\x05\x0a\x03\x32\x2e\x30", etag='"v1"', last_modified=None
+    )
+
+    reason, state = check_unchanged(SimpleNamespace(), fetched, None)
+    assert reason is None
+    assert state.etag == '"v1"'
+
+    assert check_unchanged(SimpleNamespace(), fetched, state)[0] is not None
+    assert check_unchanged(SimpleNamespace(), SimpleNamespace(not_modified=True), state) == (
+        "not-modified",
+        state,
+    )
@@ -0,0 +1,353 @@
+from collections import Counter
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import boto3
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from google.transit import gtfs_realtime_pb2
+
+from decoder import decode_vehicle_positions
+from enrich import enrich_positions
+from geoparquet import write_geoparquet
+from ingest import mark_late_days, positions_object_key
+from partitioning import (
+    DEFAULT_EVENT_TIME_WINDOW,
+    HIVE_DEFAULT_PARTITION,
+    clamp_event_times,
+    event_time_partitioning,
+    event_time_window,
+    late_days,
+    late_marker_key,
+    late_marker_prefix,
+    object_event_hours,
+    parse_partitioning,
+    partition_label,
+    poll_time_of_key,
+    route_bucket,
+    split_partitions,
+)
+from sinks import S3Sink
+from synthetic import FleetSimulator
+
+STAGE = "ttc"
+TIMEZONE = ZoneInfo("America/Toronto")
+POLLED_AT = datetime(2024, 5, 1, 0, 10, 15, tzinfo=TIMEZONE)
+TIMESTAMP_TYPE = pa.timestamp("ns", tz="America/Toronto")
+
+
+def at(*args):
+    return datetime(*args, tzinfo=TIMEZONE)
+
+
+def positions(timestamps, route_ids=None, geohashes=None):
+    rows = len(timestamps)
+    return pa.table(
+        {
+            "route_id": pa.array(route_ids or ["504"] * rows, pa.string()).dictionary_encode(),
+            "geohash": pa.array(geohashes or ["dpz83d"] * rows, pa.string()).dictionary_encode(),
+            "timestamp": pa.array(timestamps, TIMESTAMP_TYPE),
+            "row": pa.array(np.arange(rows)),
+        }
+    )
+
+
+def rows_by_path(parts):
+    return {path: part["row"].to_pylist() for path, part in parts}
+
+
+def test_parse_partitioning():
+    keys = parse_partitioning("hour, route_bucket:4,geohash3")
+
+    assert [(key.name, key.kind, key.size) for key in keys] == [
+        ("hour", "hour", 0),
+        ("route_bucket", "route_bucket", 4),
+        ("geohash3", "geohash", 3),
+    ]
+    assert parse_partitioning("route_bucket")[0].size == 16
+    assert parse_partitioning("") == ()
+
+
+@pytest.mark.parametrize(
+    "spec", ["minute", "route_bucket:0", "geohash13", "hour,hour", "geohash"]
+)
+def test_parse_partitioning_rejects(spec):
+    with pytest.raises(ValueError):
+        parse_partitioning(spec)
+
+
+def test_event_time_partitioning():
+    assert event_time_partitioning(None)
+    assert event_time_partitioning("Event")
+    assert not event_time_partitioning("poll")
+    with pytest.raises(ValueError):
+        event_time_partitioning("arrival")
+
+
+def test_event_time_window():
+    assert event_time_window() == DEFAULT_EVENT_TIME_WINDOW
+    assert event_time_window("", "") == DEFAULT_EVENT_TIME_WINDOW
+    assert event_time_window("3600", 60) == (timedelta(hours=1), timedelta(minutes=1))
+    with pytest.raises(ValueError):
+        event_time_window(-1)
+
+
+def test_poll_time_partitioning():
+    table = positions([at(2024, 4, 30, 23, 59), at(2024, 5, 1, 0, 10)])
+
+    parts = split_partitions(table, parse_partitioning("hour"), POLLED_AT)
+
+    assert rows_by_path(parts) == {"year=2024/month=05/day=01/hour=00/": [0, 1]}
+
+
+def test_event_time_splits_at_midnight():
+    table = positions(
+        [at(2024, 4, 30, 23, 59), at(2024, 5, 1, 0, 10), at(2024, 4, 30, 22, 1), None]
+    )
+
+    parts = split_partitions(table, (), POLLED_AT, event_time=True)
+    assert rows_by_path(parts) == {
+        "year=2024/month=04/day=30/": [0, 2],
+        # no timestamp: the poll time
+        "year=2024/month=05/day=01/": [1, 3],
+    }
+
+    parts = split_partitions(table, parse_partitioning("hour"), POLLED_AT, event_time=True)
+    assert rows_by_path(parts) == {
+        "year=2024/month=04/day=30/hour=22/": [2],
+        "year=2024/month=04/day=30/hour=23/": [0],
+        "year=2024/month=05/day=01/hour=00/": [1, 3],
+    }
+
+
+def test_null_timestamps_take_the_fallback():
+    table = positions([None, at(2024, 5, 1, 0, 5)])
+
+    parts = split_partitions(
+        table, (), POLLED_AT, event_time=True, fallback=at(2024, 4, 30, 23, 59, 58)
+    )
+
+    assert rows_by_path(parts) == {
+        "year=2024/month=04/day=30/": [0],
+        "year=2024/month=05/day=01/": [1],
+    }
+
+
+def test_times_outside_the_window_take_the_poll_time():
+    table = positions(
+        [
+            datetime(1970, 1, 1, tzinfo=ZoneInfo("UTC")),  # a stuck clock
+            POLLED_AT - timedelta(hours=23),  # late, within the day of lateness
+            POLLED_AT + timedelta(hours=1),  # beyond 15 minutes ahead
+            POLLED_AT + timedelta(minutes=10),
+        ]
+    )
+
+    parts = split_partitions(table, parse_partitioning("hour"), POLLED_AT, event_time=True)
+
+    assert rows_by_path(parts) == {
+        "year=2024/month=04/day=30/hour=01/": [1],
+        "year=2024/month=05/day=01/hour=00/": [0, 2, 3],
+    }
+
+
+def test_clamp_event_times_bounds_are_optional():
+    poll = int(POLLED_AT.timestamp()) * 1_000_000_000
+    nanoseconds = np.array([0, poll, poll * 2])
+
+    assert clamp_event_times(nanoseconds, POLLED_AT, (None, None)).tolist() == nanoseconds.tolist()
+    assert clamp_event_times(nanoseconds, POLLED_AT, (timedelta(0), None)).tolist() == [
+        poll,
+        poll,
+        poll * 2,
+    ]
+
+
+def test_row_keys():
+    table = positions(
+        [POLLED_AT] * 4,
+        route_ids=["504", "501", None, "504"],
+        geohashes=["dpz83d", "dpz2zz", "dpz83f", None],
+    )
+    keys = parse_partitioning("route_bucket:2,geohash3")
+
+    parts = split_partitions(table, keys, POLLED_AT, event_time=True)
+
+    day = "year=2024/month=05/day=01/"
+    b504, b501 = route_bucket("504", 2), route_bucket("501", 2)
+    assert b504 != b501
+    assert rows_by_path(parts) == {
+        f"{day}route_bucket={b504}/geohash3=dpz/": [0],
+        f"{day}route_bucket={b501}/geohash3=dpz/": [1],
+        f"{day}route_bucket={HIVE_DEFAULT_PARTITION}/geohash3=dpz/": [2],
+        f"{day}route_bucket={b504}/geohash3={HIVE_DEFAULT_PARTITION}/": [3],
+    }
+
+
+def test_late_days_and_markers():
+    partitions = [
+        "year=2024/month=04/day=29/hour=23/",
+        "year=2024/month=04/day=30/",
+        "year=2024/month=04/day=30/hour=01/",
+        "year=2024/month=05/day=01/",
+    ]
+
+    assert partition_label(partitions[0]) == "2024-04-29"
+    assert late_days(partitions, POLLED_AT) == ["2024-04-29", "2024-04-30"]
+    assert late_days(partitions[-1:], POLLED_AT) == []
+    assert late_marker_prefix(STAGE) == "ttc/_late/"
+    assert late_marker_key(STAGE, "positions", "2024-04-30", POLLED_AT) == (
+        "ttc/_late/positions/2024-04-30/20240501-001015"
+    )
+
+
+@pytest.mark.parametrize(
+    "key, expected",
+    [
+        ("ttc/positions_raw/year=2024/month=05/day=01/001015.parquet", POLLED_AT),
+        ("ttc/positions_raw/year=2024/month=05/day=01/001015.delta.parquet", POLLED_AT),
+        ("ttc/positions_raw/year=2024/month=04/day=30/hour=23/20240501-001015.parquet", POLLED_AT),
+        ("ttc/positions/year=2024/month=05/day=01/positions_0.parquet", None),
+    ],
+)
+def test_poll_time_of_key(key, expected):
+    assert poll_time_of_key(key, TIMEZONE) == expected
+
+
+def test_object_event_hours_follow_the_etl():
+    table = positions(
+        [
+            at(2024, 4, 30, 23, 59),
+            None,
+            datetime(1970, 1, 1, tzinfo=ZoneInfo("UTC")),
+            POLLED_AT + timedelta(hours=2),
+        ]
+    )
+
+    # what the ETL would have written with an hour partition
+    hourly = split_partitions(table, parse_partitioning("hour"), POLLED_AT, event_time=True)
+    expected = {}
+    for path, part in hourly:
+        for row in part["row"].to_pylist():
+            expected[row] = path.split("hour=")[1].rstrip("/")
+
+    daily = split_partitions(table, (), POLLED_AT, event_time=True)
+    assert len(daily) == 2
+    for partition, part in daily:
+        key = positions_object_key(STAGE, POLLED_AT, partition=partition)
+        column = part["timestamp"].combine_chunks()
+        hours = object_event_hours(key, column).to_pylist()
+        assert hours == [expected[row] for row in part["row"].to_pylist()]
+
+    column = table["timestamp"].combine_chunks()
+    day = "year=2024/month=05/day=01/"
+    assert object_event_hours(f"ttc/positions/{day}hour=07/positions_0.parquet", column) == "07"
+    # compacted files without an hour keep the hour of each timestamp
+    assert object_event_hours(f"ttc/positions/{day}positions_0.parquet", column)[2].as_py() == "19"
+
+
+def synthetic_positions(vehicles, reported_at):
+    simulator = FleetSimulator(vehicles, seed=0, start=int(reported_at.timestamp()))
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.ParseFromString(simulator.feed())
+    return enrich_positions(decode_vehicle_positions(message, "America/Toronto"))
+
+
+def test_compaction_keeps_the_etl_hours(compaction, s3_server, bucket):
+    """
+    Raw files written without an hour partition are compacted into the
+    ``hour=`` the ETL would have written them to, clamped and null
+    timestamps included
+    """
+
+    polled_at = at(2024, 5, 1, 12, 0, 15)
+    table = synthetic_positions(200, polled_at)
+    cases = [
+        polled_at - timedelta(minutes=1),  # the previous hour
+        None,  # the poll time
+        datetime(1970, 1, 1, tzinfo=ZoneInfo("UTC")),  # clamped to the poll time
+        polled_at + timedelta(hours=3),  # clamped to the poll time
+        polled_at - timedelta(hours=5),
+    ]
+    timestamps = pa.array([cases[i % len(cases)] for i in range(table.num_rows)], TIMESTAMP_TYPE)
+    table = table.set_column(table.schema.get_field_index("timestamp"), "timestamp", timestamps)
+
+    for partition, part in split_partitions(table, (), polled_at, event_time=True):
+        s3_server.store.put(
+            bucket,
+            positions_object_key(STAGE, polled_at, partition=partition),
+            write_geoparquet(part),
+        )
+
+    result = compaction.merge_objects_from_s3(
+        bucket,
+        polled_at,
+        "days",
+        STAGE,
+        partitioning=parse_partitioning("hour"),
+        metrics_namespace=None,
+    )
+    assert result["status"] == "ok"
+
+    compacted = Counter()
+    for key in s3_server.store.keys(bucket, f"{STAGE}/positions/"):
+        rows = pa.BufferReader(s3_server.store.read(bucket, key))
+        compacted[key.split("hour=")[1].split("/")[0]] += pq.read_metadata(rows).num_rows
+    expected = {
+        path.split("hour=")[1].rstrip("/"): part.num_rows
+        for path, part in split_partitions(
+            table, parse_partitioning("hour"), polled_at, event_time=True
+        )
+    }
+    assert compacted == expected
+    assert sorted(expected) == ["07", "11", "12"]
+
+
+def test_late_markers_are_compacted_and_removed(compaction, s3_server, bucket):
+    now = datetime.now(TIMEZONE)
+    window = (timedelta(days=5), timedelta(minutes=15))
+    sink = S3Sink(bucket, boto3.client("s3"))
+
+    def poll(polled_at, reported_at):
+        table = synthetic_positions(20, reported_at)
+        parts = split_partitions(table, (), polled_at, event_time=True, window=window)
+        for partition, part in parts:
+            sink.put(positions_object_key(STAGE, polled_at, partition=partition), write_geoparquet(part))
+        mark_late_days(sink, STAGE, "positions", [partition for partition, _ in parts], polled_at)
+        return table.num_rows
+
+    poll(now - timedelta(minutes=5), now - timedelta(minutes=5))
+    late_rows = poll(now, now - timedelta(days=3))
+    late_label = (now - timedelta(days=3)).strftime("%Y-%m-%d")
+    assert [key.rsplit("/", 2)[1] for key in sink.list(late_marker_prefix(STAGE))] == [late_label]
+
+    response = compaction.handler(
+        {
+            "s3_bucket": bucket,
+            "previous_days": 0,
+            "compact_to_now": True,
+            "timezone": "America/Toronto",
+            "stage": STAGE,
+            "datasets": ["positions"],
+            "metrics_namespace": "",
+            "workers": 1,
+        },
+        None,
+    )
+
+    results = {result["date"]: result for result in response["results"]}
+    assert results[late_label]["status"] == "ok"
+    assert results[late_label]["rows"] == late_rows
+    assert sink.list(late_marker_prefix(STAGE)) == []
+
+
+def test_clamped_rows_are_counted(monkeypatch):
+    counted = []
+    monkeypatch.setattr("partitioning.count", lambda name, value: counted.append((name, value)))
+    table = positions([datetime(1970, 1, 1, tzinfo=ZoneInfo("UTC")), POLLED_AT])
+
+    split_partitions(table, (), POLLED_AT, event_time=True)
+
+    assert counted == [("rows_out_of_window", 1)]
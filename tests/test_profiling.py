@@ -0,0 +1,102 @@
+import json
+import threading
+import tracemalloc
+from datetime import datetime
+from types import SimpleNamespace
+from zoneinfo import ZoneInfo
+
+import pytest
+
+import profiling
+
+TIMESTAMP = datetime(2024, 5, 1, 12, 30, 15, tzinfo=ZoneInfo("America/Toronto"))
+
+
+def summaries(dumps):
+    return {
+        json.loads(data)["name"]: json.loads(data) for key, data in dumps.items() if key.endswith(".json")
+    }
+
+
+def profile(dumps, name, barrier=None, modes=profiling.PROFILE_MODES):
+    with profiling.profiled(dumps.__setitem__, "ttc", "compaction", name, TIMESTAMP, modes):
+        sum(range(1000))
+        if barrier is not None:
+            barrier.wait(timeout=5)
+
+
+def test_profiled_writes_both_dumps():
+    dumps = {}
+
+    profile(dumps, "positions")
+
+    summary = summaries(dumps)["positions"]
+    assert summary["cpu"] == "123015-positions.pstats"
+    assert summary["memory"]["peak_bytes"] > 0
+    assert not tracemalloc.is_tracing()
+
+
+def test_concurrent_partitions_are_profiled():
+    """
+    Two partitions compacted at once: since Python 3.12 a second cProfile
+    would raise, so the partition starting second goes without the
+    profilers the first one holds
+    """
+
+    dumps = {}
+    barrier = threading.Barrier(2)
+    errors = []
+
+    def run(name):
+        try:
+            profile(dumps, name, barrier)
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=run, args=(name,)) for name in ("hour-00", "hour-01")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    written = summaries(dumps)
+    assert sorted(written) == ["hour-00", "hour-01"]
+    assert sorted(summary["cpu"] is None for summary in written.values()) == [False, True]
+    assert sorted(summary["memory"] is None for summary in written.values()) == [False, True]
+    assert not tracemalloc.is_tracing()
+
+    # the profilers are free again once both finished
+    dumps.clear()
+    profile(dumps, "positions")
+    assert summaries(dumps)["positions"]["cpu"] is not None
+
+
+def test_another_profiling_tool_leaves_out_cpu(monkeypatch):
+    class ActiveProfile:
+        def enable(self):
+            raise ValueError("Another profiling tool is already active")
+
+    monkeypatch.setattr(profiling, "cProfile", SimpleNamespace(Profile=ActiveProfile))
+    dumps = {}
+
+    profile(dumps, "positions")
+
+    summary = summaries(dumps)["positions"]
+    assert summary["cpu"] is None
+    assert summary["memory"] is not None
+    assert profiling._cpu_profiler.acquire(blocking=False)
+    profiling._cpu_profiler.release()
+
+
+@pytest.mark.parametrize(
+    "value, modes",
+    [(None, ("cpu", "memory")), ("cpu", ("cpu",)), (" Memory, cpu ", ("memory", "cpu"))],
+)
+def test_parse_modes(value, modes):
+    assert profiling.parse_modes(value) == modes
+
+
+def test_parse_modes_rejects():
+    with pytest.raises(ValueError):
+        profiling.parse_modes("wall")
@@ -0,0 +1,95 @@
+import io
+
+import boto3
+import pytest
+
+from sinks import LocalSink, MemorySink, S3Sink, Sink, sink_from_uri
+
+
+@pytest.fixture(params=["s3", "local", "memory"])
+def sink(request, tmp_path):
+    if request.param == "s3":
+        bucket = request.getfixturevalue("bucket")
+        # a small threshold so put_file takes the multipart path
+        return S3Sink(bucket, boto3.client("s3"), multipart_threshold=5 * 1024 * 1024)
+    if request.param == "local":
+        return LocalSink(str(tmp_path))
+    return MemorySink()
+
+
+def test_sink_is_abstract():
+    with pytest.raises(TypeError):
+        Sink()
+
+
+def test_put_get_round_trip(sink):
+    sink.put("stage/positions_raw/year=2024/month=05/day=01/120000.parquet", b"positions")
+    sink.put("stage/empty", b"")
+
+    assert sink.get("stage/positions_raw/year=2024/month=05/day=01/120000.parquet") == b"positions"
+    assert sink.get("stage/empty") == b""
+    assert sink.get("stage/missing") is None
+
+
+def test_put_replaces(sink):
+    sink.put("stage/state.json", b"old")
+    sink.put("stage/state.json", b"new")
+
+    assert sink.get("stage/state.json") == b"new"
+    assert sink.list("stage/") == ["stage/state.json"]
+
+
+def test_put_file_reads_from_the_current_position(sink):
+    data = bytes(range(256)) * (24 * 1024)  # 6 MB, past the multipart threshold
+    fileobj = io.BytesIO(b"skipped" + data)
+    fileobj.seek(len(b"skipped"))
+
+    sink.put_file("stage/archive.pb.zst", fileobj)
+
+    assert sink.get("stage/archive.pb.zst") == data
+
+
+def test_list_is_sorted_and_prefixed(sink):
+    keys = [
+        "stage/positions_raw/year=2024/month=05/day=02/000000.parquet",
+        "stage/positions_raw/year=2024/month=05/day=01/235900.parquet",
+        "stage/positions_raw/year=2024/month=05/day=01/000000.parquet",
+        "stage/trip_updates_raw/year=2024/month=05/day=01/000000.parquet",
+        "other/positions_raw/year=2024/month=05/day=01/000000.parquet",
+    ]
+    for key in keys:
+        sink.put(key, key.encode())
+
+    assert sink.list("stage/positions_raw/year=2024/month=05/day=01/") == sorted(keys[1:3])
+    # a prefix ending inside a key segment
+    assert sink.list("stage/positions") == sorted(keys[:3])
+    assert sink.list("stage/") == sorted(keys[:4])
+    assert sink.list("missing/") == []
+
+
+def test_delete(sink):
+    sink.put("stage/a", b"a")
+    sink.put("stage/b", b"b")
+
+    sink.delete("stage/a")
+    sink.delete("stage/missing")
+
+    assert sink.get("stage/a") is None
+    assert sink.list("stage/") == ["stage/b"]
+
+
+def test_local_sink_lists_no_partial_files(tmp_path):
+    sink = LocalSink(str(tmp_path))
+    sink.put("stage/done", b"done")
+    (tmp_path / "stage" / "done.123.tmp").write_bytes(b"partial")
+
+    assert sink.list("stage/") == ["stage/done"]
+
+
+def test_sink_from_uri(tmp_path):
+    assert isinstance(sink_from_uri(f"file://{tmp_path}"), LocalSink)
+    assert isinstance(sink_from_uri("memory://"), MemorySink)
+    # built once per uri
+    assert sink_from_uri("memory://") is sink_from_uri("memory://")
+    with pytest.raises(ValueError):
+        sink_from_uri("gs://bucket")
@@ -0,0 +1,182 @@
+import numpy as np
+import pyarrow as pa
+import pytest
+
+SCHEMA = pa.schema(
+    [
+        pa.field("route_id", pa.dictionary(pa.int32(), pa.string())),
+        pa.field("trip_id", pa.dictionary(pa.int32(), pa.string())),
+        pa.field("vehicle_id", pa.dictionary(pa.int32(), pa.string())),
+        pa.field("timestamp", pa.timestamp("ns", tz="America/Toronto")),
+        pa.field("speed", pa.float32()),
+        # tells rows with the same sort key apart
+        pa.field("row", pa.int64()),
+    ]
+)
+
+SORT_KEYS = [
+    ("timestamp",),
+    ("vehicle_id", "timestamp"),
+    ("route_id", "trip_id", "timestamp"),
+]
+
+
+def random_table(rows, seed=0, null_fraction=0.1, distinct=20):
+    """
+    Positions-like rows with few distinct ids and timestamps, so sort keys
+    tie often, and some nulls in every column
+    """
+
+    rng = np.random.default_rng(seed)
+
+    def nulls():
+        return rng.random(rows) < null_fraction
+
+    def ids(prefix):
+        values = [
+            None if null else f"{prefix}{value:03d}"
+            for value, null in zip(rng.integers(0, distinct, rows), nulls())
+        ]
+        return pa.array(values, pa.string()).dictionary_encode()
+
+    timestamps = 1_714_579_200 + rng.integers(0, distinct, rows) * 30
+    return pa.table(
+        [
+            ids("route-"),
+            ids("trip-"),
+            ids("vehicle-"),
+            pa.array(timestamps * 1_000_000_000, mask=nulls()).cast(SCHEMA.field("timestamp").type),
+            pa.array(rng.random(rows, dtype=np.float32) * 20, mask=nulls()),
+            pa.array(np.arange(rows)),
+        ],
+        schema=SCHEMA,
+    )
+
+
+def decoded(table):
+    return pa.table(
+        [
+            column.cast(column.type.value_type) if pa.types.is_dictionary(column.type) else column
+            for column in table.columns
+        ],
+        names=table.column_names,
+    )
+
+
+def batches_of(table, seed=0):
+    """
+    ``table`` as record batches of uneven sizes, some of them empty
+    """
+
+    rng = np.random.default_rng(seed)
+    offset = 0
+    while offset < table.num_rows:
+        size = int(rng.integers(0, 150))
+        yield from table.slice(offset, size).to_batches() or [
+            pa.RecordBatch.from_pylist([], schema=table.schema)
+        ]
+        offset += size
+
+
+def assert_sorted_like_arrow(output, table, columns):
+    """
+    ``output`` holds the rows of ``table`` in the order of Table.sort_by,
+    rows with equal keys in any order
+    """
+
+    # nulls sort last by default, as in the compaction
+    expected = decoded(table).sort_by([(name, "ascending") for name in columns])
+    actual = decoded(pa.Table.from_batches(output, schema=table.schema))
+
+    assert actual.num_rows == expected.num_rows
+    assert actual.select(list(columns)).to_pylist() == expected.select(list(columns)).to_pylist()
+    assert actual.sort_by("row").equals(expected.sort_by("row"))
+
+
+@pytest.fixture
+def spills(compaction, monkeypatch):
+    """
+    Runs of 100 rows read back in batches of 16, recording the spilled runs
+    """
+
+    monkeypatch.setattr(compaction, "SORT_RUN_ROWS", 100)
+    monkeypatch.setattr(compaction, "SORT_MERGE_ROWS", 16)
+    runs = []
+    spill_run = compaction.spill_run
+
+    def recorded(table, path):
+        runs.append(table.num_rows)
+        spill_run(table, path)
+
+    monkeypatch.setattr(compaction, "spill_run", recorded)
+    return runs
+
+
+@pytest.mark.parametrize("columns", SORT_KEYS)
+@pytest.mark.parametrize("seed", range(3))
+def test_spilled_sort_matches_arrow(compaction, spills, columns, seed):
+    table = random_table(2000, seed=seed)
+
+    output = list(compaction.sorted_batches(batches_of(table, seed), SCHEMA, columns))
+
+    assert len(spills) >= 10
+    assert_sorted_like_arrow(output, table, columns)
+    assert all(batch.num_rows <= 16 for batch in output)
+
+
+@pytest.mark.parametrize("columns", SORT_KEYS)
+def test_in_memory_sort_matches_arrow(compaction, monkeypatch, columns):
+    monkeypatch.setattr(compaction, "SORT_RUN_ROWS", 10_000)
+    table = random_table(2000, seed=7)
+
+    output = list(compaction.sorted_batches(batches_of(table), SCHEMA, columns))
+
+    assert_sorted_like_arrow(output, table, columns)
+
+
+@pytest.mark.parametrize(
+    "table",
+    [
+        # every key the same
+        random_table(1000, null_fraction=0.0, distinct=1),
+        # every key null
+        random_table(1000, null_fraction=1.0),
+        # reverse sorted input, so every run sorts before the ones spilled earlier
+        decoded(random_table(1000)).sort_by(
+            [("vehicle_id", "descending"), ("timestamp", "descending")]
+        ).cast(SCHEMA),
+    ],
+    ids=["ties", "nulls", "descending input"],
+)
+def test_spilled_sort_edge_cases(compaction, spills, table):
+    columns = ("vehicle_id", "timestamp")
+
+    output = list(compaction.sorted_batches(batches_of(table), SCHEMA, columns))
+
+    assert spills
+    assert_sorted_like_arrow(output, table, columns)
+
+
+def test_sorted_batches_of_nothing(compaction, spills):
+    assert list(compaction.sorted_batches(iter([]), SCHEMA, ("timestamp",))) == []
+
+
+def test_merged_runs_k_way(compaction, monkeypatch, tmp_path):
+    monkeypatch.setattr(compaction, "SORT_MERGE_ROWS", 7)
+    columns = ("vehicle_id", "timestamp")
+    table = random_table(600, seed=3)
+    # runs of uneven lengths, one of them empty
+    bounds = [0, 10, 10, 250, 400, 401, 600]
+    paths = []
+    for run, (start, stop) in enumerate(zip(bounds, bounds[1:])):
+        paths.append(str(tmp_path / f"run-{run}.arrow"))
+        compaction.spill_run(compaction.sort_table(table.slice(start, stop - start), columns), paths[-1])
+
+    output = list(compaction.merged_runs(paths, columns))
+
+    assert_sorted_like_arrow(output, table, columns)
+    # every batch has dictionaries of its own
+    for batch in output:
+        vehicle_id = batch.column("vehicle_id")
+        assert len(vehicle_id.dictionary) == len(vehicle_id.dictionary.unique())
+        assert len(vehicle_id.dictionary) <= batch.num_rows